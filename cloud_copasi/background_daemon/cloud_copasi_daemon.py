@@ -16,6 +16,8 @@
 import sys, time
 from tools.daemon import Daemon
 import tools.background_script
+from tools import wakeup
+from cloud_copasi.web_interface.pools import metrics
 from tools.response import RemoteLoggingResponse
 from cloud_copasi import settings
 import logging
@@ -40,27 +42,34 @@ class MyDaemon(Daemon):
     
     def run(self):
         log.debug('Daemon running')
+        
+        #Each phase of the background script runs on its own adaptive interval
+        scheduler = tools.background_script.get_scheduler()
+        
+        #Listen for wakeups, e.g. when a new task is submitted
+        try:
+            listener = wakeup.WakeupListener()
+        except Exception, e:
+            log.exception(e)
+            listener = None
 
         while True:
-            min_repeat_time = settings.DAEMON_POLL_TYME #Seconds
-            start_time = time.time()
-
-            try:
-                
-                tools.background_script.run()
-
-                log.debug('Background script finished')
             
+            try:
+                if scheduler.run_due_phases():
+                    metrics.write_metrics()
             except Exception, e:
                 log.exception(e)
-                
-            
             
-            finish_time = time.time()
-            difference = finish_time - start_time
+            sleep_time = scheduler.time_until_next()
             
-            if difference < min_repeat_time:
-                time.sleep(min_repeat_time - difference)
+            if listener:
+                reasons = listener.wait(sleep_time)
+                if reasons:
+                    log.debug('Woken up early: %s' % ', '.join(reasons))
+                    scheduler.wake(tools.background_script.WAKEUP_PHASES)
+            else:
+                time.sleep(sleep_time)
 
  
 
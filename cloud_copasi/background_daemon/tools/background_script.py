@@ -20,6 +20,7 @@ import logging
 
 from cloud_copasi.web_interface.pools import condor_tools, task_tools
 from cloud_copasi.background_daemon.tools import pool_tools
+from cloud_copasi.background_daemon.tools.scheduler import Scheduler
 
 if __name__ == '__main__':
     log = logging.getLogger('cloud_copasi.background_daemon.tools.background_script')
@@ -36,6 +37,8 @@ def run():
         
     condor_tools.process_condor_q()
     
+    condor_tools.submit_pending_jobs()
+    
     task_tools.update_tasks()
     
     try:
@@ -44,5 +47,42 @@ def run():
         log.exception(e)
     
     log.debug('Finished background script')
+
+#The phases of the background script, in the order they are run
+PHASES = [
+          ('ec2_refresh', pool_tools.refresh_all_ec2_pools),
+          ('condor_q', condor_tools.process_condor_q),
+          ('submit_pending_jobs', condor_tools.submit_pending_jobs),
+          ('update_tasks', task_tools.update_tasks),
+          ('terminate_idle_pools', pool_tools.terminate_idle_pools),
+          ]
+
+#The phases to run straight away when the daemon is woken up, e.g. when a new task has been submitted
+WAKEUP_PHASES = ['condor_q', 'submit_pending_jobs', 'update_tasks']
+
+#Phases that don't back off by default. Whether submit_pending_jobs can do anything depends on room being
+#made in the queue as jobs finish, not on whether it did anything last time
+NO_BACKOFF_PHASES = ['submit_pending_jobs']
+
+def get_phase_intervals(name):
+    """Return the (minimum, maximum) interval in seconds of the named phase.
+    Phases not listed in settings.DAEMON_PHASE_INTERVALS use the daemon poll times
+    """
+    min_interval = settings.DAEMON_POLL_TYME
+    if name in NO_BACKOFF_PHASES:
+        max_interval = min_interval
+    else:
+        max_interval = getattr(settings, 'DAEMON_MAX_POLL_TIME', 10 * min_interval)
+    return getattr(settings, 'DAEMON_PHASE_INTERVALS', {}).get(name, (min_interval, max_interval))
+
+def get_scheduler():
+    """Return a scheduler that runs each phase of the background script on its own adaptive interval
+    """
+    scheduler = Scheduler()
+    for name, function in PHASES:
+        min_interval, max_interval = get_phase_intervals(name)
+        scheduler.add_phase(name, function, min_interval, max_interval)
+    return scheduler
+
 if __name__ == '__main__':
     run()
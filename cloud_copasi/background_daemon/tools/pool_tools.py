@@ -11,33 +11,108 @@ from cloud_copasi.web_interface.models import EC2Pool, Task
 from cloud_copasi.web_interface.aws import ec2_tools
 
 from logging import getLogger
+from cloud_copasi import settings
+import threading, Queue, time
 from cloud_copasi.web_interface.pools import condor_tools
 from cloud_copasi.web_interface.email import email_tools
 log = getLogger(__name__)
 
+def _fetch_pool_status_worker(work_queue, result_queue, start_times):
+    """Worker thread. Makes the EC2 API calls for each pool refresh request in the work queue
+    """
+    while True:
+        try:
+            pool_id, refresh_request = work_queue.get_nowait()
+        except Queue.Empty:
+            return
+        start_times[pool_id] = time.time()
+        try:
+            result_queue.put((pool_id, ec2_tools.fetch_pool_status(refresh_request), None))
+        except Exception, e:
+            result_queue.put((pool_id, None, e))
+
 def refresh_all_ec2_pools():
     """Refresh all ec2 pools
+    The EC2 API calls for each pool are made concurrently in a bounded number of worker threads.
+    The results are written back to the database on this thread
     """
     log.debug('Refreshing all EC2 pools')
     pools = EC2Pool.objects.all() #Get all pools indiscriminately
+    pool_count = len(pools)
     
+    #Read what we need from the database first. Copied pools are refreshed through the original
+    refresh_requests = {}
     for ec2_pool in pools:
         try:
-            ec2_tools.refresh_pool(ec2_pool)
+            refresh_request = ec2_tools.get_pool_refresh_request(ec2_pool)
+            if refresh_request != None:
+                refresh_requests[refresh_request['ec2_pool'].id] = refresh_request
         except Exception, e:
             log.exception(e)
+    
+    if len(refresh_requests) == 0:
+        return pool_count
+    
+    max_workers = getattr(settings, 'EC2_REFRESH_THREADS', 8)
+    timeout = getattr(settings, 'EC2_REFRESH_TIMEOUT', 60) #Seconds per pool
+    
+    work_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+    start_times = {}
+    for pool_id, refresh_request in refresh_requests.items():
+        work_queue.put((pool_id, refresh_request))
+    
+    worker_count = min(max_workers, len(refresh_requests))
+    for i in range(worker_count):
+        worker = threading.Thread(target=_fetch_pool_status_worker, args=(work_queue, result_queue, start_times))
+        #Don't let a hung EC2 call keep the daemon from exiting
+        worker.daemon = True
+        worker.start()
+    
+    #Don't wait forever if every worker gets stuck
+    deadline = time.time() + timeout * (len(refresh_requests) / worker_count + 1)
+    pending = set(refresh_requests.keys())
+    while len(pending) > 0 and time.time() < deadline:
+        try:
+            pool_id, pool_status, error = result_queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+        else:
+            pending.discard(pool_id)
+            refresh_request = refresh_requests[pool_id]
+            if error != None:
+                log.exception(error)
+                continue
+            try:
+                ec2_tools.apply_pool_status(refresh_request, pool_status)
+            except Exception, e:
+                log.exception(e)
+        
+        #Give up on any pool that has taken too long
+        for pool_id in list(pending):
+            if pool_id in start_times and time.time() - start_times[pool_id] > timeout:
+                log.debug('Timed out refreshing pool %s' % refresh_requests[pool_id]['ec2_pool'].name)
+                pending.discard(pool_id)
+    
+    for pool_id in pending:
+        log.debug('Timed out refreshing pool %s' % refresh_requests[pool_id]['ec2_pool'].name)
+    
+    return pool_count
 
 def terminate_idle_pools():
     """Terminate any pool that doesn't have any more tasks running on it
     """
     
     ec2_pools = EC2Pool.objects.filter(auto_terminate=True)
+    pool_count = len(ec2_pools)
     for ec2_pool in ec2_pools:
         try:
             copied_pools = EC2Pool.objects.filter(copy_of=ec2_pool)
             all_tasks = Task.objects.filter(condor_pool=ec2_pool) | Task.objects.filter(condor_pool__in=copied_pools)
             running_tasks = all_tasks.filter(status='running') | all_tasks.filter(status='new')
-            if running_tasks.count() == 0 and all_tasks.count() > 0:
+            #Don't terminate a pool that other pools' tasks have federated jobs running on
+            federated_tasks = Task.objects.filter(status='running', subtask__condorjob__condor_pool__in=[ec2_pool] + list(copied_pools))
+            if running_tasks.count() == 0 and all_tasks.count() > 0 and not federated_tasks.exists():
 
                 pool_name = ec2_pool.name
                 log.debug('Terminating pool %s since no other jobs running (auto terminate)' % pool_name)
@@ -71,4 +146,5 @@ def terminate_idle_pools():
 
         except Exception, e:
             log.exception('Error terminating pool')
-            log.exception(e)
\ No newline at end of file
+            log.exception(e)
+    return pool_count
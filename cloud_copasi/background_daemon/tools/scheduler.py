@@ -0,0 +1,88 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Scheduler for the phases of the background daemon
+#Each phase runs on its own interval. While a phase has work to do it runs at its minimum interval.
+#When it is idle, or raises an exception, the interval is doubled, up to its maximum interval
+
+import time
+import logging
+from cloud_copasi.web_interface.pools import metrics
+
+log = logging.getLogger(__name__)
+
+class Phase(object):
+
+    def __init__(self, name, function, min_interval, max_interval):
+        """function is called each time the phase runs. It should return a true value if
+        there was any work to do (e.g. the number of running jobs), or a false value if idle
+        """
+        self.name = name
+        self.function = function
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min_interval
+        self.next_run = 0
+
+    def run(self):
+        try:
+            active = metrics.run_phase(self.name, self.function)
+        except Exception, e:
+            log.exception(e)
+            active = False
+
+        if active:
+            self.interval = self.min_interval
+        else:
+            #Back off
+            self.interval = min(self.interval * 2, self.max_interval)
+        self.next_run = time.time() + self.interval
+
+    def wake(self):
+        """Run this phase as soon as possible, and reset the interval"""
+        self.interval = self.min_interval
+        self.next_run = 0
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.phases = []
+
+    def add_phase(self, name, function, min_interval, max_interval):
+        self.phases.append(Phase(name, function, min_interval, max_interval))
+
+    def get_phase(self, name):
+        for phase in self.phases:
+            if phase.name == name:
+                return phase
+        raise KeyError(name)
+
+    def run_due_phases(self):
+        """Run all the phases that are due, in the order they were added. Returns the number of phases run
+        """
+        phases_run = 0
+        for phase in self.phases:
+            if phase.next_run <= time.time():
+                phase.run()
+                phases_run += 1
+        return phases_run
+
+    def time_until_next(self):
+        """The number of seconds until the next phase is due
+        """
+        if len(self.phases) == 0:
+            return None
+        return max(min([phase.next_run for phase in self.phases]) - time.time(), 0)
+
+    def wake(self, names=None):
+        """Wake the named phases (or all phases if None) so they are run straight away
+        """
+        for phase in self.phases:
+            if names == None or phase.name in names:
+                phase.wake()
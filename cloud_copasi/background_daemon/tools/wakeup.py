@@ -0,0 +1,71 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Module for waking up the background daemon early, e.g. when a new task has been submitted
+#The daemon listens on a local UDP port. Any datagram sent to it wakes the daemon up
+
+import socket, select, errno
+from cloud_copasi import settings
+import logging
+
+log = logging.getLogger(__name__)
+
+WAKEUP_ADDRESS = '127.0.0.1'
+
+def get_wakeup_port():
+    return getattr(settings, 'DAEMON_WAKEUP_PORT', 47123)
+
+def send_wakeup(reason='wakeup'):
+    """Poke the background daemon so that it checks the condor queue, submits any pending jobs and updates the task status straight away.
+    Never raises - if the daemon isn't listening, it will pick up the change on its next poll anyway
+    """
+    try:
+        wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            wakeup_socket.sendto(str(reason), (WAKEUP_ADDRESS, get_wakeup_port()))
+        finally:
+            wakeup_socket.close()
+    except Exception, e:
+        log.debug('Could not wake up the background daemon: %s' % str(e))
+
+class WakeupListener(object):
+    """Listens for wakeup datagrams sent with send_wakeup()
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((WAKEUP_ADDRESS, get_wakeup_port()))
+        self.socket.setblocking(0)
+
+    def wait(self, timeout):
+        """Wait for up to timeout seconds for a wakeup. Returns a list of the reasons received, or [] if we timed out
+        """
+        try:
+            readable, writable, exceptional = select.select([self.socket], [], [], max(timeout, 0))
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        if not readable:
+            return []
+
+        #Drain any other wakeups that have queued up in the meantime
+        reasons = []
+        while True:
+            try:
+                data, address = self.socket.recvfrom(1024)
+                reasons.append(data)
+            except socket.error:
+                break
+        return reasons
+
+    def close(self):
+        self.socket.close()
@@ -45,6 +45,12 @@ queue ${n}\n"""
 
 raw_condor_job_string = condor_string_header + condor_string_args + condor_string_body
 
+#For jobs whose saved model isn't needed, i.e. only the report output is used
+condor_string_args_no_save = condor_string_args.replace(' --save run_${copasiFile}', '')
+condor_string_body_no_save = condor_string_body.replace('run_${copasiFile}, ', '')
+
+raw_condor_job_string_no_save = condor_string_header + condor_string_args_no_save + condor_string_body_no_save
+
 raw_mode_string = condor_string_header + condor_string_no_args + condor_string_body
 
 #This spec is used for the stochastic simulation results processing task
@@ -94,3 +100,36 @@ should_transfer_files = YES
 when_to_transfer_output = ON_EXIT
 transfer_output_files = ${output_files}
 queue\n"""
+
+#Wrapper used when the models for a set of jobs are fanned out from a single base model on the execute node
+#The first argument is the process number. The line of the overrides file for the process lists the
+#KEY=value pairs substituted for the @KEY@ placeholders in the base model
+fan_out_wrapper_string = """#!/bin/sh
+#Create the COPASI model for this process from the base model, then run COPASI
+PROCESS=$$1
+shift
+SUBSTITUTIONS="-e s/@PROCESS@/$$PROCESS/g"
+for OVERRIDE in `sed -n "$$((PROCESS + 1))p" ${overrides_file}`; do
+    SUBSTITUTIONS="$$SUBSTITUTIONS -e s/@$${OVERRIDE%%=*}@/$${OVERRIDE#*=}/g"
+done
+sed $$SUBSTITUTIONS ${base_file} > ${model_file} || exit 1
+exec ${executable} "$$@"
+"""
+
+#Wrapper used when job input and output files are compressed for transfer
+#The first argument is the process number. The compressed inputs are decompressed before running
+#the job, and the outputs are compressed afterwards, ready to be transferred back
+compression_wrapper_string = """#!/bin/sh
+#Decompress the input files, run the job, then compress the output files
+PROCESS=$$1
+shift
+for FILE in ${input_files}; do
+    gunzip -c "$$FILE.gz" > "$$FILE" || exit 1
+done
+${prepare_executable}${executable} "$$@"
+STATUS=$$?
+for FILE in ${output_files}; do
+    if [ -f "$$FILE" ]; then gzip -f "$$FILE"; fi
+done
+exit $$STATUS
+"""
@@ -8,9 +8,11 @@
 
 #Adapted from Condor-COPSAI
 #code.google.com/p/condor-copasi
-import subprocess, os, re, math, time
+import subprocess, os, re, math, time, functools, inspect, json, io, uuid, multiprocessing
 from cloud_copasi import settings
 from cloud_copasi.condor import condor_spec
+from cloud_copasi.copasi import model_cache
+from django.db import connections
 from lxml import etree
 from string import Template
 xmlns = '{http://www.copasi.org/static/schema}'
@@ -26,6 +28,13 @@ when_to_transfer_output = ON_EXIT
 queue\n"""
 
 
+def get_condor_job_template(save_model=True):
+    """Return the template for the condor job spec. If save_model is False, COPASI isn't asked to save the model
+    after running, and no run_ model is transferred back"""
+    if save_model:
+        return condor_spec.raw_condor_job_string
+    return condor_spec.raw_condor_job_string_no_save
+
 def get_time_per_job(job):
     #For benchmarking purposes, jobs with a name ending with ?t=0.5 will use the custom t for load balancing
     name_re = re.compile(r'.*t=(?P<t>.*)')
@@ -36,6 +45,156 @@ def get_time_per_job(job):
         return settings.IDEAL_JOB_TIME
     
 
+def reads_model(method):
+    """Decorator for CopasiModel methods that only read the model. These use the shared tree from the model cache,
+    rather than making a private copy of it"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._read_only_depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._read_only_depth -= 1
+    return wrapper
+
+def uses_metadata(method):
+    """Decorator for CopasiModel getters whose results are precomputed in the model's metadata file (see write_metadata).
+    The result is read from the metadata file if there is an up to date one, rather than from the model"""
+    arg_names = inspect.getargspec(method).args[1:]
+    defaults = inspect.getargspec(method).defaults or ()
+    defaults = dict(zip(arg_names[len(arg_names) - len(defaults):], defaults))
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        values = list(args) + [kwargs.get(name, defaults.get(name)) for name in arg_names[len(args):]]
+        key = '%s(%s)' % (method.__name__, ','.join([str(value) for value in values]))
+        metadata = self._get_metadata()
+        if metadata != None and key in metadata:
+            return _from_json(metadata[key])
+        return method(self, *args, **kwargs)
+    wrapper.metadata_key = lambda *values: '%s(%s)' % (method.__name__, ','.join([str(value) for value in values]))
+    return wrapper
+
+def _from_json(value):
+    """Convert a value read from a metadata file back to the types returned by the getters:
+    ASCII strings to str (as returned by lxml), and lists of lists to lists of tuples"""
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    elif isinstance(value, list):
+        return [tuple([_from_json(item) for item in element]) if isinstance(element, list) else _from_json(element) for element in value]
+    return value
+
+#The getters stored in the metadata file, and the arguments to store them for
+METADATA_GETTERS = [('get_name', ()),
+                    ('get_variables', (False,)),
+                    ('get_variables', (True,)),
+                    ('get_sensitivities_object', (True,)),
+                    ('get_sensitivities_object', (False,)),
+                    ('get_optimization_parameters', (True,)),
+                    ('get_optimization_parameters', (False,)),
+                    ('get_parameter_estimation_parameters', (True,)),
+                    ('get_parameter_estimation_parameters', (False,)),
+                    ]
+
+#Values that can be spliced into a serialised model as they are, without escaping
+splice_safe_re = re.compile(r'^[A-Za-z0-9_.+\-]*$')
+
+#The serialised model template used by the worker processes writing model variants
+_splice_template = None
+
+def _init_splice_worker(literals, names):
+    global _splice_template
+    _splice_template = (literals, names)
+
+def _write_spliced_models(jobs, template=None):
+    """Write the model for each (filename, values) in jobs, by splicing the values into the serialised model template,
+    given as (literal parts, placeholder names). Each file is written to a temporary file, then renamed into place
+    """
+    literals, names = template or _splice_template
+    for filename, values in jobs:
+        output = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            output.append(values[name])
+            output.append(literal)
+        model_file = open(filename + '.tmp', 'wb')
+        model_file.write(''.join(output))
+        model_file.close()
+        os.rename(filename + '.tmp', filename)
+
+#The base model of a subtask whose job models were written in fan-out mode (see CopasiModel._write_job_models)
+fan_out_base_re = re.compile(r'^auto_copasi_(?P<subtask_index>\d+)\.base\.cps$')
+
+def expand_fan_out_models(directory):
+    """Write the model file of each job of any subtasks in directory whose job models were written in fan-out mode,
+    in the same way the fan-out wrapper script creates them on the execute node. Existing files are left as they are
+    """
+    for name in os.listdir(directory):
+        match = fan_out_base_re.match(name)
+        if not match:
+            continue
+        subtask_index = int(match.group('subtask_index'))
+        overrides_path = os.path.join(directory, 'auto_copasi_%d.overrides' % subtask_index)
+        if not os.path.isfile(overrides_path):
+            continue
+        base_file = open(os.path.join(directory, name), 'rb')
+        base_model = base_file.read()
+        base_file.close()
+        overrides_file = open(overrides_path, 'r')
+        overrides = overrides_file.readlines()
+        overrides_file.close()
+        
+        jobs = []
+        for process, line in enumerate(overrides):
+            filename = os.path.join(directory, 'auto_copasi_%d.%d.cps' % (subtask_index, process))
+            if os.path.isfile(filename):
+                continue
+            values = dict([override.split('=', 1) for override in line.split()])
+            values['PROCESS'] = str(process)
+            jobs.append((filename, values))
+        if len(jobs) == 0:
+            continue
+        #Only the placeholders the wrapper script substitutes, @PROCESS@ and @KEY@ for each KEY in the overrides
+        keys = sorted(jobs[0][1].keys())
+        parts = re.split('@(%s)@' % '|'.join(keys), base_model)
+        _write_spliced_models(jobs, (parts[0::2], parts[1::2]))
+
+#Parts of object CNs, for constructing user-friendly names
+values_cn_re = re.compile(r'.*Vector=Values\[(?P<name>.*)\].*')
+parameter_cn_re = re.compile(r'.*Vector=Reactions\[(?P<reaction>.*)\].*Parameter=(?P<parameter>.*),Reference=Value.*')
+metabolites_cn_re = re.compile(r'.*Vector=Metabolites\[(?P<name>.*)\].*')
+
+def get_friendly_optimization_name(name):
+    """Return a user-friendly name for the CN of an optimization parameter"""
+    #Look for a match for global parameters: Vector=Values[Test parameter],
+    values_match = values_cn_re.match(name)
+    if values_match:
+        return 'Values[' + values_match.group('name') + ']'
+    #else check for a parameter match.
+    #Vector=Reactions[Reaction] Parameter=k1
+    parameter_match = parameter_cn_re.match(name)
+    if parameter_match:
+        return '(%s).%s'%(parameter_match.group('reaction'), parameter_match.group('parameter'))
+    #Try again, this time looking for a string like: Vector=Metabolites[blah]
+    metabolites_match = metabolites_cn_re.match(name)
+    if metabolites_match:
+        return 'Metabolites[' + metabolites_match.group('name') + ']'
+    return name
+
+def get_friendly_fitting_name(name):
+    """Return a user-friendly name for the CN of a parameter estimation parameter"""
+    #Look for a match for global parameters: Vector=Values[Test parameter],
+    global_match = values_cn_re.match(name)
+    if global_match:
+        name = global_match.group('name')
+    #else check for a local match.
+    #Vector=Reactions[Reaction] Parameter=k1
+    local_match = parameter_cn_re.match(name)
+    if local_match:
+        name = '(%s).%s'%(local_match.group('reaction'), local_match.group('parameter'))
+    return name
+
 class CopasiModel(object):
     """Class representing a Copasi model"""
     def __init__(self, filename, binary=settings.COPASI_LOCAL_BINARY, binary_dir=None, job=None):
@@ -43,24 +202,234 @@ class CopasiModel(object):
         if binary_dir == None:
             binary_dir, binary_path = os.path.split(settings.COPASI_LOCAL_BINARY)
         
-        #Load the copasi binary
-        self.model = etree.parse(filename)
         self.binary = binary
         self.binary_dir = binary_dir
         self.name = filename
         (head, tail) = os.path.split(filename)
         self.path = head
         self.job=job
+        
+        self._model = None
+        self._read_only_depth = 0
+        #Lookup indexes of elements of the model, built on first use (see _get_index)
+        self._indexes = {}
+        self._indexed_model = None
+        #If there is an up to date metadata file, the model is only loaded once it's needed
+        self._metadata = self._read_metadata()
+        #The parsed model is shared with other instances through the model cache until it's modified (see model)
+        self._shared_model = None
+        if self._metadata == None:
+            self._shared_model = model_cache.get_tree(filename)
+    
+    @property
+    def model(self):
+        """The XML tree of the model. Outside of methods marked with reads_model, a private copy of the cached tree
+        is made on first use, so that it can be changed"""
+        if self._model == None:
+            if self._shared_model == None:
+                self._shared_model = model_cache.get_tree(self.name)
+            if self._read_only_depth > 0:
+                return self._shared_model
+            self._model = model_cache.copy_tree(self._shared_model)
+        return self._model
+    
+    @model.setter
+    def model(self, tree):
+        self._model = tree
+    
+    def _get_metadata_filename(self):
+        return os.path.splitext(self.name)[0] + '.metadata.json'
+    
+    def _get_file_key(self):
+        #Identifies the version of the model file the metadata was written for
+        stat = os.stat(self.name)
+        return [stat.st_mtime, stat.st_size]
+    
+    def _read_metadata(self):
+        """Return the contents of the model's metadata file, or None if there isn't one for the current model file"""
+        try:
+            metadata_file = open(self._get_metadata_filename(), 'r')
+        except IOError:
+            return None
+        try:
+            metadata = json.load(metadata_file)
+        except ValueError:
+            return None
+        finally:
+            metadata_file.close()
+        if metadata.get('model_file') != self._get_file_key():
+            return None
+        return metadata
+    
+    def _get_metadata(self):
+        #The metadata no longer applies once the model has been changed
+        if self._model != None:
+            return None
+        return self._metadata
+    
+    def write_metadata(self):
+        """Precompute the details of the model shown on the results pages (see METADATA_GETTERS),
+        and write them to the model's metadata file
+        """
+        metadata = {'model_file': self._get_file_key()}
+        for getter, args in METADATA_GETTERS:
+            method = getattr(self, getter)
+            try:
+                metadata[method.metadata_key(*args)] = method(*args)
+            except Exception:
+                #e.g. the task isn't set up in the model. Leave the getter to raise the error if it's used
+                pass
+        
+        metadata_filename = self._get_metadata_filename()
+        metadata_file = open(metadata_filename + '.tmp', 'w')
+        json.dump(metadata, metadata_file)
+        metadata_file.close()
+        os.rename(metadata_filename + '.tmp', metadata_filename)
+        self._metadata = metadata
+    
     def __unicode__(self):
         return self.name
     def __string__(self):
         return self.name
         
+    @reads_model
     def write(self, filename):
         """Write the contents of the model to the specified filename, preserving xml declaration"""
         
         return self.model.write(filename,xml_declaration=True, encoding='utf-8')
+    
+    def _get_fan_out_filenames(self, subtask_index):
+        """Return the filenames of the base model, per-process overrides and wrapper script used in fan-out mode"""
+        return ('auto_copasi_%d.base.cps' % subtask_index, 'auto_copasi_%d.overrides' % subtask_index, 'auto_fan_out_%d.sh' % subtask_index)
+    
+    def _write_job_models(self, subtask_index, job_values, set_values):
+        """Write the model files for a set of jobs that differ only in a few values, e.g. the report target or number of repeats.
+        job_values is a list containing a dict of values for each job, and set_values(process, values) sets them in the model.
+        
+        If settings.COPASI_JOB_FAN_OUT is set, only a single base model is written, with placeholders in place of the values,
+        together with a file listing the values for each process. The model for each job is created from these on the execute
+        node by a wrapper script (see _fan_out_condor_job). Values must not contain whitespace.
         
+        In fan-out mode, the base model is the same for every job, so it is staged once per pool like other shared inputs
+        if settings.SHARED_INPUT_STAGING is set. The job models can be written on the server with expand_fan_out_models.
+        
+        Returns the list of model filenames used by the jobs, relative to the task directory
+        """
+        model_files = ['auto_copasi_%d.%d.cps' % (subtask_index, i) for i in range(len(job_values))]
+        base_filename, overrides_filename, wrapper_filename = self._get_fan_out_filenames(subtask_index)
+        
+        if getattr(settings, 'COPASI_JOB_FAN_OUT', False) and len(job_values) > 1:
+            keys = sorted(job_values[0].keys())
+            set_values('@PROCESS@', dict([(key, '@%s@' % key.upper()) for key in keys]))
+            self.write(os.path.join(self.path, base_filename))
+            
+            overrides_file = open(os.path.join(self.path, overrides_filename), 'w')
+            for values in job_values:
+                overrides_file.write(' '.join(['%s=%s' % (key.upper(), values[key]) for key in keys]) + '\n')
+            overrides_file.close()
+        else:
+            self._write_model_variants([(os.path.join(self.path, model_files[i]), str(i), values) for i, values in enumerate(job_values)], set_values)
+            #Make sure a base model left over from a previous preparation isn't used
+            if os.path.isfile(os.path.join(self.path, base_filename)):
+                os.remove(os.path.join(self.path, base_filename))
+        
+        return model_files
+    
+    def _write_model_variants(self, jobs, set_values):
+        """Write a model file for each job in jobs, a list of (filename, process, values), where set_values(process, values)
+        sets the job's values in the model.
+        Rather than serialising the whole model for each job, the model is serialised once with placeholders in place of the
+        values, and the values for each job are spliced into the serialised model. The files are identical to those written
+        by setting the values and calling write(). Values containing characters that would need escaping are written with write().
+        With settings.COPASI_JOB_WRITER_PROCESSES > 1, large numbers of files are written by a pool of worker processes.
+        Every file is written atomically.
+        
+        The workers are forked from the preparing process, which is usually threaded: a daemon preparation thread, or a web
+        server worker for the first subtask of a task. Only the calling thread is copied into the workers, and they only write
+        files, so they don't touch any locks or state of the other threads. The database connections of the calling thread are
+        closed before forking, so that they aren't shared with the workers; Django reopens them when they're next used.
+        This must not be called inside a database transaction
+        """
+        if len(jobs) == 0:
+            return
+        #Placeholders that can't already be in the model
+        token = uuid.uuid4().hex
+        keys = sorted(jobs[0][2].keys())
+        placeholders = dict([(key, '@%s_%s@' % (token, key.upper())) for key in keys])
+        set_values('@%s_PROCESS@' % token, placeholders)
+        
+        model_buffer = io.BytesIO()
+        self.model.write(model_buffer, xml_declaration=True, encoding='utf-8')
+        #The parts of the serialised model between the placeholders, and the names of the placeholders
+        parts = re.split('@%s_([A-Z0-9_]+)@' % token, model_buffer.getvalue())
+        model_buffer.close()
+        literals = parts[0::2]
+        names = parts[1::2]
+        
+        spliced_jobs = []
+        for filename, process, values in jobs:
+            spliced_values = dict([(key.upper(), str(value)) for key, value in values.items()])
+            spliced_values['PROCESS'] = str(process)
+            if any([not splice_safe_re.match(value) for value in spliced_values.values()]):
+                set_values(process, values)
+                self.write(filename + '.tmp')
+                os.rename(filename + '.tmp', filename)
+            else:
+                spliced_jobs.append((filename, spliced_values))
+        
+        processes = getattr(settings, 'COPASI_JOB_WRITER_PROCESSES', 1)
+        if processes > 1 and len(spliced_jobs) >= getattr(settings, 'COPASI_JOB_WRITER_MIN_JOBS', 500):
+            #Give each worker a contiguous slice of the jobs. The template is passed to the workers when they're started
+            chunk_size = int(math.ceil(float(len(spliced_jobs)) / processes))
+            chunks = [spliced_jobs[i:i + chunk_size] for i in range(0, len(spliced_jobs), chunk_size)]
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(len(chunks), initializer=_init_splice_worker, initargs=(literals, names))
+            try:
+                pool.map(_write_spliced_models, chunks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            _write_spliced_models(spliced_jobs, (literals, names))
+        
+        #Leave the model as it would be after writing the last job
+        set_values(jobs[-1][1], jobs[-1][2])
+    
+    def _fan_out_condor_job(self, condor_job_string, subtask_index):
+        """If the jobs for subtask_index were written in fan-out mode, rewrite the condor job string to run the wrapper script,
+        which creates the model for each process from the base model before running COPASI
+        """
+        base_filename, overrides_filename, wrapper_filename = self._get_fan_out_filenames(subtask_index)
+        if not os.path.isfile(os.path.join(self.path, base_filename)):
+            return condor_job_string
+        
+        copasi_file = 'auto_copasi_%d.$(Process).cps' % subtask_index
+        executable = re.search(r'^executable\s*=\s*(\S+)\s*$', condor_job_string, re.MULTILINE).group(1)
+        transfer_executable = re.search(r'^transfer_executable\s*=\s*(\S+)\s*$', condor_job_string, re.MULTILINE).group(1).upper() == 'YES'
+        
+        input_files = [base_filename, overrides_filename]
+        if transfer_executable:
+            input_files.append(executable)
+            executable = './' + os.path.basename(executable)
+        
+        wrapper_file = open(os.path.join(self.path, wrapper_filename), 'w')
+        wrapper_file.write(Template(condor_spec.fan_out_wrapper_string).substitute(base_file=base_filename,
+                                                                                    overrides_file=overrides_filename,
+                                                                                    model_file='auto_copasi_%d.$PROCESS.cps' % subtask_index,
+                                                                                    executable=executable,
+                                                                                    ))
+        wrapper_file.close()
+        os.chmod(os.path.join(self.path, wrapper_filename), 0755)
+        
+        condor_job_string = re.sub(r'(?m)^executable\s*=.*$', 'executable = ' + wrapper_filename, condor_job_string, count=1)
+        condor_job_string = re.sub(r'(?m)^transfer_executable\s*=.*$', 'transfer_executable = YES', condor_job_string, count=1)
+        condor_job_string = re.sub(r'(?m)^arguments\s*=\s*', 'arguments = $(Process) ', condor_job_string, count=1)
+        condor_job_string = condor_job_string.replace('transfer_input_files = ' + copasi_file, 'transfer_input_files = ' + ', '.join(input_files), 1)
+        return condor_job_string
+        
+    @reads_model
     def is_valid(self, job_type):
         """Check if the model has been correctly set up for a particular condor-copasi task"""
         #Check the version is correct
@@ -136,38 +505,52 @@ class CopasiModel(object):
         return returncode, stdout, stderr
         
    
+    @reads_model
     def _getVersionMajor(self):
         """Get the major version of COPASI used to generate the model"""
         return int(self.model.getroot().attrib['versionMajor'])
    
+    @reads_model
     def _getVersionMinor(self):
         """Get the minor version of COPASI used to generate the model"""
         return int(self.model.getroot().attrib['versionMinor'])
    
+    @reads_model
     def _getVersionDevel(self):
         """Get the version of COPASI used to generate the model"""
         return int(self.model.getroot().attrib['versionDevel'])
    
+    def _get_index(self, index_name, build_index):
+        """Return the named index of elements in the model, building it with build_index(model) on first use.
+        Indexes are kept for the current tree only, so are rebuilt for a private copy of the model (see model)"""
+        model = self.model
+        if self._indexed_model is not model:
+            self._indexes = {}
+            self._indexed_model = model
+        if index_name not in self._indexes:
+            self._indexes[index_name] = build_index(model)
+        return self._indexes[index_name]
+    
+    def _invalidate_index(self, index_name):
+        """Call after adding or removing elements of the model covered by the index"""
+        self._indexes.pop(index_name, None)
+    
     def _getTask(self,task_type, model=None):
         """Get the XML tree representing a task with type: 'type'"""
-        if model == None:
-            model = self.model
-        #Get the task list
-        try:
-            listOfTasks = model.find(xmlns + 'ListOfTasks')
-            assert listOfTasks != None
-        except:
-            raise
-        #Find the appropriate task
-        try:
-            for task in listOfTasks:
-                if (task.attrib['type'] == task_type):
-                    foundTask = task
-                    break
-            assert foundTask != None
-        except:
-            raise
+        if model != None:
+            return self._build_task_index(model)[task_type]
+        foundTask = self._get_index('tasks', self._build_task_index).get(task_type)
+        assert foundTask != None
         return foundTask
+    
+    def _build_task_index(self, model):
+        #Task type -> task. If there's more than one task of a type, the first is used
+        listOfTasks = model.find(xmlns + 'ListOfTasks')
+        assert listOfTasks != None
+        tasks = {}
+        for task in listOfTasks:
+            tasks.setdefault(task.attrib.get('type'), task)
+        return tasks
 
     def _clear_tasks(self):
         """Go through the task list, and set all tasks as not scheduled to run"""
@@ -177,34 +560,58 @@ class CopasiModel(object):
         for task in listOfTasks:
             task.attrib['scheduled'] = 'false'
     
+    @reads_model
     def _get_compartment_name(self, key):
-        """Go through the list of compartments and return the name of the compartment with a given key"""
-        model = self.model.find(xmlns + 'Model')
-        compartments = model.find(xmlns + 'ListOfCompartments')
-        for compartment in compartments:
-            if compartment.attrib['key'] == key:
-                name = compartment.attrib['name']
-                break
+        """Return the name of the compartment with a given key"""
+        def build_index(model):
+            compartments = model.find(xmlns + 'Model').find(xmlns + 'ListOfCompartments')
+            names = {}
+            for compartment in compartments:
+                names.setdefault(compartment.attrib['key'], compartment.attrib['name'])
+            return names
+        name = self._get_index('compartments', build_index).get(key)
         assert name != None
         return name
     
+    def _get_report(self, key):
+        """Return the report with a given key, or None if there isn't one"""
+        def build_index(model):
+            reports = {}
+            for report in model.find(xmlns + 'ListOfReports'):
+                reports[report.attrib['key']] = report
+            return reports
+        return self._get_index('reports', build_index).get(key)
+    
+    def _get_friendly_name(self, cn, get_name):
+        """Return get_name(cn), a user friendly version of an object CN, computing it only once for each CN"""
+        friendly_names = self._get_index('friendly_names', lambda model: {})
+        if (get_name, cn) not in friendly_names:
+            friendly_names[(get_name, cn)] = get_name(cn)
+        return friendly_names[(get_name, cn)]
+    
+    @reads_model
+    @uses_metadata
     def get_name(self):
         """Returns the name of the model"""
         modelTree = self.model.find(xmlns + 'Model')
         return modelTree.attrib['name']
 
+    @reads_model
     def get_timecourse_method(self):
         """Returns the algorithm set for the time course task"""
         timeTask = self._getTask('timeCourse')
         timeMethod = timeTask.find(xmlns + 'Method')
         return timeMethod.attrib['name']
 
+    @reads_model
     def get_optimization_method(self):
         """Returns the algorithm set for the optimization task"""
         optTask = self._getTask('optimization')
         optMethod = optTask.find(xmlns + 'Method')
         return optMethod.attrib['name']
 
+    @reads_model
+    @uses_metadata
     def get_sensitivities_object(self, friendly=True):
         """Returns the single object set for the sensitvities task"""
         sensTask = self._getTask('sensitivities')
@@ -223,6 +630,7 @@ class CopasiModel(object):
                 value_string = search.group('name')
         return value_string
       
+    @reads_model
     def _get_optimization_object(self):
         """Returns the objective expression for the optimization task"""
         optTask = self._getTask('optimization')
@@ -231,6 +639,8 @@ class CopasiModel(object):
         return parameterText.text.strip()
       
             
+    @reads_model
+    @uses_metadata
     def get_optimization_parameters(self, friendly=True):
         """Returns a list of the parameter names to be included in the sensitvitiy optimization task. Will optionally process names to make them more user friendly"""
         #Get the sensitivities task:
@@ -259,39 +669,14 @@ class CopasiModel(object):
             assert startValue != None
               
             if friendly:
-                #Construct a user-friendly name for the parameter name using regexs
-                #Look for a match for global parameters: Vector=Values[Test parameter],
-                values_string = r'.*Vector=Values\[(?P<name>.*)\].*'
-                values_string_re = re.compile(values_string)
-                values_match = re.match(values_string_re, name)
-                
-                if values_match:
-                    name = 'Values[' + values_match.group('name') + ']'
-                
-                else:
-                    #else check for a parameter match.
-                    #Vector=Reactions[Reaction] Parameter=k1
-                    parameter_string = r'.*Vector=Reactions\[(?P<reaction>.*)\].*Parameter=(?P<parameter>.*),Reference=Value.*'
-                    parameter_string_re = re.compile(parameter_string)
-                    parameter_match = re.match(parameter_string_re, name)
-                    
-                    if parameter_match:
-                        reaction = parameter_match.group('reaction')
-                        parameter = parameter_match.group('parameter')
-                        name = '(%s).%s'%(reaction, parameter)
-                        
-                    else:
-                        #Try again, this time looking for a string like: Vector=Metabolites[blah]
-                        metabolites_string = r'.*Vector=Metabolites\[(?P<name>.*)\].*'
-                        metabolites_string_re = re.compile(metabolites_string)
-                        metabolites_match = re.match(metabolites_string_re, name)
-                        if metabolites_match:
-                            name = 'Metabolites[' + metabolites_match.group('name') + ']'
+                name = self._get_friendly_name(name, get_friendly_optimization_name)
 
             parameters.append((name, lowerBound, upperBound, startValue))
 
         return parameters
     
+    @reads_model
+    @uses_metadata
     def get_parameter_estimation_parameters(self, friendly=True):
         """Returns a list of the parameter names to be included in the parameter estimation task. Will optionally process names to make them more user friendly"""
         #Get the sensitivities task:
@@ -320,30 +705,13 @@ class CopasiModel(object):
             assert startValue != None
               
             if friendly:
-                #Construct a user-friendly name for the parameter name using regexs
-                #Look for a match for global parameters: Vector=Values[Test parameter],
-                global_string = r'.*Vector=Values\[(?P<name>.*)\].*'
-                global_string_re = re.compile(global_string)
-                global_match = re.match(global_string_re, name)
-                
-                if global_match:
-                    name = global_match.group('name')
-                
-                #else check for a local match.
-                #Vector=Reactions[Reaction] Parameter=k1
-                local_string = r'.*Vector=Reactions\[(?P<reaction>.*)\].*Parameter=(?P<parameter>.*),Reference=Value.*'
-                local_string_re = re.compile(local_string)
-                local_match = re.match(local_string_re, name)
-                
-                if local_match:
-                    reaction = local_match.group('reaction')
-                    parameter = local_match.group('parameter')
-                    name = '(%s).%s'%(reaction, parameter)
+                name = self._get_friendly_name(name, get_friendly_fitting_name)
 
             parameters.append((name, lowerBound, upperBound, startValue))
 
         return parameters
     
+    @reads_model
     def get_ps_number(self):
         """Returns the number of runs set up for the parameter scan task"""
         scanTask = self._getTask('scan')
@@ -389,12 +757,11 @@ class CopasiModel(object):
         listOfReports = self.model.find(xmlns + 'ListOfReports')
         
         #Check a report with the current key doesn't already exist. If it does, delete it
-        foundReport = False
-        for report in listOfReports:
-            if report.attrib['key'] == report_key:
-                foundReport = report
-        if foundReport:
+        foundReport = self._get_report(report_key)
+        if foundReport != None:
             listOfReports.remove(foundReport)
+        #The reports are about to change
+        self._invalidate_index('reports')
 
         #Next, look through and check to see if a report with the report_name already exists. If it does, delete it
         
@@ -669,7 +1036,7 @@ class CopasiModel(object):
             
         return file_list
         
-    def prepare_so_condor_job(self, pool_type, pool_address, subtask_index=1, rank='0', extraArgs=''):
+    def prepare_so_condor_job(self, pool_type, pool_address, subtask_index=1, rank='0', extraArgs='', save_model=True):
         """Prepare the neccessary .job file to submit to condor for the sensitivity optimization task"""
         #New: only prepares a single job which allows multiple jobs to be queued
         #We must change the ownership of each of the copasi files to the user running this script
@@ -704,7 +1071,7 @@ class CopasiModel(object):
             transfer_executable = 'YES'
         
         
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles='',
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -913,29 +1280,32 @@ class CopasiModel(object):
 
         runs_left=runs # Decrease this value as we generate the jobs
         
-        model_files = []
+        job_values = []
         
         for i in range(no_of_jobs):
             #Calculate the number of runs per job. This will either be repeats_per_job, or if this is the last job, runs_left
             
             no_of_steps = min(repeats_per_job, runs_left)
-            p1.attrib['value'] = str(no_of_steps)
             runs_left -= no_of_steps
+            job_values.append({'repeats': str(no_of_steps)})
             
-            report.set('target', 'output_%d.%d.txt' % (subtask_index, i))
-            filename = os.path.join(self.path, 'auto_copasi_%d.%d.cps' % (subtask_index, i))
-            self.write(filename)
-            model_files.append(filename)
-            
-            #Also, write a file called filename.runs.txt containing the number of runs per job
-            runs_file = open(filename + '.runs.txt', 'w')
-            runs_file.write('Repeats per job:\n')
-            runs_file.write(str(no_of_steps))
-            runs_file.close()
+        def set_values(process, values):
+            p1.attrib['value'] = values['repeats']
+            report.set('target', 'output_%d.%s.txt' % (subtask_index, process))
+        
+        model_files = [os.path.join(self.path, filename) for filename in self._write_job_models(subtask_index, job_values, set_values)]
+        
+        if not os.path.isfile(os.path.join(self.path, self._get_fan_out_filenames(subtask_index)[0])):
+            for filename, values in zip(model_files, job_values):
+                #Also, write a file called filename.runs.txt containing the number of runs per job
+                runs_file = open(filename + '.runs.txt', 'w')
+                runs_file.write('Repeats per job:\n')
+                runs_file.write(values['repeats'])
+                runs_file.close()
             
         return model_files
             
-    def prepare_ss_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs=''):
+    def prepare_ss_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs='', save_model=True):
         """Prepare the neccessary .job file to submit to condor for the sensitivity optimization task"""
         #New: only prepares a single job which allows multiple jobs to be queued
         #We must change the ownership of each of the copasi files to the user running this script
@@ -970,7 +1340,7 @@ class CopasiModel(object):
             transfer_executable = 'YES'
         
         
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles='',
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -982,6 +1352,7 @@ class CopasiModel(object):
                                                                                    outputFile = output_file,
                                                                                    extraArgs='',
                                                                                    )
+        condor_job_string = self._fan_out_condor_job(condor_job_string, subtask_index)
         
         condor_job_filename = 'auto_condor_%d.job'%subtask_index
         condor_job_full_filename = os.path.join(self.path, condor_job_filename)
@@ -1025,6 +1396,8 @@ class CopasiModel(object):
         
         return job_filename
         
+    @reads_model
+    @uses_metadata
     def get_variables(self, pretty=False):
         """Returns a list of all variable metabolites, compartments and global quantities in the model.
         
@@ -1034,6 +1407,8 @@ class CopasiModel(object):
         output = []
         #Get the model XML tree
         model = self.model.find(xmlns + 'Model')
+        if not pretty:
+            model_name = self.get_name()
         #Get list of metabolites
         metabolites = model.find(xmlns + 'ListOfMetabolites')
         
@@ -1048,7 +1423,6 @@ class CopasiModel(object):
                 else:
                     #Format the metabolite string as: CN=Root,Model=modelname,Vector=Compartments[compartment],Vector=Metabolites[a],Reference=ParticleNumber
                     compartment_name = self._get_compartment_name(compartment_key)
-                    model_name = self.get_name()
                     
                     output_template = Template('CN=Root,Model=${model_name},Vector=Compartments[${compartment_name}],Vector=Metabolites[${name}],Reference=ParticleNumber')
                     
@@ -1065,7 +1439,6 @@ class CopasiModel(object):
                     output.append(name + ' (' + model.attrib['volumeUnit'] + ')')
                 else:
                     #format the compartment string as: "CN=Root,Model=Kummer calcium model,Vector=Compartments[compartment_2],Reference=Volume"
-                    model_name = self.get_name()
                     output_template = Template('CN=Root,Model=${model_name},Vector=Compartments[${name}],Reference=Volume')
                     output_string = output_template.substitute(model_name=model_name, name=name)
                     output.append(output_string)
@@ -1084,7 +1457,6 @@ class CopasiModel(object):
                     output.append(name + ' (Value)')
                 else:
                     #format as: CN=Root,Model=Kummer calcium model,Vector=Values[quantity_1],Reference=Value"
-                    model_name = self.get_name()
                     output_template = Template('CN=Root,Model=${model_name},Vector=Values[${name}],Reference=Value')
                     output_string = output_template.substitute(model_name=model_name, name=name)
                     output.append(output_string)
@@ -1198,6 +1570,9 @@ class CopasiModel(object):
         scanTask.attrib['updateModel'] = 'true'
         #First, deal with the easy case -- where the top-level item is a repeat.
 
+        #The files are written together once the values for each job are known (see _write_model_variants)
+        jobs = []
+        
         if task_type == 0:
             step_count = 0
             for i in range(no_of_jobs):
@@ -1208,12 +1583,14 @@ class CopasiModel(object):
                 step_count += steps
                 
                 if steps > 0:
-                    parameters['no_of_steps'].attrib['value'] = str(steps)
-                    report.attrib['target'] = 'output_%d.%d.txt' % (subtask_index, i)
                     filename = 'auto_copasi_%d.%d.cps' % (subtask_index, i)
-                    self.write(os.path.join(self.path, filename))
+                    jobs.append((os.path.join(self.path, filename), str(i), {'no_of_steps': str(steps)}))
                     model_files.append(filename)
             
+            def set_values(process, values):
+                parameters['no_of_steps'].attrib['value'] = values['no_of_steps']
+                report.attrib['target'] = 'output_%d.%s.txt' % (subtask_index, process)
+            
         
         
         #Then, deal with the case where we actually scan a parameter
@@ -1241,20 +1618,26 @@ class CopasiModel(object):
                 job_max_value = job_scan_range[-1]
                 job_no_of_intervals = len(job_scan_range)-1
                 
-                parameters['min'].attrib['value'] = str(job_min_value)
-                parameters['max'].attrib['value'] = str(job_max_value)
-                parameters['no_of_steps'].attrib['value'] = str(job_no_of_intervals)
-                
-                #Set the report output
-                report.attrib['target'] = 'output_%d.%d.txt' % (subtask_index, i)
-                
                 filename = 'auto_copasi_%d.%d.cps' % (subtask_index, i)
-                self.write(os.path.join(self.path, filename))
+                jobs.append((os.path.join(self.path, filename), str(i), {'min': str(job_min_value),
+                                                                         'max': str(job_max_value),
+                                                                         'no_of_steps': str(job_no_of_intervals),
+                                                                         }))
                 model_files.append(filename)
+            
+            def set_values(process, values):
+                parameters['min'].attrib['value'] = values['min']
+                parameters['max'].attrib['value'] = values['max']
+                parameters['no_of_steps'].attrib['value'] = values['no_of_steps']
+                #Set the report output
+                report.attrib['target'] = 'output_%d.%s.txt' % (subtask_index, process)
+        
+        if len(jobs) > 0:
+            self._write_model_variants(jobs, set_values)
         
         return model_files
         
-    def prepare_ps_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs=''):
+    def prepare_ps_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs='', save_model=True):
         copasi_file = 'auto_copasi_%d.$(Process).cps' % subtask_index
         output_file = 'output_%d.$(Process).txt' % subtask_index
         
@@ -1268,7 +1651,7 @@ class CopasiModel(object):
             transfer_executable = 'YES'
         
         
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles='',
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -1409,7 +1792,7 @@ class CopasiModel(object):
         ############
         
         repeat_count = 0
-        model_files = []
+        job_values = []
         
         for i in range(no_of_jobs):
             if repeats_per_job + repeat_count > repeats:
@@ -1417,18 +1800,16 @@ class CopasiModel(object):
             else:
                 no_of_repeats = repeats_per_job
             repeat_count += no_of_repeats
+            job_values.append({'repeats': str(no_of_repeats)})
             
+        def set_values(process, values):
             #Set the number of repeats for the scan task
-            p1.attrib['value'] = str(no_of_repeats)
-            report.attrib['target'] = 'output_%d.%d.txt' % (subtask_index, i)
-            
-            filename = 'auto_copasi_%d.%d.cps' % (subtask_index, i)
-            self.write(os.path.join(self.path, filename))
-            model_files.append(filename)
+            p1.attrib['value'] = values['repeats']
+            report.attrib['target'] = 'output_%d.%s.txt' % (subtask_index, process)
         
-        return model_files
+        return self._write_job_models(subtask_index, job_values, set_values)
         
-    def prepare_or_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs=''):
+    def prepare_or_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index=1, rank='0', extraArgs='', save_model=True):
         copasi_file = 'auto_copasi_%d.$(Process).cps' % subtask_index
         output_file = 'output_%d.$(Process).txt' % subtask_index
         
@@ -1442,7 +1823,7 @@ class CopasiModel(object):
             transfer_executable = 'YES'
         
         
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles='',
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -1454,6 +1835,7 @@ class CopasiModel(object):
                                                                                    outputFile = output_file,
                                                                                    extraArgs='',
                                                                                    )
+        condor_job_string = self._fan_out_condor_job(condor_job_string, subtask_index)
         
         condor_job_filename = 'auto_condor_%d.job'%subtask_index
         condor_job_full_filename = os.path.join(self.path, condor_job_filename)
@@ -1463,6 +1845,7 @@ class CopasiModel(object):
 
         return condor_job_filename
         
+    @reads_model
     def process_or_results(self, filenames):
         """Process the results of the OR task by copying them all into one file, named raw_results.txt.
         As we copy, extract the best value, and write the details to results.txt"""
@@ -1684,7 +2067,7 @@ class CopasiModel(object):
         ############
         #Prepare the Copasi files
         ############
-        model_files = []
+        job_values = []
         repeat_count = 0
         for i in range(no_of_jobs):
             if repeats_per_job + repeat_count > repeats:
@@ -1692,20 +2075,18 @@ class CopasiModel(object):
             else:
                 no_of_repeats = repeats_per_job
             repeat_count += no_of_repeats
+            job_values.append({'repeats': str(no_of_repeats)})
             
+        def set_values(process, values):
             #Set the number of repeats for the scan task
-            p1.attrib['value'] = str(no_of_repeats)
+            p1.attrib['value'] = values['repeats']
             #And the report target output
-            report.attrib['target'] = 'output_%d.%d.txt' % (subtask_index, i)
-            
-            filename = 'auto_copasi_%d.%d.cps' % (subtask_index, i)
-            self.write(os.path.join(self.path, filename))
-            model_files.append(filename)
+            report.attrib['target'] = 'output_%d.%s.txt' % (subtask_index, process)
         
-        return model_files
+        return self._write_job_models(subtask_index, job_values, set_values)
         
         
-    def prepare_pr_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index, data_files, rank='0', extraArgs=''):
+    def prepare_pr_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index, data_files, rank='0', extraArgs='', save_model=True):
         """Prepare the condor jobs for the parallel scan task"""
         ############
         copasi_file = 'auto_copasi_%d.$(Process).cps' % subtask_index
@@ -1725,7 +2106,7 @@ class CopasiModel(object):
             input_files_string += (data_file + ', ')
         input_files_string = input_files_string.rstrip(', ')
 
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles=input_files_string,
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -1737,6 +2118,7 @@ class CopasiModel(object):
                                                                                    outputFile = output_file,
                                                                                    extraArgs='',
                                                                                    )
+        condor_job_string = self._fan_out_condor_job(condor_job_string, subtask_index)
         
         condor_job_filename = 'auto_condor_%d.job'%subtask_index
         condor_job_full_filename = os.path.join(self.path, condor_job_filename)
@@ -1958,7 +2340,7 @@ class CopasiModel(object):
 
         return filename
     
-    def prepare_pr_optimal_model_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index, data_files, rank='0', extraArgs=''):
+    def prepare_pr_optimal_model_condor_job(self, pool_type, pool_address, number_of_jobs, subtask_index, data_files, rank='0', extraArgs='', save_model=True):
         """Prepare the condor jobs for the parallel scan task"""
         ############
         copasi_file = 'auto_copasi_%d.$(Process).cps' % subtask_index
@@ -1978,7 +2360,7 @@ class CopasiModel(object):
             input_files_string += (data_file + ', ')
         input_files_string = input_files_string.rstrip(', ')
 
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles=input_files_string,
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -2027,31 +2409,26 @@ class CopasiModel(object):
         
         
         task_report_targets = {} #Store the report output targets 
-        #Create a new COPASI file for each repeat
         #Keep a note of the output files we're creating
-        model_files = []
         output_files = []
-        for i in range(repeats):
+        for taskName in taskList:
+            try:
+                task = self._getTask(taskName)
+                report = task.find(xmlns + 'Report')
+                task_report_targets[taskName] = report.attrib['target']
+                if task.attrib['scheduled'] == 'true':
+                    output_files.append(task_report_targets[taskName])
+            except:
+                pass #It's possible not every task has a report set. If this is the case, ignore it!
+        
+        def set_values(process, values):
             #For each task, if the report output is set, append it with '_i'
-            for taskName in taskList:
-                try:
-                    task = self._getTask(taskName)
-                    report = task.find(xmlns + 'Report')
-                    if i==0:
-                        task_report_targets[taskName] = report.attrib['target']
-                    report.attrib['target'] = str(i) + '_' + task_report_targets[taskName]
-                    if i==0:
-                        if task.attrib['scheduled'] == 'true':
-                            output_files.append(task_report_targets[taskName])
-                    
-                except:
-                    pass #It's possible not every task has a report set. If this is the case, ignore it!
-                    
-            filename = 'auto_copasi_1.%d.cps'%i
-            target = os.path.join(self.path, filename)
-            model_files.append(filename)
-            
-            self.write(target)
+            for taskName in task_report_targets:
+                report = self._getTask(taskName).find(xmlns + 'Report')
+                report.attrib['target'] = process + '_' + task_report_targets[taskName]
+        
+        #Create a new COPASI file for each repeat
+        model_files = self._write_job_models(1, [{} for i in range(repeats)], set_values)
          
         return model_files, output_files
 
@@ -2103,6 +2480,7 @@ class CopasiModel(object):
                                                                            extraArgs='',
                                                                            rank=rank,
                                                                            )
+        condor_job_string = self._fan_out_condor_job(condor_job_string, 1)
         
         condor_job_filename = 'auto_condor_1.job'
         condor_file = open(os.path.join(self.path, condor_job_filename), 'w')
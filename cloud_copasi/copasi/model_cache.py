@@ -0,0 +1,83 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Process-wide cache of parsed COPASI models
+#Task plugins load the task's original model every time they are constructed, i.e. for every results page,
+#plot and download, and at every subtask transition in the daemon. Rather than parsing the file each time,
+#the parsed tree is kept here, indexed by the path, modification time and size of the file, so a changed
+#file is always parsed afresh. The least recently used models are dropped once the total size of the cached
+#files exceeds settings.MODEL_CACHE_FILE_SIZE. The limit is on the size of the files, not the memory used by the
+#parsed trees, which is several times larger.
+#The cached trees are shared, and must never be modified. CopasiModel only reads from them, and makes its own
+#copy of the tree before changing it (see CopasiModel.model)
+
+import os, copy, threading
+from cloud_copasi import settings
+from lxml import etree
+import logging
+
+log = logging.getLogger(__name__)
+
+def get_max_size():
+    #Total size of the cached model files in bytes
+    return getattr(settings, 'MODEL_CACHE_FILE_SIZE', 20) * 1024 * 1024
+
+#The cached trees, indexed by (path, modification time, size), most recently used last
+_cache = []
+_cache_size = 0
+_lock = threading.Lock()
+
+def _get_key(filename):
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+def get_tree(filename):
+    """Return the parsed tree of the model file, parsing it only if it isn't already cached.
+    The tree returned is shared, and must not be modified
+    """
+    global _cache_size
+    max_size = get_max_size()
+    key = _get_key(filename)
+
+    with _lock:
+        for index, (cached_key, tree) in enumerate(_cache):
+            if cached_key == key:
+                #Move to the most recently used end
+                _cache.append(_cache.pop(index))
+                return tree
+
+    tree = etree.parse(filename)
+    if key[2] > max_size:
+        return tree
+
+    with _lock:
+        #Drop any out of date copies of the file, and make room for the new one
+        for cached_key, cached_tree in list(_cache):
+            if cached_key[0] == key[0]:
+                _cache.remove((cached_key, cached_tree))
+                _cache_size -= cached_key[2]
+        while len(_cache) > 0 and _cache_size + key[2] > max_size:
+            cached_key, cached_tree = _cache.pop(0)
+            _cache_size -= cached_key[2]
+            log.debug('Dropped %s from the model cache' % cached_key[0])
+        _cache.append((key, tree))
+        _cache_size += key[2]
+    return tree
+
+def copy_tree(tree):
+    """Return a private copy of a cached tree that can be modified.
+    Comments and processing instructions before the root element are kept
+    """
+    return copy.deepcopy(tree)
+
+def clear():
+    global _cache_size
+    with _lock:
+        del _cache[:]
+        _cache_size = 0
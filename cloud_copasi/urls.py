@@ -95,6 +95,7 @@ urlpatterns = patterns('',
     url(r'^my_account/pools/$', pool_views.PoolListView.as_view(), name='pool_list'),
     url(r'^my_account/pools/add_ec2/$', pool_views.EC2PoolAddView.as_view(), name='ec2_pool_add'),
     url(r'^my_account/pools/add_existing/$', pool_views.BoscoPoolAddView.as_view(), name='bosco_pool_add'),
+    url(r'^my_account/pools/(?P<pool_id>\d+)/add_status/$', pool_views.BoscoPoolAddStatusView.as_view(), name='bosco_pool_add_status'),
 
     url(r'^my_account/pools/(?P<pool_id>\d+)/ec2/scale_up/$', pool_views.EC2PoolScaleUpView.as_view(), name='ec2_pool_scale_up'),
     url(r'^my_account/pools/(?P<pool_id>\d+)/ec2/scale_down/$', pool_views.EC2PoolScaleDownView.as_view(), name='ec2_pool_scale_down'),
@@ -36,6 +36,17 @@ def get_active_ami(ec2_connection):
 def refresh_pool(ec2_pool):
     """Refresh the state of each instance in a ec2 pool
     """
+    refresh_request = get_pool_refresh_request(ec2_pool)
+    if refresh_request == None:
+        return
+    
+    pool_status = fetch_pool_status(refresh_request)
+    apply_pool_status(refresh_request, pool_status)
+
+def get_pool_refresh_request(ec2_pool):
+    """Read everything needed from the database to refresh the pool.
+    Returns None if the pool doesn't need refreshing
+    """
     log.debug('Refreshing pool %s status' % ec2_pool.name)
 
     if ec2_pool.copy_of:
@@ -50,16 +61,28 @@ def refresh_pool(ec2_pool):
     log.debug('Time difference %s' % str(difference))
     if difference < datetime.timedelta(seconds=3):
         log.debug('Pool recently refreshed. Not updating')
-        return
-    
-    vpc_connection, ec2_connection = aws_tools.create_connections(ec2_pool.vpc.access_key)
+        return None
     
     #Get a list of any spot requests associated with the pool
-    
     spot_requests = SpotRequest.objects.filter(ec2_pool=ec2_pool) | SpotRequest.objects.filter(ec2_pool__copy_of=ec2_pool)
     
-    spot_request_ids = [request.request_id for request in spot_requests]
+    instances = EC2Instance.objects.filter(ec2_pool=ec2_pool) | EC2Instance.objects.filter(ec2_pool__copy_of=ec2_pool)
+    instances = instances.exclude(state='terminated')
+    
+    return {
+            'ec2_pool': ec2_pool,
+            'copied_pool': copied_pool,
+            'access_key': ec2_pool.vpc.access_key,
+            'spot_request_ids': [request.request_id for request in spot_requests],
+            'instance_states': dict([(instance.instance_id, instance.state) for instance in instances]),
+            }
+
+def fetch_pool_status(refresh_request):
+    """Make the EC2 API calls needed to refresh the pool. Does not touch the database, so is safe to run in a worker thread
+    """
+    vpc_connection, ec2_connection = aws_tools.create_connections(refresh_request['access_key'])
     
+    spot_request_ids = refresh_request['spot_request_ids']
     try:
         if spot_request_ids != []:
             spot_request_list = ec2_connection.get_all_spot_instance_requests(request_ids=spot_request_ids)
@@ -72,13 +95,58 @@ def refresh_pool(ec2_pool):
         for spot_request_id in spot_request_ids:
             try:
                 spot_instance_request = ec2_connection.get_all_spot_instance_requests(request_ids=[spot_request_id])
-                spot_request_list.append(spot_instance_request)
+                spot_request_list.extend(spot_instance_request)
             except:
                 log.debug('Spot request %s not found, not updating status' %spot_request_id)
                 not_found_requests.append(spot_request_id)
             #Don't do anything with spot requests that weren't found for now
     
+    #Also check the status of any instances that have just been launched by a spot request
+    instance_states = dict(refresh_request['instance_states'])
     for request in spot_request_list:
+        if request.instance_id != None and request.instance_id not in instance_states:
+            instance_states[request.instance_id] = 'unknown'
+    
+    instance_ids = instance_states.keys()
+    not_found_instances = []
+    
+    try:
+        instance_status_list = ec2_connection.get_all_instance_status(instance_ids)
+    except EC2ResponseError:
+        #Perhaps an instance wasn't found? If so we'll have to go through the list the slow way
+        instance_status_list = []
+        for instance_id in instance_ids:
+            try:
+                instance_status = ec2_connection.get_all_instance_status([instance_id])[0]
+                instance_status_list.append(instance_status)
+            except:
+                log.debug('Instance %s not found, presuming terminated' % instance_id)
+                not_found_instances.append(instance_id)
+    
+    #Find out why any instance changed state
+    state_transition_reasons = {}
+    for status in instance_status_list:
+        if instance_states.get(status.id) != status.state_name:
+            try:
+                instance_reservation = ec2_connection.get_all_instances(instance_ids=[status.id])
+                state_transition_reasons[status.id] = instance_reservation[0].instances[0].state_reason
+            except Exception, e:
+                log.exception(e)
+    
+    return {
+            'spot_request_list': spot_request_list,
+            'instance_status_list': instance_status_list,
+            'not_found_instances': not_found_instances,
+            'state_transition_reasons': state_transition_reasons,
+            }
+
+def apply_pool_status(refresh_request, pool_status):
+    """Write the results of fetch_pool_status back to the database
+    """
+    ec2_pool = refresh_request['ec2_pool']
+    copied_pool = refresh_request['copied_pool']
+    
+    for request in pool_status['spot_request_list']:
         try:
             spot_request = SpotRequest.objects.get(request_id=request.id)
             spot_request.status_code = request.status.code
@@ -107,27 +175,8 @@ def refresh_pool(ec2_pool):
         except Exception, e:
             log.exception(e)
     
-    instances = EC2Instance.objects.filter(ec2_pool=ec2_pool) | EC2Instance.objects.filter(ec2_pool__copy_of=ec2_pool)
-    
-    instances = instances.exclude(state='terminated')
-    
-    instance_ids = [instance.instance_id for instance in instances]
-    
-    try:
-        instance_status_list = ec2_connection.get_all_instance_status(instance_ids)
-    except EC2ResponseError:
-        #Perhaps an instance wasn't found? If so we'll have to go through the list the slow way
-        instance_status_list = []
-        not_found_instances = []
-        for instance_id in instance_ids:
-            try:
-                instance_status = ec2_connection.get_all_instance_status([instance_id])[0]
-                instance_status_list.append(instance_status)
-            except:
-                log.debug('Instance %s not found, presuming terminated' % instance_id)
-                not_found_instances.append(instance_id)
-        
-        for instance_id in not_found_instances:
+    for instance_id in pool_status['not_found_instances']:
+        try:
             ec2_instance = EC2Instance.objects.get(instance_id=instance_id)
             ec2_instance.state='terminated'
             ec2_instance.instance_status = 'terminated'
@@ -135,9 +184,12 @@ def refresh_pool(ec2_pool):
             ec2_instance.state_transition_reason = 'Unknown'
             
             ec2_instance.save()
+        except Exception, e:
+            log.exception(e)
     
+    instances = EC2Instance.objects.filter(ec2_pool=ec2_pool) | EC2Instance.objects.filter(ec2_pool__copy_of=ec2_pool)
     
-    for status in instance_status_list:
+    for status in pool_status['instance_status_list']:
         #assert isinstance(status, )
         log.debug('Refreshing instance %s' % status.id)
         try:
@@ -145,9 +197,8 @@ def refresh_pool(ec2_pool):
             ec2_instance = instances.get(instance_id=id)
             if ec2_instance.state!=status.state_name:
                 ec2_instance.state=status.state_name
-                ec2_instance.save()
-                instance=ec2_instance.get_instance()
-                ec2_instance.state_transition_reason=instance.state_reason
+                if id in pool_status['state_transition_reasons']:
+                    ec2_instance.state_transition_reason=pool_status['state_transition_reasons'][id]
                 
             ec2_instance.instance_status = status.instance_status.status
             ec2_instance.system_status = status.system_status.status
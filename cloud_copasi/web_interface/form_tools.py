@@ -15,20 +15,28 @@ class NameChoiceField(forms.ModelChoiceField):
     def label_from_instance(self, obj):
         return "%s" % (obj.name)
 
+def get_pool_label(obj):
+    if hasattr(obj, 'ec2pool'):
+        pool_type = 'EC2'
+    elif hasattr(obj, 'boscopool'):
+        pool_type = unicode(obj.boscopool.get_pool_type_display())
+    else:
+        pool_type = 'Unknown'
+        
+    if obj.copy_of != None:
+        return "%s (%s) (Shared)" % (obj.name, pool_type)
+    else:
+        return "%s (%s)" % (obj.name, pool_type)
+
 #Subclass the modelchoicefield so that we can just use the display name of the object
 class PoolChoiceField(forms.ModelChoiceField):
     def label_from_instance(self, obj):
-        if hasattr(obj, 'ec2pool'):
-            pool_type = 'EC2'
-        elif hasattr(obj, 'boscopool'):
-            pool_type = unicode(obj.boscopool.get_pool_type_display())
-        else:
-            pool_type = 'Unknown'
-            
-        if obj.copy_of != None:
-            return "%s (%s) (Shared)" % (obj.name, pool_type)
-        else:
-            return "%s (%s)" % (obj.name, pool_type)
+        return get_pool_label(obj)
+
+#As above, for selecting several pools
+class PoolMultipleChoiceField(forms.ModelMultipleChoiceField):
+    def label_from_instance(self, obj):
+        return get_pool_label(obj)
 
 #Generic function for saving a django UploadedFile to a destination
 def handle_uploaded_file(f,destination):
@@ -0,0 +1,31 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+from django.core.management.base import BaseCommand, CommandError
+from cloud_copasi.web_interface.pools import metrics
+import datetime
+
+class Command(BaseCommand):
+    args = '[metrics_file]'
+    help = 'Summarise the phase timings and counters recorded by the background daemon'
+
+    def handle(self, *args, **options):
+        path = args[0] if args else metrics.get_metrics_file()
+        try:
+            data = metrics.read_metrics(path)
+        except (IOError, ValueError), e:
+            raise CommandError('Could not read daemon metrics from %s: %s' % (path, str(e)))
+
+        updated = datetime.datetime.fromtimestamp(data['updated'])
+        self.stdout.write('Daemon metrics (pid %s), last updated %s' % (data.get('pid'), updated.strftime('%Y-%m-%d %H:%M:%S')))
+        self.stdout.write('%-45s %8s %10s %10s %10s %10s %10s' % ('Metric', 'Samples', 'Mean', 'p50', 'p90', 'p99', 'Max'))
+
+        for name, summary in sorted(data['metrics'].items()):
+            if summary['count'] == 0:
+                continue
+            self.stdout.write('%-45s %8d %10.3f %10.3f %10.3f %10.3f %10.3f' % (name, summary['count'], summary['mean'], summary['p50'], summary['p90'], summary['p99'], summary['max']))
@@ -0,0 +1,26 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+from django.core.management.base import BaseCommand
+from cloud_copasi.web_interface.models import Subtask
+
+class Command(BaseCommand):
+    args = '[subtask_id ...]'
+    help = 'Recompute the subtask job counters from the condor jobs. If no subtask ids are given, all subtasks are repaired'
+
+    def handle(self, *args, **options):
+        subtasks = Subtask.objects.all()
+        if args:
+            subtasks = subtasks.filter(id__in=[int(subtask_id) for subtask_id in args])
+
+        count = 0
+        for subtask in subtasks:
+            subtask.update_job_counters()
+            count += 1
+
+        self.stdout.write('Repaired job counters for %d subtasks' % count)
@@ -177,6 +177,17 @@ class CondorPool(models.Model):
                                                            ),
                                  default='condor',
                                  )
+    
+    #The result of the last bosco_cluster --test, which runs in the background
+    test_status = models.CharField(max_length=20, blank=True, default='', choices = (
+                                                                                  ('running', 'Running'),
+                                                                                  ('success', 'Success'),
+                                                                                  ('failed', 'Failed'),
+                                                                                  ))
+    test_output = models.TextField(blank=True, default='')
+    test_time = models.DateTimeField(blank=True, null=True)
+    
+    max_queued_jobs = models.PositiveIntegerField(blank=True, null=True, verbose_name='Maximum queued jobs per subtask', help_text='The maximum number of jobs of a subtask in the queue at once. Leave blank to use the server default, or 0 for no limit.')
 
     class Meta:
         #abstract = True
@@ -207,7 +218,8 @@ class CondorPool(models.Model):
 
 
     def get_running_tasks(self):
-        return Task.objects.filter(condor_pool=self).filter(status='running')
+        #Includes tasks with jobs federated to this pool from another (see pools.federation)
+        return Task.objects.filter(models.Q(condor_pool=self) | models.Q(subtask__condorjob__condor_pool=self)).filter(status='running').distinct()
     
     def get_recast_pool(self):
         if self.get_pool_type() == 'ec2':
@@ -222,6 +234,19 @@ class BoscoPool(CondorPool):
 
     status_page = models.CharField(max_length=1000, blank=True, null=True, default='')
     
+    #The result of bosco_cluster --add, which runs in the background. Blank for pools added before this was recorded
+    add_status = models.CharField(max_length=20, blank=True, default='', choices = (
+                                                                                 ('running', 'Running'),
+                                                                                 ('success', 'Success'),
+                                                                                 ('failed', 'Failed'),
+                                                                                 ))
+    add_output = models.TextField(blank=True, default='')
+    add_time = models.DateTimeField(blank=True, null=True)
+    
+    def is_added(self):
+        """Return True if the pool has been added to bosco, and can be used"""
+        return self.add_status == '' or self.add_status == 'success'
+    
     class Meta:
         app_label = 'web_interface'
     
@@ -525,10 +550,14 @@ class Task(models.Model):
         if self.job_count > 0:
             return self.job_count
         else:
-            count = 0
-            subtasks = Subtask.objects.filter(task=self) 
-            for subtask in subtasks:
-                count += subtask.get_job_count()
+            #Finished subtasks have their job count set. For the others, count the jobs from the job counters
+            subtasks = Subtask.objects.filter(task=self)
+            counts = subtasks.filter(job_count__gt=0).aggregate(job_count=models.Sum('job_count'))
+            count = counts['job_count'] or 0
+            counter_fields = Subtask.job_counter_fields.values()
+            counts = subtasks.filter(job_count__lte=0).aggregate(*[models.Sum(field) for field in counter_fields])
+            for field in counter_fields:
+                count += counts[field + '__sum'] or 0
             return count
     def set_job_count(self):
         self.job_count = self.get_job_count()
@@ -543,11 +572,11 @@ class Task(models.Model):
         if self.run_time > 0:
             return self.run_time
         else:
+            #Finished subtasks have their run time set. For the others, use the run time of their jobs so far
             subtasks = self.subtask_set.all()
-            count = 0
-            for subtask in subtasks:
-                count += subtask.get_run_time()
-            return count
+            run_time = subtasks.filter(run_time__gt=0).aggregate(run_time=models.Sum('run_time'))['run_time'] or 0.0
+            run_time += subtasks.filter(run_time__lte=0).aggregate(job_run_time=models.Sum('job_run_time'))['job_run_time'] or 0.0
+            return run_time
     def set_run_time(self):
         self.run_time = self.get_run_time()
         self.save()
@@ -630,7 +659,9 @@ class Subtask(models.Model):
     
     status_choices = (
                       ('waiting', 'Waiting'),
+                      ('preparing', 'Preparing'),
                       ('ready', 'Ready'),
+                      ('queued', 'Queued in DAG'),
                       ('running', 'Running'),
                       ('finished', 'Finished'),
                       ('error', 'Error'),
@@ -672,8 +703,7 @@ class Subtask(models.Model):
         if self.job_count > 0:
             return self.job_count
         else:
-            jobs = self.condorjob_set.all()
-            return max(jobs.count(), 0)
+            return self.get_queued_job_count()
    
     def set_job_count(self):
         self.job_count = self.get_job_count()
@@ -688,11 +718,7 @@ class Subtask(models.Model):
         if self.run_time > 0:
             return self.run_time
         else:
-            jobs = self.condorjob_set.all()
-            count = 0
-            for job in jobs:
-                count += job.run_time
-            return count
+            return self.job_run_time
     def set_run_time(self, time_delta=None):
         if not time_delta:
             self.run_time = self.get_run_time()
@@ -708,6 +734,46 @@ class Subtask(models.Model):
     start_time=models.DateTimeField(blank=True, null=True, help_text= 'The time this subtask started running')
     finish_time = models.DateTimeField(blank=True, null=True, help_text = 'The time the subtask stopped running')
     
+    #Counters for the number of condor jobs in each state. These are kept up to date by condor_tools
+    #in the same transaction as the CondorJob status changes. Use update_job_counters() to recompute them
+    idle_job_count = models.IntegerField(default=0)
+    running_job_count = models.IntegerField(default=0)
+    held_job_count = models.IntegerField(default=0)
+    finished_job_count = models.IntegerField(default=0)
+    error_job_count = models.IntegerField(default=0)
+    unsubmitted_job_count = models.IntegerField(default=0)
+    job_run_time = models.FloatField(default=0.0, help_text = 'The cumulative run time in days of the associated condor jobs so far')
+    
+    #The counter field for each CondorJob status
+    job_counter_fields = {
+                          'I': 'idle_job_count',
+                          'R': 'running_job_count',
+                          'H': 'held_job_count',
+                          'F': 'finished_job_count',
+                          'E': 'error_job_count',
+                          'N': 'unsubmitted_job_count',
+                          }
+    
+    def get_queued_job_count(self):
+        """Return the number of condor jobs currently associated, from the job counters
+        """
+        return self.idle_job_count + self.running_job_count + self.held_job_count + self.finished_job_count + self.error_job_count + self.unsubmitted_job_count
+    
+    def update_job_counters(self):
+        """Recompute the job counters from the associated condor jobs
+        """
+        for field in self.job_counter_fields.values():
+            setattr(self, field, 0)
+        self.job_run_time = 0.0
+        
+        job_statuses = self.condorjob_set.order_by().values('status').annotate(count=models.Count('id'), run_time=models.Sum('run_time'))
+        for row in job_statuses:
+            field = self.job_counter_fields.get(row['status'])
+            if field:
+                setattr(self, field, row['count'])
+            self.job_run_time += row['run_time'] or 0.0
+        self.save()
+    
     
     def __unicode__(self):
         return '%s (%d)' % (self.task.name, self.index)
@@ -743,6 +809,13 @@ class CondorJob(models.Model):
     
     #The id of the job process in the cluster. Only set once the job has been queued. 
     process_id = models.IntegerField(null=True, blank=True)
+    #If the subtask was submitted in several chunks, the condor cluster and process id the job was submitted as.
+    #Otherwise null, and the job is process process_id of the subtask's cluster
+    cluster_id = models.IntegerField(null=True, blank=True)
+    cluster_process_id = models.IntegerField(null=True, blank=True)
+    #If the task is federated across several pools, the pool the job was submitted to.
+    #Otherwise null, and the job was submitted to the task's pool
+    condor_pool = models.ForeignKey(CondorPool, null=True, blank=True, on_delete=models.SET_NULL)
     #The amount of computation time in days that the condor job took to finish. Note, this does not include any interrupted runs. Will not be set until the condor job finishes.
     run_time = models.FloatField(null=True)
     
@@ -758,6 +831,21 @@ class CondorJob(models.Model):
     def getDirectory(self):
         return os.path.dirname(self.spec_file)
     
+    def get_cluster_id(self):
+        if self.cluster_id != None:
+            return self.cluster_id
+        return self.subtask.cluster_id
+    
+    def get_cluster_process_id(self):
+        if self.cluster_process_id != None:
+            return self.cluster_process_id
+        return self.process_id
+    
+    def get_condor_pool(self):
+        if self.condor_pool != None:
+            return self.condor_pool
+        return self.subtask.task.condor_pool
+    
     class Meta:
         app_label = 'web_interface'
 
@@ -0,0 +1,132 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Runs external commands (condor_q, condor_submit, bosco_cluster etc.) with a timeout,
+#a limit on the number of concurrent commands per remote cluster, and optional short-lived
+#caching of the output of read-only queries
+
+import subprocess, threading, time, os, signal
+from cloud_copasi import settings
+from cloud_copasi.web_interface.pools import metrics
+from django.db import connection
+import logging
+
+log = logging.getLogger(__name__)
+
+#The key used for commands run against the local bosco schedd
+LOCAL_CLUSTER = 'local'
+
+def get_default_timeout():
+    return getattr(settings, 'BOSCO_COMMAND_TIMEOUT', 300)
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+def get_semaphore(cluster):
+    """Return the semaphore limiting the number of concurrent commands run against cluster
+    """
+    with _semaphores_lock:
+        semaphore = _semaphores.get(cluster)
+        if semaphore == None:
+            semaphore = _semaphores[cluster] = threading.BoundedSemaphore(getattr(settings, 'BOSCO_MAX_CONCURRENT_COMMANDS', 4))
+        return semaphore
+
+#Cached output of read-only commands, indexed by (command, cwd)
+_cache = {}
+_cache_lock = threading.Lock()
+
+def _kill(process):
+    """Kill the process and any children it has started (e.g. an ssh session started by a shell command)
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def run_command(command, env=None, cwd=None, shell=False, timeout=None, cluster=LOCAL_CLUSTER, cache_time=0):
+    """Run command and return a tuple (stdout lines, stderr lines, exit status).
+    If the command takes longer than timeout seconds it is killed, and a non-zero exit status is returned.
+    At most BOSCO_MAX_CONCURRENT_COMMANDS commands are run against a given cluster at once.
+    If cache_time > 0, the output of an identical command run within the last cache_time seconds is returned instead
+    """
+    if timeout == None:
+        timeout = get_default_timeout()
+
+    if cache_time > 0:
+        cache_key = (str(command), cwd)
+        with _cache_lock:
+            cached = _cache.get(cache_key)
+        if cached != None and time.time() - cached[0] < cache_time:
+            metrics.increment('bosco_command_cache_hits')
+            return cached[1]
+
+    semaphore = get_semaphore(cluster)
+    with semaphore:
+        start_time = time.time()
+        #Start the command in its own process group, so that all of it can be killed on a timeout
+        process = subprocess.Popen(command, shell=shell, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, preexec_fn=os.setsid)
+
+        timed_out = []
+        def on_timeout():
+            timed_out.append(True)
+            _kill(process)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+        try:
+            output = process.communicate()
+        finally:
+            timer.cancel()
+
+        command_time = time.time() - start_time
+
+    metrics.record('bosco_command_time', command_time)
+    metrics.increment('bosco_commands')
+    metrics.increment('bosco_command_time', command_time)
+
+    stdout = output[0].splitlines()
+    stderr = output[1].splitlines()
+    exit_status = process.returncode
+
+    if timed_out:
+        log.error('Command %s timed out after %d seconds' % (command, timeout))
+        metrics.increment('bosco_command_timeouts')
+        stderr.append('Command timed out after %d seconds' % timeout)
+        if exit_status == 0:
+            exit_status = -signal.SIGKILL
+        return (stdout, stderr, exit_status)
+
+    result = (stdout, stderr, exit_status)
+    if cache_time > 0 and exit_status == 0:
+        with _cache_lock:
+            _cache[cache_key] = (time.time(), result)
+    return result
+
+def clear_cache():
+    """Forget the cached output of all read-only commands, e.g. after submitting or removing jobs
+    """
+    with _cache_lock:
+        _cache.clear()
+
+def run_in_background(function, *args, **kwargs):
+    """Run function(*args, **kwargs) in a background thread, so that e.g. a web request doesn't have to wait for it.
+    Any exception raised is logged
+    """
+    def worker():
+        try:
+            function(*args, **kwargs)
+        except Exception, e:
+            log.exception(e)
+        finally:
+            #Each thread has its own database connection
+            connection.close()
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,164 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Compression of job input and output files for transfer to and from the pool
+#COPASI models and reports compress very well, so gzipping them can save most of the transfer time of short jobs.
+#The models are compressed before submission, and the spec file is rewritten to run a wrapper script which
+#decompresses them on the worker, runs the job, and compresses its outputs before they are transferred back.
+#The outputs are decompressed by the daemon as each job finishes, so the results processing is unchanged
+
+import os, re, gzip, shutil
+from string import Template
+from cloud_copasi import settings
+from cloud_copasi.condor import condor_spec
+from cloud_copasi.web_interface.pools.staging_tools import transfer_input_files_re, executable_re, transfer_executable_re
+import logging
+
+log = logging.getLogger(__name__)
+
+#Only input files with these extensions are compressed
+COMPRESSED_INPUT_EXTENSIONS = ['.cps']
+
+transfer_output_files_re = re.compile(r'^transfer_output_files\s*=(?P<files>.*)$', re.MULTILINE)
+arguments_re = re.compile(r'^arguments\s*=[ \t]*(?P<arguments>.*)$', re.MULTILINE)
+
+def is_compression_enabled():
+    return getattr(settings, 'COMPRESS_JOB_TRANSFERS', False)
+
+def _split_files(files_string):
+    return [name.strip() for name in files_string.split(',') if name.strip() != '']
+
+def _shell_filename(name):
+    """Return name double quoted for the wrapper script, with $(Process) replaced by the process number"""
+    for character in ['\\', '"', '`', '$']:
+        name = name.replace(character, '\\' + character)
+    return '"%s"' % name.replace('\\$(Process)', '${PROCESS}')
+
+def compress_file(path):
+    """Write a gzipped copy of path to path.gz"""
+    input_file = open(path, 'rb')
+    try:
+        output_file = gzip.open(path + '.gz', 'wb')
+        try:
+            shutil.copyfileobj(input_file, output_file)
+        finally:
+            output_file.close()
+    finally:
+        input_file.close()
+
+def decompress_file(path):
+    """Replace path.gz with the decompressed file path"""
+    input_file = gzip.open(path + '.gz', 'rb')
+    try:
+        output_file = open(path, 'wb')
+        try:
+            shutil.copyfileobj(input_file, output_file)
+        finally:
+            output_file.close()
+    finally:
+        input_file.close()
+    os.remove(path + '.gz')
+
+def compress_job_transfers(subtask, number_of_jobs):
+    """Compress the model files of the subtask, and rewrite the spec file to decompress them on the worker
+    and compress the outputs for the transfer back. The output filename patterns are recorded in the
+    subtask's compressed_outputs custom field, so they can be decompressed by decompress_job_outputs.
+    Returns True if the spec file was changed
+    """
+    if not is_compression_enabled():
+        return False
+
+    task = subtask.task
+    spec_file_path = os.path.join(task.directory, subtask.spec_file)
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+
+    transfer_match = transfer_input_files_re.search(spec_string)
+    output_match = transfer_output_files_re.search(spec_string)
+    executable_match = executable_re.search(spec_string)
+    arguments_match = arguments_re.search(spec_string)
+    transfer_executable_match = transfer_executable_re.search(spec_string)
+    if not transfer_match or not output_match or not executable_match or not arguments_match:
+        return False
+
+    input_files = _split_files(transfer_match.group('files'))
+    output_files = _split_files(output_match.group('files'))
+    compressed_inputs = [name for name in input_files if os.path.splitext(name)[1] in COMPRESSED_INPUT_EXTENSIONS]
+    if len(compressed_inputs) == 0 and len(output_files) == 0:
+        return False
+
+    for name in compressed_inputs:
+        if '$(Process)' in name:
+            paths = [os.path.join(task.directory, name.replace('$(Process)', str(process))) for process in range(number_of_jobs)]
+        else:
+            paths = [os.path.join(task.directory, name)]
+        for path in paths:
+            if not os.path.isfile(path):
+                log.debug('Input file %s does not exist. Not compressing job transfers' % path)
+                return False
+            compress_file(path)
+
+    executable = executable_match.group('executable')
+    transfer_executable = not transfer_executable_match or transfer_executable_match.group('transfer').upper() in ['YES', 'TRUE']
+
+    new_input_files = [name + '.gz' if name in compressed_inputs else name for name in input_files]
+    if transfer_executable:
+        #The executable is transferred as an ordinary input file, so make sure it can be run
+        #Input files are given relative to the task directory, so link an executable elsewhere (e.g. CopasiSE) into it
+        executable_name = os.path.basename(executable)
+        if os.path.isabs(executable) and not os.path.exists(os.path.join(task.directory, executable_name)):
+            os.symlink(executable, os.path.join(task.directory, executable_name))
+        new_input_files.append(executable_name)
+        executable = './' + executable_name
+        prepare_executable = 'chmod +x %s\n' % executable
+    else:
+        prepare_executable = ''
+
+    wrapper_filename = 'auto_compress_%d.sh' % subtask.index
+    wrapper_file = open(os.path.join(task.directory, wrapper_filename), 'w')
+    wrapper_file.write(Template(condor_spec.compression_wrapper_string).substitute(input_files=' '.join([_shell_filename(name) for name in compressed_inputs]),
+                                                                                    output_files=' '.join([_shell_filename(name) for name in output_files]),
+                                                                                    prepare_executable=prepare_executable,
+                                                                                    executable=executable,
+                                                                                    ))
+    wrapper_file.close()
+    os.chmod(os.path.join(task.directory, wrapper_filename), 0755)
+
+    spec_string = executable_re.sub('executable = %s' % wrapper_filename, spec_string, count=1)
+    if transfer_executable_match:
+        spec_string = transfer_executable_re.sub('transfer_executable = YES', spec_string, count=1)
+    spec_string = arguments_re.sub(lambda match: 'arguments = $(Process) ' + match.group('arguments'), spec_string, count=1)
+    spec_string = transfer_input_files_re.sub('transfer_input_files = %s' % ', '.join(new_input_files), spec_string, count=1)
+    spec_string = transfer_output_files_re.sub('transfer_output_files = %s' % ', '.join([name + '.gz' for name in output_files]), spec_string, count=1)
+
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
+
+    subtask.set_custom_field('compressed_outputs', [name.replace('%', '%%').replace('$(Process)', '%d') for name in output_files])
+    return True
+
+def decompress_job_outputs(job):
+    """Decompress the output files of a finished job that were compressed for transfer, if any
+    """
+    patterns = job.subtask.get_custom_field('compressed_outputs')
+    if not patterns:
+        return
+    for pattern in patterns:
+        try:
+            name = pattern % job.process_id
+        except TypeError:
+            name = pattern % ()
+        path = os.path.join(job.subtask.task.directory, name)
+        if os.path.isfile(path + '.gz'):
+            try:
+                decompress_file(path)
+            except Exception, e:
+                log.exception(e)
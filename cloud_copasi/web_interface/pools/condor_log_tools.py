@@ -7,126 +7,328 @@
 # http://www.gnu.org/licenses/gpl.html
 #-------------------------------------------------------------------------------
 
-import re, datetime
+import re, datetime, os
+from collections import OrderedDict
+from cloud_copasi.web_interface.pools import metrics
 
+#Regexes are compiled once, at import time
 
-class Log:
-    """Class for reading and processing condor log files using regex patterns"""
-   
-    def __init__(self, path):
-        """Initialise the class, reading from the condor file located at absolute path 'path'"""
-       
-        #First, define some regexes
-       
-        #Job execution string will be of the format:
-        #001 (20949.000.000) 02/07 11:27:10 Job executing on host: <130.88.110.118:60608>
-        execution_string = r'\d+\s\S+\s(?P<month>\d\d)\/(?P<day>\d\d)\s(?P<hour>\d+)\:(?P<minute>\d+)\:(?P<second>\d+)\sJob executing on host\:\s\<(?P<host>.+)\>.*'
-        execution_re = re.compile(execution_string)
-        execution_match = False
-        
-        #Job termination string:
-        #005 (20949.000.000) 02/07 11:28:10 Job terminated.
-        termination_string = r'\d+\s\S+\s(?P<month>\d\d)\/(?P<day>\d\d)\s(?P<hour>\d+)\:(?P<minute>\d+)\:(?P<second>\d+)\sJob terminated\..*'
-        termination_re = re.compile(termination_string)
-        termination_match = False
-        #Termination status:
-        #       (1) Normal termination (return value 0) #TODO:this only works for normal termination, so status will always be 0
-        termination_status_string = r'\s+\(\d+\)\s(Normal|Abnormal) termination\s\((return value|signal) (?P<return_value>\d+)\).*'
-        termination_status_re = re.compile(termination_status_string)
-        termination_status_match = False
-        #Remote usage time
-        #               Usr 0 00:00:54, Sys 0 00:00:00  -  Total Remote Usage
-        remote_usage_string = r'\s+Usr\s(?P<usr_days>\d+)\s(?P<usr_hours>\d+)\:(?P<usr_minutes>\d+)\:(?P<usr_seconds>\d+)\,\sSys\s(?P<sys_days>\d+)\s(?P<sys_hours>\d+)\:(?P<sys_minutes>\d+)\:(?P<sys_seconds>\d+)\s+\-\s+Total Remote Usage.*'
-        remote_usage_re = re.compile(remote_usage_string)
-        remote_usage_match = False
-        #We'll use this string to search for the phrase 'Job terminated'. We'll then use this to decide whether or not the job has finished running yet. If not, then don't try and match anything else yet - there's no point
-        termination_confirmation_string = r'.*Job terminated.'
-        termination_confirmation_re = re.compile(termination_confirmation_string)
-        
+#Each event in the user log starts with a header line of the format:
+#001 (20949.000.000) 02/07 11:27:10 Job executing on host: <130.88.110.118:60608>
+#Newer versions of condor write the date as 2013-02-07 instead
+event_header_string = r'^(?P<code>\d\d\d)\s\((?P<cluster_id>\d+)\.(?P<process_id>\d+)\.\d+\)\s(?P<date>\S+)\s(?P<hour>\d+)\:(?P<minute>\d+)\:(?P<second>\d+)\s(?P<text>.*)$'
+event_header_re = re.compile(event_header_string)
+
+#Each event is terminated by a line containing only '...'
+event_end_string = '...'
+
+#Job executing on host: <130.88.110.118:60608>
+execution_host_string = r'Job executing on host\:\s\<(?P<host>.+)\>.*'
+execution_host_re = re.compile(execution_host_string)
+
+#Termination status:
+#       (1) Normal termination (return value 0)
+termination_status_string = r'\s+\(\d+\)\s(Normal|Abnormal) termination\s\((return value|signal) (?P<return_value>\d+)\).*'
+termination_status_re = re.compile(termination_status_string)
+
+#Remote usage time
+#               Usr 0 00:00:54, Sys 0 00:00:00  -  Total Remote Usage
+remote_usage_string = r'\s+Usr\s(?P<usr_days>\d+)\s(?P<usr_hours>\d+)\:(?P<usr_minutes>\d+)\:(?P<usr_seconds>\d+)\,\sSys\s(?P<sys_days>\d+)\s(?P<sys_hours>\d+)\:(?P<sys_minutes>\d+)\:(?P<sys_seconds>\d+)\s+\-\s+Total Remote Usage.*'
+remote_usage_re = re.compile(remote_usage_string)
+
+#Submit events of jobs submitted by DAGMan include the name of the DAG node
+#    DAG Node: subtask_2
+dag_node_string = r'\s*DAG Node\:\s(?P<node>\S+).*'
+dag_node_re = re.compile(dag_node_string)
+
+#The event codes we are interested in. Anything else is recorded as 'other'
+EVENT_TYPES = {
+               0: 'submit',
+               1: 'execute',
+               4: 'evict',
+               5: 'terminate',
+               9: 'abort',
+               12: 'hold',
+               13: 'release',
+               }
+
+#The maximum number of log files to keep track of at once
+LOG_CACHE_SIZE = 20000
+
+
+def _parse_timestamp(date, hour, minute, second):
+    """Create a datetime object from the date and time fields of an event header
+    """
+    if '-' in date:
+        year, month, day = [int(x) for x in date.split('-')]
+    else:
+        #Since older log files don't store the year, we'll have to guess it
+        month, day = [int(x) for x in date.split('/')]
+        today = datetime.datetime.today()
+        year = today.year
+        #An event can't have happened in the future, so it must have been last year
+        if (month, day) > (today.month, today.day):
+            year -= 1
+    return datetime.datetime(year=year, month=month, day=day, hour=int(hour), minute=int(minute), second=int(second))
+
+
+class LogEvent(object):
+    """A single event from a condor user log
+    """
+
+    def __init__(self, code, cluster_id, process_id, timestamp, lines):
+        self.code = code
+        self.event_type = EVENT_TYPES.get(code, 'other')
+        self.cluster_id = cluster_id
+        self.process_id = process_id
+        self.timestamp = timestamp
+        #Any lines following the header line
+        self.lines = lines
+
+        self.host = None
+        self.termination_status = None
+        self.remote_usage_time = None
+        self.dag_node = None
+
+        if self.event_type == 'submit':
+            for line in lines[1:]:
+                match = dag_node_re.match(line)
+                if match:
+                    self.dag_node = match.group('node')
+
+        elif self.event_type == 'execute':
+            match = execution_host_re.match(lines[0]) if len(lines) > 0 else None
+            if match:
+                self.host = match.group('host')
+
+        elif self.event_type == 'terminate':
+            for line in lines:
+                match = termination_status_re.match(line)
+                if match:
+                    self.termination_status = int(match.group('return_value'))
+                    continue
+                match = remote_usage_re.match(line)
+                if match:
+                    g = match.group
+                    usr_time = datetime.timedelta(days=int(g('usr_days')), hours=int(g('usr_hours')), minutes=int(g('usr_minutes')), seconds=int(g('usr_seconds')))
+                    sys_time = datetime.timedelta(days=int(g('sys_days')), hours=int(g('sys_hours')), minutes=int(g('sys_minutes')), seconds=int(g('sys_seconds')))
+                    self.remote_usage_time = usr_time + sys_time
+
+    def __repr__(self):
+        return '<LogEvent %s %d.%d %s>' % (self.event_type, self.cluster_id, self.process_id, self.timestamp)
+
+
+class JobState(object):
+    """The state of a job, built up from its log events one at a time, so that the events themselves needn't be kept
+    """
+
+    def __init__(self):
         self.has_terminated = False
-        #Search to see if the job has actually terminated. Only continue if it has...
-        for line in open(path, 'r'):
-            if termination_confirmation_re.match(line):
-                self.has_terminated = True
+        self.has_aborted = False
+        self.execution_start = None
+        self.host = None
+        self.termination_status = None
+        self.termination_time = None
+        self.remote_usage_time = None
+
+    def add_event(self, event):
+        if event.event_type == 'execute':
+            self.execution_start = event.timestamp
+            self.host = event.host
+        elif event.event_type == 'terminate':
+            self.has_terminated = True
+            self.termination_status = event.termination_status
+            self.termination_time = event.timestamp
+            self.remote_usage_time = event.remote_usage_time
+        elif event.event_type == 'abort':
+            #The job was removed from the queue, e.g. by condor_rm
+            self.has_aborted = True
+            self.termination_time = event.timestamp
+
+
+class LogReader(object):
+    """Incrementally reads events from a condor user log.
+    Remembers the byte offset reached, so that each call to update() only parses newly appended events.
+    Only the state of each job is kept, not the events themselves
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.size = 0
+        self.offset = 0
+        #Job states indexed by (cluster_id, process_id)
+        self.job_states = {}
+        #The state of all the jobs in the log taken together
+        self.log_state = JobState()
+        #Cluster ids of jobs submitted by DAGMan, indexed by DAG node name
+        self.dag_nodes = {}
+
+    def update(self):
+        """Read and parse any events appended to the log since the last update.
+        Returns a list of the new events
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            #The log hasn't been created yet
+            return []
+
+        #If the file has been replaced or truncated, start again from the beginning
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.reset()
+            self.inode = stat.st_ino
+
+        if stat.st_size == self.size:
+            return []
+
+        log_file = open(self.path, 'rb')
+        try:
+            log_file.seek(self.offset)
+            data = log_file.read()
+        finally:
+            log_file.close()
+
+        self.size = self.offset + len(data)
+        metrics.increment('log_files_read')
+        metrics.increment('log_bytes_read', len(data))
+
+        #Only consume complete events. Any partially written event will be read again next time
+        new_events = []
+        event_lines = []
+        consumed = 0
+        position = 0
+        for line in data.splitlines(True):
+            position += len(line)
+            if not line.endswith('\n'):
                 break
-       
-        if not self.has_terminated:
-            return
+            line = line.rstrip('\r\n')
+            if line == event_end_string:
+                event = self._parse_event(event_lines)
+                if event:
+                    new_events.append(event)
+                event_lines = []
+                consumed = position
+            else:
+                event_lines.append(line)
+
+        self.offset += consumed
+
+        for event in new_events:
+            job_state = self.job_states.get((event.cluster_id, event.process_id))
+            if job_state == None:
+                job_state = self.job_states[(event.cluster_id, event.process_id)] = JobState()
+            job_state.add_event(event)
+            self.log_state.add_event(event)
+            if event.dag_node != None:
+                self.dag_nodes[event.dag_node] = event.cluster_id
 
+        return new_events
+
+    def _parse_event(self, lines):
+        if len(lines) == 0:
+            return None
+        match = event_header_re.match(lines[0])
+        if not match:
+            return None
+        g = match.group
         try:
-            for line in open(path, 'r'):
-                if execution_re.match(line):
-                    execution_match = execution_re.match(line)
-                elif termination_re.match(line):
-                    termination_match = termination_re.match(line)
-                elif termination_status_re.match(line):
-                    termination_status_match = termination_status_re.match(line)
-                elif remote_usage_re.match(line):
-                    remote_usage_match = remote_usage_re.match(line)
-               
-           
-            if remote_usage_match:
-                g = remote_usage_match.group
-                usr_days = int(g('usr_days'))
-                usr_hours = int(g('usr_hours'))
-                usr_minutes = int(g('usr_minutes'))
-                usr_seconds = int(g('usr_seconds'))
-
-                sys_days = int(g('sys_days'))
-                sys_hours = int(g('sys_hours'))
-                sys_minutes = int(g('sys_minutes'))
-                sys_seconds = int(g('sys_seconds'))
-               
-                usr_time = datetime.timedelta(days=usr_days, hours=usr_hours, minutes=usr_minutes, seconds=usr_seconds)
-                sys_time = datetime.timedelta(days=sys_days, hours=sys_hours, minutes=sys_minutes, seconds=sys_seconds)
-               
-                self.remote_usage_time = usr_time + sys_time
-           
-            if execution_match:
-                g = execution_match.group
-                day = int(g('day'))
-                month = int(g('month'))
-                hour = int(g('hour'))
-                minute = int(g('minute'))
-                second = int(g('second'))
-                host = g('host')
-#                port = g('port')
-               
-                #Create datetime object for execution start time
-                #Since log file doesn't store the date, we'll have to guess it
-                #If remote_usage time is stored, take the current date, and subtract the usage time
-                try:
-                    assert self.remote_usage_time != None
-                    year = (datetime.datetime.today() - self.remote_usage_time).year
-                except AssertionError:
-                    year = datetime.datetime.today().year
-               
-                self.execution_start = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
-                self.host = host
-               
-            if termination_status_match:
-                self.termination_status = int(termination_status_match.group('return_value'))
-               
-            if termination_match:
-                g = termination_match.group
-                day = int(g('day'))
-                month = int(g('month'))
-                hour = int(g('hour'))
-                minute = int(g('minute'))
-                second = int(g('second'))
-               
-                #Again, guess the year
-                year=datetime.datetime.today().year
-                self.termination_time = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
-
-            #For some reason, the remote usage time sometimes appears as zero. In this case, set running time as follows:
-            if self.remote_usage_time == datetime.timedelta() and hasattr(self, 'execution_start'):            
-                self.running_time = self.termination_time - self.execution_start
+            timestamp = _parse_timestamp(g('date'), g('hour'), g('minute'), g('second'))
+        except ValueError:
+            timestamp = None
+
+        return LogEvent(int(g('code')), int(g('cluster_id')), int(g('process_id')), timestamp, [g('text')] + lines[1:])
+
+    def get_job_state(self, cluster_id=None, process_id=None):
+        """Return the state of a single job, or of all the jobs in the log taken together
+        """
+        if cluster_id == None or process_id == None:
+            return self.log_state
+        return self.job_states.get((int(cluster_id), int(process_id))) or JobState()
+
+    def get_dag_node_cluster_id(self, node):
+        """Return the cluster id DAGMan submitted the named DAG node as, or None if it hasn't been submitted yet
+        """
+        return self.dag_nodes.get(node)
+
+    def get_log(self, cluster_id=None, process_id=None):
+        """Return a Log summary for the events read so far
+        """
+        return Log(state=self.get_job_state(cluster_id, process_id))
+
+
+#Process-wide cache of log readers, indexed by path
+_reader_cache = OrderedDict()
+
+def get_reader(path):
+    """Return the LogReader for the log at path, brought up to date with any newly appended events
+    """
+    reader = _reader_cache.pop(path, None)
+    if reader == None:
+        reader = LogReader(path)
+    #Re-insert to mark as most recently used
+    _reader_cache[path] = reader
+    while len(_reader_cache) > LOG_CACHE_SIZE:
+        _reader_cache.popitem(last=False)
+
+    reader.update()
+    return reader
+
+def get_log(path, cluster_id=None, process_id=None):
+    """Return a Log summary for the log at path, only parsing events appended since the last call
+    """
+    return get_reader(path).get_log(cluster_id, process_id)
+
+def forget(path):
+    """Stop tracking the log at path, e.g. once the corresponding job has finished
+    """
+    _reader_cache.pop(path, None)
+
+
+class Log:
+    """Class summarising the events of a condor job read from a condor log file"""
+
+    def __init__(self, path=None, events=None, state=None):
+        """Initialise the class, either from a JobState, from a list of LogEvents, or by reading from the condor file located at absolute path 'path'"""
+
+        if state == None:
+            if events == None:
+                reader = LogReader(path)
+                reader.update()
+                state = reader.get_job_state()
             else:
-                self.running_time = self.remote_usage_time
-            self.running_time_in_days = float(self.running_time.days) + (float(self.running_time.seconds) / 86400.00)
-             
-               
-        except:
-            raise
+                state = JobState()
+                for event in events:
+                    state.add_event(event)
+
+        #A job removed from the queue (e.g. with condor_rm) has also terminated, but without a termination status
+        self.has_terminated = state.has_terminated or state.has_aborted
+        self.has_aborted = state.has_aborted and not state.has_terminated
+        self.termination_status = None
+        self.remote_usage_time = datetime.timedelta()
+
+        #Only continue if the job has actually terminated
+        if not self.has_terminated:
+            return
+
+        if state.remote_usage_time != None:
+            self.remote_usage_time = state.remote_usage_time
+
+        if state.execution_start != None:
+            self.execution_start = state.execution_start
+            self.host = state.host
+
+        if not self.has_aborted:
+            self.termination_status = state.termination_status
+
+        self.termination_time = state.termination_time
 
+        #For some reason, the remote usage time sometimes appears as zero. In this case, set running time as follows:
+        if self.remote_usage_time == datetime.timedelta() and hasattr(self, 'execution_start') and self.termination_time != None:
+            self.running_time = self.termination_time - self.execution_start
+        else:
+            self.running_time = self.remote_usage_time
+        self.running_time_in_days = float(self.running_time.days) + (float(self.running_time.seconds) / 86400.00)
@@ -6,19 +6,23 @@
 # which accompanies this distribution, and is available at
 # http://www.gnu.org/licenses/gpl.html
 #-------------------------------------------------------------------------------
-import subprocess, re, os
+import subprocess, re, os, json
 import os.path, time
 from cloud_copasi import settings
 import logging
-from cloud_copasi.web_interface.models import EC2Pool, Subtask, CondorJob
-from cloud_copasi.web_interface.pools import condor_log_tools
+from cloud_copasi.web_interface.models import EC2Pool, CondorPool, BoscoPool, Task, Subtask, CondorJob
+from cloud_copasi.web_interface.pools import condor_log_tools, command_runner, staging_tools, compression_tools, fair_share, federation
+from cloud_copasi.web_interface.pools import metrics
 import datetime
 from django.utils.timezone import now
+from django.db import transaction
+from django.db.models import F
 
 log = logging.getLogger(__name__)
 
 CONDOR_Q = 'condor_q'
 CONDOR_SUBMIT = 'condor_submit'
+CONDOR_SUBMIT_DAG = 'condor_submit_dag'
 CONDOR_RM = 'condor_rm'
 BOSCO_CLUSTER = 'bosco_cluster'
 
@@ -38,14 +42,18 @@ if hasattr(settings, 'BOSCO_CUSTOM_ENV'):
 
 
 
-def run_bosco_command(command, error=False, cwd=None, shell=False):
-    
-    process = subprocess.Popen(command, shell=shell, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
-    
-    output = process.communicate()
+def get_bosco_cluster_timeout():
+    #bosco_cluster --add and --test can take several minutes over SSH
+    return getattr(settings, 'BOSCO_CLUSTER_TIMEOUT', 900)
 
-    if not error: return output[0].splitlines()
-    else: return (output[0].splitlines(), output[1].splitlines(), process.returncode)
+def run_bosco_command(command, error=False, cwd=None, shell=False, timeout=None, cluster=command_runner.LOCAL_CLUSTER, cache_time=0):
+    """Run command in the bosco environment. Commands are killed after timeout seconds (BOSCO_COMMAND_TIMEOUT by default)
+    See command_runner.run_command
+    """
+    output = command_runner.run_command(command, env=env, cwd=cwd, shell=shell, timeout=timeout, cluster=cluster, cache_time=cache_time)
+
+    if not error: return output[0]
+    else: return output
 
 def add_bosco_pool(platform, address, keypair, pool_type='condor'):
     
@@ -57,16 +65,51 @@ def add_bosco_pool(platform, address, keypair, pool_type='condor'):
     command += 'kill $SSH_AGENT_PID;'
         
     
-    output = run_bosco_command(command, error=True, shell=True)
+    output = run_bosco_command(command, error=True, shell=True, timeout=get_bosco_cluster_timeout(), cluster=address)
     
     log.debug(output)
     
     return output
 
+def run_bosco_pool_add(pool_id, keypair):
+    """Add the pool to bosco using bosco_cluster --add, and record the result on the pool.
+    The keypair file is removed afterwards
+    """
+    pool = BoscoPool.objects.get(id=pool_id)
+    try:
+        output, errors, exit_status = add_bosco_pool(pool.platform, pool.address, keypair, pool.pool_type)
+    finally:
+        os.remove(keypair)
+    
+    if exit_status != 0:
+        try:
+            log.debug('Error adding pool. Attempting to remove from bosco_cluster')
+            remove_bosco_pool(pool.address)
+        except Exception, e:
+            log.exception(e)
+    
+    add_output = json.dumps({'output': output, 'stderr': errors, 'exit_status': exit_status})
+    add_status = 'success' if exit_status == 0 else 'failed'
+    BoscoPool.objects.filter(id=pool_id).update(add_status=add_status, add_output=add_output, add_time=now())
+
+def start_bosco_pool_add(pool, keypair):
+    """Start adding the pool to bosco in the background. The result is recorded in pool.add_status and pool.add_output
+    """
+    BoscoPool.objects.filter(id=pool.id).update(add_status='running', add_output='', add_time=now())
+    command_runner.run_in_background(run_bosco_pool_add, pool.id, keypair)
+
+def is_bosco_pool_add_running(pool):
+    """Return True if the pool is still being added to bosco.
+    If it has been running for longer than the timeout, the background worker must have died
+    """
+    if pool.add_status != 'running' or pool.add_time == None:
+        return False
+    return (now() - pool.add_time) < datetime.timedelta(seconds=get_bosco_cluster_timeout() + 60)
+
 def remove_bosco_pool(address):
     
     log.debug('Removing pool %s' %address)
-    output = run_bosco_command([BOSCO_CLUSTER, '--remove', address], error=True)
+    output = run_bosco_command([BOSCO_CLUSTER, '--remove', address], error=True, timeout=get_bosco_cluster_timeout(), cluster=address)
     log.debug('Response:')
     log.debug(output)
     
@@ -82,7 +125,7 @@ def test_bosco_pool(address):
     
     command = [BOSCO_CLUSTER, '--test', address]
 
-    output =  run_bosco_command(command, error=True)
+    output =  run_bosco_command(command, error=True, timeout=get_bosco_cluster_timeout(), cluster=address)
     
     log.debug('Test response:')
     log.debug(output[0])
@@ -93,6 +136,30 @@ def test_bosco_pool(address):
     
     return output
 
+def run_pool_test(pool_id):
+    """Test the pool using bosco_cluster --test, and record the result on the pool
+    """
+    pool = CondorPool.objects.get(id=pool_id)
+    output, errors, exit_status = test_bosco_pool(pool.address)
+    
+    test_output = json.dumps({'output': output, 'stderr': errors, 'exit_status': exit_status})
+    test_status = 'success' if exit_status == 0 else 'failed'
+    CondorPool.objects.filter(id=pool_id).update(test_status=test_status, test_output=test_output, test_time=now())
+
+def start_pool_test(pool):
+    """Start testing the pool in the background. The result is recorded in pool.test_status and pool.test_output
+    """
+    CondorPool.objects.filter(id=pool.id).update(test_status='running', test_output='', test_time=now())
+    command_runner.run_in_background(run_pool_test, pool.id)
+
+def is_pool_test_running(pool):
+    """Return True if a pool test has been started and hasn't finished yet.
+    If it has been running for longer than the timeout, the background worker must have died
+    """
+    if pool.test_status != 'running' or pool.test_time == None:
+        return False
+    return (now() - pool.test_time) < datetime.timedelta(seconds=get_bosco_cluster_timeout() + 60)
+
 
 def add_ec2_pool(ec2_pool):
     """Add an EC2 pool to bosco
@@ -119,6 +186,7 @@ def condor_submit(condor_file):
     (directory, filename) = os.path.split(condor_file)
     
     output, error, exit_status = run_bosco_command([CONDOR_SUBMIT, condor_file], error=True, cwd=directory)
+    command_runner.clear_cache()
     log.debug('Submitting to condor. Output: ')
     log.debug(output)
     #Get condor_process number...
@@ -146,21 +214,54 @@ def condor_submit(condor_file):
     
     
     
-def submit_task(subtask):
-    """Submit the subtask to the pool. Create all necessary CondorJobs, and update their status.
+#Matches the log line of a spec file that writes one log per job in the cluster, e.g.
+#log =  auto_copasi_1.$(Process).cps.log
+per_job_log_re = re.compile(r'^log\s*=.*\$\(Process\).*$', re.MULTILINE)
+
+def use_shared_log(spec_file_path, log_file):
+    """Rewrite the spec file so that every job in the cluster writes to the single user log log_file.
+    Returns True if the spec file was changed
     """
-    
-    assert isinstance(subtask, Subtask)
-    assert subtask.spec_file != ''
-    
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+    
+    if not per_job_log_re.search(spec_string):
+        return False
+    
+    spec_string = per_job_log_re.sub('log = %s' % log_file, spec_string)
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
+    return True
+
+#The number of CondorJob rows inserted per query when submitting a subtask
+JOB_INSERT_BATCH_SIZE = 500
+
+def get_filename_formatter(pattern):
+    """Return a function mapping a process id to a filename. If pattern contains a %d placeholder
+    it is substituted with the process id, otherwise the pattern is used as is
+    """
+    try:
+        pattern % 0
+    except (TypeError, ValueError, KeyError):
+        return lambda process_id: pattern
+    return lambda process_id: pattern % process_id
+
+def prepare_shared_log(subtask):
+    """If requested, have all jobs in the subtask cluster share a single user log.
+    The shared log is recorded as the subtask's log_file custom field
+    """
+    if not getattr(settings, 'CONDOR_SHARED_LOG', False):
+        return
     spec_file_path = os.path.join(subtask.task.directory, subtask.spec_file)
-    
-    cluster_id, number_of_jobs = condor_submit(spec_file_path)
-    
-    log.debug('cluster id %d' % cluster_id)
-    log.debug('number_of_jobs %d' % number_of_jobs)
-    
-    
+    shared_log_file = 'auto_copasi_%d.log' % subtask.index
+    if use_shared_log(spec_file_path, shared_log_file):
+        subtask.set_custom_field('log_file', shared_log_file)
+
+def build_condor_jobs(subtask, number_of_jobs):
+    """Return a list of the (unsaved) CondorJobs for the subtask, with the filenames filled in for each process
+    """
     #Check to see if std_output_file, std_err_file, log_file or job_output were specified by the subtask
     #If not use the defualt values
     
@@ -191,54 +292,402 @@ def submit_task(subtask):
         copasi_model_filename_n = 'auto_copasi_%d.%%d.cps' % subtask.index
     
     
+    #Work out once whether each filename pattern takes the process id
+    std_output_file = get_filename_formatter(std_output_file_n)
+    std_err_file = get_filename_formatter(std_err_file_n)
+    log_file = get_filename_formatter(log_file_n)
+    copasi_model_filename = get_filename_formatter(copasi_model_filename_n)
+    job_output = get_filename_formatter(job_output_n)
+    
+    return [CondorJob(subtask=subtask,
+                      std_output_file = std_output_file(n),
+                      std_error_file = std_err_file(n),
+                      log_file = log_file(n),
+                      job_output = job_output(n), 
+                      status = 'I',
+                      process_id = n,
+                      run_time = 0.0,
+                      copasi_file = copasi_model_filename(n),
+                      ) for n in range(number_of_jobs)]
+
+def start_subtask_jobs(subtask, cluster_id, number_of_jobs):
+    """Create the CondorJobs for a subtask that has been submitted to condor as cluster cluster_id, and mark it as running.
+    If cluster_id is None, the jobs haven't been submitted yet. They are submitted in chunks by submit_next_chunk
+    """
+    jobs = build_condor_jobs(subtask, number_of_jobs)
+    
     subtask.cluster_id=cluster_id
-    for n in range(number_of_jobs):
-        
-        try:
-            std_output_file = std_output_file_n % n
-        except:
-            std_output_file = std_output_file_n
-        try:
-            std_err_file = std_err_file_n % n
-        except:
-            std_err_file = std_err_file_n
-        try:
-            log_file = log_file_n % n
-        except:
-            log_file = log_file_n
+    subtask.status='running'
+    subtask.start_time = now()
+    #All the jobs start off idle, or not queued
+    if cluster_id == None:
+        for job in jobs:
+            job.status = 'N'
+        subtask.idle_job_count = 0
+        subtask.unsubmitted_job_count = number_of_jobs
+    else:
+        subtask.idle_job_count = number_of_jobs
+        subtask.unsubmitted_job_count = 0
+    subtask.running_job_count = 0
+    subtask.held_job_count = 0
+    subtask.finished_job_count = 0
+    subtask.error_job_count = 0
+    subtask.job_run_time = 0.0
+    
+    #Insert all the jobs and update the subtask in a single transaction
+    with transaction.commit_on_success():
+        CondorJob.objects.bulk_create(jobs, batch_size=JOB_INSERT_BATCH_SIZE)
+        subtask.save()
+
+def submit_task(subtask):
+    """Submit the subtask to the pool. Create all necessary CondorJobs, and update their status.
+    """
+    
+    assert isinstance(subtask, Subtask)
+    assert subtask.spec_file != ''
+    
+    prepare_shared_log(subtask)
+    
+    spec_file_path = os.path.join(subtask.task.directory, subtask.spec_file)
+    number_of_jobs = count_spec_jobs(spec_file_path)
+    compression_tools.compress_job_transfers(subtask, number_of_jobs)
+    pools = federation.get_task_pools(subtask.task)
+    federated = len(pools) > 1 and is_chunkable(spec_file_path)
+    #Staged files are cached on the task's own pool only
+    if not federated:
+        staging_tools.stage_shared_inputs(subtask, number_of_jobs)
+    fair_share.apply_priority(subtask, spec_file_path, number_of_jobs)
+    
+    if federated:
+        log.debug('Submitting %d jobs across %d pools' % (number_of_jobs, len(pools)))
+        start_subtask_jobs(subtask, None, number_of_jobs)
+        submit_federated_chunks(subtask, pools)
+        return
+    
+    #Don't flood the schedd with huge clusters
+    max_queued_jobs = get_max_queued_jobs(subtask.task.condor_pool)
+    if needs_chunked_submission(subtask):
+        log.debug('Submitting %d jobs in chunks of at most %d' % (number_of_jobs, max_queued_jobs))
+        start_subtask_jobs(subtask, None, number_of_jobs)
+        submit_next_chunk(subtask, max_queued_jobs)
+        return
+    elif getattr(settings, 'CONDOR_LATE_MATERIALIZATION', False) and max_queued_jobs > 0 and number_of_jobs > max_queued_jobs:
+        use_late_materialization(spec_file_path, max_queued_jobs)
+    
+    cluster_id, number_of_jobs = condor_submit(spec_file_path)
+    
+    log.debug('cluster id %d' % cluster_id)
+    log.debug('number_of_jobs %d' % number_of_jobs)
+    
+    start_subtask_jobs(subtask, cluster_id, number_of_jobs)
+
+#Matches the queue statements of a spec file, e.g. 'queue 10' or 'queue'
+queue_re = re.compile(r'^\s*queue\s*(?P<n>\d*)\s*$', re.MULTILINE | re.IGNORECASE)
+
+def count_spec_jobs(spec_file_path):
+    """Return the number of jobs queued by a spec file
+    """
+    spec_file = open(spec_file_path, 'r')
+    try:
+        spec = spec_file.read()
+    finally:
+        spec_file.close()
+    return sum([int(match.group('n') or 1) for match in queue_re.finditer(spec)])
+
+def get_max_queued_jobs(pool):
+    """Return the maximum number of jobs of a subtask to have in the queue at once, or 0 for no limit.
+    Can be set for each pool, otherwise settings.CONDOR_MAX_QUEUED_JOBS is used
+    """
+    if pool != None and pool.max_queued_jobs != None:
+        return pool.max_queued_jobs
+    return getattr(settings, 'CONDOR_MAX_QUEUED_JOBS', 0)
+
+def use_late_materialization(spec_file_path, max_queued_jobs):
+    """Rewrite the spec file so that the schedd only materialises max_queued_jobs jobs of the cluster at a time.
+    Requires HTCondor 8.7.1 or later on the submit host
+    """
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+    
+    spec_string = queue_re.sub(lambda match: 'max_materialize = %d\n%s' % (max_queued_jobs, match.group(0)), spec_string, count=1)
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
+
+#Matches the process id macro of a spec file
+process_macro_re = re.compile(r'\$\(Process\)', re.IGNORECASE)
+
+def is_chunkable(spec_file_path):
+    """Return True if the jobs of the spec file can be submitted in chunks, i.e. it has a single queue statement
+    """
+    spec_file = open(spec_file_path, 'r')
+    try:
+        spec = spec_file.read()
+    finally:
+        spec_file.close()
+    return len(queue_re.findall(spec)) == 1
+
+def needs_chunked_submission(subtask):
+    """Return True if the subtask has more jobs than can be queued at once, and condor late materialisation isn't
+    available, so its jobs will be submitted in chunks. The jobs of a task federated across several pools are
+    always submitted in chunks
+    """
+    if federation.is_federated(subtask.task):
+        return is_chunkable(os.path.join(subtask.task.directory, subtask.spec_file))
+    if getattr(settings, 'CONDOR_LATE_MATERIALIZATION', False):
+        return False
+    spec_file_path = os.path.join(subtask.task.directory, subtask.spec_file)
+    max_queued_jobs = get_max_queued_jobs(subtask.task.condor_pool)
+    return max_queued_jobs > 0 and count_spec_jobs(spec_file_path) > max_queued_jobs and is_chunkable(spec_file_path)
+
+def write_chunk_spec(spec_file_path, first_process, number_of_jobs):
+    """Write a spec file for submitting jobs first_process to first_process + number_of_jobs - 1 of spec_file_path as a new cluster.
+    Each job keeps its filenames by replacing $(Process) with $(JobIndex), which a single queue statement sets to the job's
+    index in the subtask. Requires HTCondor 8.4 or later on the submit host. Returns the path of the new spec file
+    """
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+    
+    spec_string = process_macro_re.sub('$(JobIndex)', spec_string)
+    queue_line = 'queue JobIndex from seq %d %d |' % (first_process, first_process + number_of_jobs - 1)
+    spec_string = queue_re.sub(lambda match: queue_line, spec_string, count=1)
+    
+    chunk_file_path = '%s.%d.job' % (os.path.splitext(spec_file_path)[0], first_process)
+    chunk_file = open(chunk_file_path, 'w')
+    chunk_file.write(spec_string)
+    chunk_file.close()
+    return chunk_file_path
+
+def submit_chunk(subtask, chunk_size, pool=None):
+    """Submit the next chunk_size of the subtask's jobs that haven't been submitted yet, to pool if it isn't the
+    task's own pool
+    """
+    #The jobs are submitted in order, so the unsubmitted jobs are the last ones
+    remaining = subtask.unsubmitted_job_count
+    first_process = subtask.get_queued_job_count() - remaining
+    chunk_file_path = write_chunk_spec(os.path.join(subtask.task.directory, subtask.spec_file), first_process, chunk_size)
+    if pool != None and pool.id != subtask.task.condor_pool_id:
+        federation.retarget_spec(chunk_file_path, pool)
+    else:
+        pool = None
+    #Usage changes as the subtask runs, so work out the priority afresh for each chunk
+    fair_share.apply_priority(subtask, chunk_file_path, subtask.get_queued_job_count())
+    cluster_id, number_of_jobs = condor_submit(chunk_file_path)
+    assert number_of_jobs == chunk_size
+    log.debug('Task %s, subtask %d: submitted jobs %d to %d as cluster %d' % (subtask.task.name, subtask.index, first_process, first_process + chunk_size - 1, cluster_id))
+    
+    with transaction.commit_on_success():
+        CondorJob.objects.filter(subtask=subtask, status='N', process_id__gte=first_process, process_id__lt=first_process + chunk_size).update(status='I',
+                                                                                                                                         cluster_id=cluster_id,
+                                                                                                                                         cluster_process_id=F('process_id') - first_process,
+                                                                                                                                         condor_pool=pool)
+        Subtask.objects.filter(id=subtask.id).update(unsubmitted_job_count=F('unsubmitted_job_count') - chunk_size,
+                                                     idle_job_count=F('idle_job_count') + chunk_size)
+        if subtask.cluster_id == None:
+            Subtask.objects.filter(id=subtask.id).update(cluster_id=cluster_id)
+    subtask.unsubmitted_job_count -= chunk_size
+    subtask.idle_job_count += chunk_size
+    if subtask.cluster_id == None:
+        subtask.cluster_id = cluster_id
+
+def submit_next_chunk(subtask, max_queued_jobs):
+    """Submit the next chunk of a subtask's jobs that haven't been submitted yet, keeping the number of its jobs
+    in the queue at or below max_queued_jobs. Returns the number of jobs submitted
+    """
+    remaining = subtask.unsubmitted_job_count
+    queued = subtask.idle_job_count + subtask.running_job_count + subtask.held_job_count
+    chunk_size = min(max_queued_jobs - queued, remaining)
+    #Avoid lots of small submissions - wait until there is room for a reasonably sized chunk
+    if chunk_size <= 0 or (chunk_size < remaining and chunk_size < max(max_queued_jobs / 4, 1)):
+        return 0
+    
+    submit_chunk(subtask, chunk_size)
+    return chunk_size
+
+def submit_federated_chunks(subtask, pools):
+    """Submit the next chunks of a subtask's jobs that haven't been submitted yet, split between the pools
+    in proportion to their throughput. Each pool's queue limit applies to the jobs queued on it.
+    Returns the number of jobs submitted
+    """
+    queued = federation.get_queued_jobs_by_pool(subtask)
+    jobs_submitted = 0
+    for pool, share in federation.get_chunk_shares(subtask, pools):
+        remaining = subtask.unsubmitted_job_count
+        if remaining <= 0:
+            break
+        max_queued_jobs = fair_share.get_queue_share(subtask, get_max_queued_jobs(pool), pool)
+        if max_queued_jobs <= 0:
+            max_queued_jobs = subtask.get_queued_job_count()
+        chunk_size = min(max_queued_jobs - queued.get(pool.id, 0), share, remaining)
+        #As for submit_next_chunk, wait until there is room on the pool for a reasonably sized chunk
+        if chunk_size <= 0 or (chunk_size < remaining and chunk_size < min(share, max(max_queued_jobs / 4, 1))):
+            continue
         try:
-            copasi_model_filename = copasi_model_filename_n % n
-        except:
-            copasi_model_filename = copasi_model_filename_n
+            submit_chunk(subtask, chunk_size, pool)
+        except Exception, e:
+            #Leave the jobs for the other pools
+            log.exception(e)
+            continue
+        log.debug('Task %s, subtask %d: %d jobs submitted to pool %s' % (subtask.task.name, subtask.index, chunk_size, pool.name))
+        jobs_submitted += chunk_size
+    return jobs_submitted
+
+def submit_pending_jobs():
+    """Submit the next chunk of jobs of any running subtasks that were too large to submit at once, or are
+    federated across several pools. Returns the number of subtasks with jobs still waiting to be submitted
+    """
+    subtasks = Subtask.objects.filter(status='running', task__status='running', unsubmitted_job_count__gt=0).select_related('task__condor_pool')
+    pending = 0
+    for subtask in subtasks:
         try:
-            job_output = job_output_n % n
-        except:
-            job_output = job_output_n
-
-        job = CondorJob(subtask=subtask,
-                        std_output_file = std_output_file,
-                        std_error_file = std_err_file,
-                        log_file = log_file,
-                        job_output = job_output, 
-                        status = 'I',
-                        process_id = n,
-                        run_time = 0.0,
-                        copasi_file = copasi_model_filename,
-                        )
-        job.save()
+            pools = federation.get_task_pools(subtask.task)
+            if len(pools) > 1:
+                jobs_submitted = submit_federated_chunks(subtask, pools)
+            else:
+                #Share the queue with the other users of the pool
+                max_queued_jobs = fair_share.get_queue_share(subtask, get_max_queued_jobs(subtask.task.condor_pool))
+                jobs_submitted = submit_next_chunk(subtask, max_queued_jobs if max_queued_jobs > 0 else subtask.unsubmitted_job_count)
+            metrics.increment('chunk_jobs_submitted', jobs_submitted)
+        except Exception, e:
+            log.exception(e)
+        if subtask.unsubmitted_job_count > 0:
+            pending += 1
+    return pending
+
+def get_subtask_cluster_ids(subtask):
+    """Return the condor cluster ids of all the subtask's jobs. There is more than one if the subtask was submitted in chunks
+    """
+    cluster_ids = set(CondorJob.objects.filter(subtask=subtask).exclude(cluster_id=None).values_list('cluster_id', flat=True))
+    if subtask.cluster_id != None:
+        cluster_ids.add(subtask.cluster_id)
+    return sorted(cluster_ids)
+
+def get_dag_node_name(subtask):
+    return 'subtask_%d' % subtask.index
+
+def submit_dag(subtasks):
+    """Submit a chain of prepared subtasks to the pool as a single condor DAG.
+    DAGMan submits each subtask as soon as the previous one has finished, without waiting for the daemon.
+    The subtasks are marked as queued. Their CondorJobs are created by process_dag_nodes once DAGMan has submitted them
+    """
+    assert len(subtasks) > 0
+    task = subtasks[0].task
+    
+    dag_lines = []
+    for subtask in subtasks:
+        assert isinstance(subtask, Subtask)
+        assert subtask.spec_file != ''
+        prepare_shared_log(subtask)
+        number_of_jobs = count_spec_jobs(os.path.join(task.directory, subtask.spec_file))
+        #The outputs of a subtask feeding a later node must be transferred back uncompressed, since DAGMan starts
+        #the next node before the daemon has had the chance to decompress them
+        if subtask == subtasks[-1]:
+            compression_tools.compress_job_transfers(subtask, number_of_jobs)
+        staging_tools.stage_shared_inputs(subtask, number_of_jobs)
+        fair_share.apply_priority(subtask, os.path.join(task.directory, subtask.spec_file), number_of_jobs)
+        max_queued_jobs = get_max_queued_jobs(task.condor_pool)
+        if getattr(settings, 'CONDOR_LATE_MATERIALIZATION', False) and max_queued_jobs > 0 and number_of_jobs > max_queued_jobs:
+            use_late_materialization(os.path.join(task.directory, subtask.spec_file), max_queued_jobs)
+        dag_lines.append('JOB %s %s' % (get_dag_node_name(subtask), subtask.spec_file))
+    for parent, child in zip(subtasks[:-1], subtasks[1:]):
+        dag_lines.append('PARENT %s CHILD %s' % (get_dag_node_name(parent), get_dag_node_name(child)))
+    
+    dag_file = 'auto_copasi_%d.dag' % subtasks[0].index
+    dag_file_handle = open(os.path.join(task.directory, dag_file), 'w')
+    dag_file_handle.write('\n'.join(dag_lines) + '\n')
+    dag_file_handle.close()
+    
+    output, error, exit_status = run_bosco_command([CONDOR_SUBMIT_DAG, '-force', dag_file], error=True, cwd=task.directory)
+    command_runner.clear_cache()
+    log.debug('Submitting DAG to condor. Output: ')
+    log.debug(output)
+    
+    #The DAGMan job itself is submitted as a single job cluster
+    r=re.compile(r'^(?P<n>\d+) job\(s\) submitted to cluster (?P<cluster>\d+).*')
+    dag_cluster_id = None
+    for line in output:
+        match = r.match(line)
+        if match:
+            dag_cluster_id = int(match.group('cluster'))
+    
+    if exit_status != 0 or dag_cluster_id == None:
+        log.error('Failed to submit DAG')
+        log.error(output)
+        log.error(error)
+        raise Exception('Failed to submit DAG %s' % dag_file)
+    
+    log.debug('DAGMan cluster id %d' % dag_cluster_id)
+    
+    for subtask in subtasks:
+        subtask.set_custom_field('dag_file', dag_file)
+        subtask.set_custom_field('dag_cluster_id', dag_cluster_id)
+        subtask.status = 'queued'
+        subtask.save()
+
+def process_dag_nodes():
+    """Look for subtasks queued in a DAG that DAGMan has now submitted, and start tracking their CondorJobs.
+    Subtasks whose DAGMan job has left the queue without submitting them are marked as errored.
+    Returns the number of subtasks still queued
+    """
+    queued_subtasks = list(Subtask.objects.filter(status='queued').select_related('task'))
+    if len(queued_subtasks) == 0:
+        return 0
+    
+    dag_cluster_ids = set([subtask.get_custom_field('dag_cluster_id') for subtask in queued_subtasks])
+    running_dag_cluster_ids = set([cluster_id for cluster_id, process_id, status, run_time, job_starts in read_condor_q_clusters(dag_cluster_ids) if status != 'C' and status != 'X'])
+    
+    still_queued = 0
+    started_logs = set()
+    queued_logs = set()
+    for subtask in queued_subtasks:
+        #DAGMan writes the events of every node job to the default node log, <dag file>.nodes.log
+        nodes_log_path = os.path.join(subtask.task.directory, subtask.get_custom_field('dag_file') + '.nodes.log')
+        reader = condor_log_tools.get_reader(nodes_log_path)
+        cluster_id = reader.get_dag_node_cluster_id(get_dag_node_name(subtask))
         
-    subtask.status='running'
-    subtask.start_time = now()
-    subtask.save()
+        if cluster_id != None:
+            number_of_jobs = count_spec_jobs(os.path.join(subtask.task.directory, subtask.spec_file))
+            log.debug('Task %s, subtask %d: submitted by DAGMan with cluster id %d' % (subtask.task.name, subtask.index, cluster_id))
+            start_subtask_jobs(subtask, cluster_id, number_of_jobs)
+            started_logs.add(nodes_log_path)
+        elif subtask.get_custom_field('dag_cluster_id') not in running_dag_cluster_ids:
+            #E.g. a previous node in the DAG failed, or the DAG was removed
+            log.debug('Task %s, subtask %d: DAGMan exited without submitting subtask. Marking as error' % (subtask.task.name, subtask.index))
+            subtask.status = 'error'
+            subtask.finish_time = now()
+            subtask.save()
+            Task.objects.filter(id=subtask.task_id, status='running').update(status='error', last_update_time=now())
+        else:
+            still_queued += 1
+            queued_logs.add(nodes_log_path)
+    
+    for nodes_log_path in started_logs - queued_logs:
+        condor_log_tools.forget(nodes_log_path)
+    
+    return still_queued
 
 def remove_task(subtask):
     """Call condor_rm on the condor jobs belonging to a subtask
     """
     assert isinstance(subtask, Subtask)
+    
+    #Removing the DAGMan job also removes any subtasks it has yet to submit
+    dag_cluster_id = subtask.get_custom_field('dag_cluster_id')
+    if dag_cluster_id != None and subtask.status in ['queued', 'running', 'error']:
+        log.debug('Removing DAG with cluster id %s from condor_q' % dag_cluster_id)
+        try:
+            run_bosco_command([CONDOR_RM, str(dag_cluster_id)], error=True)
+        except Exception, e:
+            log.exception(e)
+    
     if subtask.status == 'running' or subtask.status == 'error':
-        log.debug('Removing subtask with cluster id %s from condor_q' % subtask.cluster_id)
+        cluster_ids = get_subtask_cluster_ids(subtask)
+        log.debug('Removing subtask with cluster ids %s from condor_q' % cluster_ids)
         try:
-            output, error, exit_status = run_bosco_command([CONDOR_RM, str(subtask.cluster_id)], error=True)
+            output, error, exit_status = run_bosco_command([CONDOR_RM] + [str(cluster_id) for cluster_id in cluster_ids], error=True)
+            command_runner.clear_cache()
             assert exit_status == 0 
             return output, error, exit_status
 
@@ -252,50 +701,68 @@ def remove_task(subtask):
         try:
             for job in subtask.condorjob_set.all():
                 job.delete()
+            subtask.update_job_counters()
         except Exception, e:
             log.exception(e)
     else:
         return (None, None, None)
     
-def read_condor_q():
-    
-    """Execute the condor_q command and process the output
-    Returns a list of tuples of the form (cluster_id, process_id, status)
-    where status is a single lettter, e.g. I, R, H, X
+#Map the numeric JobStatus ClassAd attribute to the single letter codes used by condor_q
+#1=Idle, 2=Running, 3=Removed, 4=Completed, 5=Held, 6=Transferring output, 7=Suspended
+JOB_STATUS_CODES = {
+                    1: 'I',
+                    2: 'R',
+                    3: 'X',
+                    4: 'C',
+                    5: 'H',
+                    6: 'R',
+                    7: 'I',
+                    }
+
+CONDOR_Q_ATTRIBUTES = ['ClusterId', 'ProcId', 'JobStatus', 'RemoteWallClockTime', 'NumJobStarts']
+
+def read_condor_q_clusters(cluster_ids):
+    """Execute condor_q for the specified cluster ids only, asking for projected ClassAd attributes
+    rather than the human readable table.
+    Returns a list of tuples of the form (cluster_id, process_id, status, run_time, job_starts)
+    where status is a single letter, e.g. I, R, H, X, or None if condor reported a status we don't know,
+    run_time is the cumulative wall clock time in days and job_starts is the number of times the job has been started
     """
     
+    cluster_ids = sorted(set([int(cluster_id) for cluster_id in cluster_ids if cluster_id != None]))
+    if len(cluster_ids) == 0:
+        return []
     
-    
-    condor_q_output, error, exit_status = run_bosco_command([CONDOR_Q], error=True)
+    command = [CONDOR_Q] + [str(cluster_id) for cluster_id in cluster_ids] + ['-autoformat'] + CONDOR_Q_ATTRIBUTES
+    #condor_q is read-only, so the output can be reused for a short time
+    condor_q_output, error, exit_status = run_bosco_command(command, error=True, cache_time=getattr(settings, 'BOSCO_QUERY_CACHE_TIME', 5))
     
     assert exit_status == 0
     
-    #Process the output using regexps. Example line is as follows:
-    # ID      OWNER            SUBMITTED     RUN_TIME ST PRI SIZE CMD               
-    #18756.0   ed              1/7  11:45   0+03:19:53 R  0   22.0 CopasiSE.$$(OpSys)
-    condor_q=[]
-    no_of_jobs = len(condor_q_output) - 6
-    if no_of_jobs > 0:
-        job_string = r'\s*(?P<cluster_id>\d+)\.(?P<process_id>\d+)\s+(?P<owner>\S+)\s+(?P<sub_date>\S+)\s+(?P<sub_time>\S+)\s+(?P<run_time>\S+)\s+(?P<status>\w)\s+(?P<pri>\d+)\s+(?P<size>\S+)\s+(?P<cmd>\S+)'
-        job_re = re.compile(job_string)
-        for job_listing in condor_q_output:
-            match = job_re.match(job_listing)
-            if match:
-                cluster_id = int(match.group('cluster_id'))
-                process_id = int(match.group('process_id'))
-
-                owner = match.group('owner')
-                sub_date = match.group('sub_date')
-                sub_time = match.group('sub_time')
-                run_time = match.group('run_time')
-                status = match.group('status')
-                pri = match.group('pri')
-                size=match.group('size')
-                cmd=match.group('cmd')
-                
-                condor_q.append((cluster_id, process_id,status))
-
-    
+    #Each line contains the attributes in the order requested, separated by spaces, e.g.
+    #18756 0 2 1203.0 1
+    #Attributes that are not defined for a job are printed as 'undefined'
+    condor_q = []
+    for job_listing in condor_q_output:
+        fields = job_listing.split()
+        if len(fields) != len(CONDOR_Q_ATTRIBUTES):
+            continue
+        try:
+            cluster_id = int(fields[0])
+            process_id = int(fields[1])
+            status = JOB_STATUS_CODES.get(int(fields[2]))
+        except ValueError:
+            continue
+        try:
+            run_time = float(fields[3]) / 86400.0
+        except ValueError:
+            run_time = 0.0
+        try:
+            job_starts = int(fields[4])
+        except ValueError:
+            job_starts = 0
+        
+        condor_q.append((cluster_id, process_id, status, run_time, job_starts))
     
     return condor_q
 
@@ -304,77 +771,166 @@ def process_condor_q(user=None, subtask=None):
     If specified we can narrow down to a specific user or subtask
     
     Note: this method only updates the status of CondorJob objects. It does not update any upstream subtask or task changes. this is performed in task_tools
+    Returns the number of jobs that were marked as still running, plus the number of subtasks still queued in a DAG
     """
     
     #Next, get a list of all condor jobs we think are still running
     #Status will be 'I', 'R', 'H'
+    #Pull in the subtask and task in the same query, since we need the cluster id and directory for every job
     
-    condor_jobs = CondorJob.objects.filter(status='I') | CondorJob.objects.filter(status='R') | CondorJob.objects.filter(status='H')
+    condor_jobs = CondorJob.objects.filter(status__in=['I', 'R', 'H']).select_related('subtask__task')
     
     if user:
         condor_jobs = condor_jobs.filter(subtask__task__user=user)
     if subtask:
         condor_jobs = condor_jobs.filter(subtask=subtask)
     
+    #Start tracking any subtasks that DAGMan has submitted since the last poll
+    queued_subtask_count = 0
+    if not user and not subtask:
+        queued_subtask_count = process_dag_nodes()
+    
+    condor_jobs = list(condor_jobs)
+    metrics.increment('jobs_checked', len(condor_jobs))
     
     if len(condor_jobs) == 0:
         #log.debug('No jobs marked as running. Not checking condor_q')
-        pass
+        return queued_subtask_count
         
-    else:
-        #log.debug('Reading condor_q')
-        condor_q = read_condor_q()
+    #log.debug('Reading condor_q')
+    #Only ask the schedd about the clusters our subtasks own
+    condor_q = read_condor_q_clusters([job.get_cluster_id() for job in condor_jobs])
+    
+    #Index the queue by (cluster_id, process_id)
+    #Skip if state == 'C' or 'X' -- means complete, so just assume not in the queue
+    #The run time is only stored once a job leaves the queue, from its log, so that the jobs still in the queue
+    #can be updated in bulk. The wall clock time reported while in the queue isn't needed
+    queue_index = {}
+    for cluster_id, process_id, status, run_time, job_starts in condor_q:
+        if status != 'C' and status != 'X':
+            queue_index[(cluster_id, process_id)] = (status, job_starts)
+    
+    #Remember the original status and run time of each job so we can update the subtask job counters
+    original_state = dict([(job.id, (job.status, job.run_time or 0.0)) for job in condor_jobs])
+    
+    #Jobs whose status has changed, grouped by the new status
+    status_changes = {}
+    #Jobs that have finished with a run time, grouped by the new status and run time
+    run_time_changes = {}
+    
+    for job in condor_jobs:
+        cluster_id, cluster_process_id = job.get_cluster_id(), job.get_cluster_process_id()
+        queue_entry = queue_index.get((cluster_id, cluster_process_id))
+        if queue_entry != None:
+            status, job_starts = queue_entry
+            #Keep the last known status if condor reported one we don't know
+            if status == None:
+                status = job.status
+            if job_starts > 1 and status != job.status:
+                log.debug('Job %d.%d has been started %d times' % (cluster_id, cluster_process_id, job_starts))
+            if status != job.status:
+                job.status = status
+                status_changes.setdefault(status, []).append(job.id)
+            continue
         
+        #If not in the queue, then the job must have finished running. Change the status accordingly
+        #TODO: At some point we need to validate the job based on the log file
+        log.debug('Job %d.%d (Task %s) not in queue. Checking log' % (cluster_id, cluster_process_id, job.subtask.task.name))
         
-        for job in condor_jobs:
-            in_q = False
-            for cluster_id, process_id, status in condor_q:
-                if (status != 'C' and status != 'X') and process_id == job.process_id and cluster_id == job.subtask.cluster_id:
-                    #Skip if state == 'C' -- means complete, so just assume not in the queue
-                    in_q = True
-                    job.status = status
-                    job.save()
-            if not in_q:
-                #If not in the queue, then the job must have finished running. Change the status accordingly
-                #TODO: At some point we need to validate the job based on the log file
-                log.debug('Job %d.%d (Task %s) not in queue. Checking log' % (job.subtask.cluster_id, job.process_id, job.subtask.task.name))
-                
-                log_path = os.path.join(job.subtask.task.directory, job.log_file)
-                condor_log = condor_log_tools.Log(log_path)
+        log_path = os.path.join(job.subtask.task.directory, job.log_file)
+        #Only events appended since the last cycle are parsed
+        #The log may be shared by every job in the cluster, so only look at the events for this job
+        condor_log = condor_log_tools.get_log(log_path, cluster_id, cluster_process_id)
+        
+        if condor_log.has_terminated:
+            if condor_log.has_aborted:
+                #Removed from the queue before it finished, e.g. with condor_rm
+                log.debug('Log indicates job was aborted. Marking job as error')
+                job.status = 'E'
+                status_changes.setdefault('E', []).append(job.id)
+            elif condor_log.termination_status == 0:
+                #Outputs compressed for the transfer back are decompressed before anything reads them
+                compression_tools.decompress_job_outputs(job)
+                log.debug('Log indicates normal termination. Checking output files exist')
                 
-                if condor_log.has_terminated:
-                    if condor_log.termination_status == 0:
-                        log.debug('Log indicates normal termination. Checking output files exist')
-                        
-                        if job.job_output != '' and job.job_output != None:
-                            output_filename = os.path.join(job.subtask.task.directory, job.job_output)
-                            
-                            if os.path.isfile(output_filename):
-                                try:
-                                    assert os.path.getsize(output_filename) > 0
-                                    try:
-                                        run_time =  condor_log.running_time_in_days
-                                        job.run_time = run_time
-                                        run_time_minutes = run_time * 24 * 60
-                                    except:
-                                        run_time_minutes = None
-                                    log.debug('Job output exists and is nonempty. Marking job as finished with run time %s minutes' % run_time_minutes)
-                                    job.status = 'F'
-                                except:
-                                    log.debug('Job output exists but is empty. Leaving status as running')
-                            else:
-                                log.debug('Output file does not exist. Leaving status as running')
-                        
-                        else:
-                            log.debug('Job has no output specified. Assuming job has finished.')
+                if job.job_output != '' and job.job_output != None:
+                    output_filename = os.path.join(job.subtask.task.directory, job.job_output)
+                    
+                    if os.path.isfile(output_filename):
+                        try:
+                            assert os.path.getsize(output_filename) > 0
+                            try:
+                                run_time =  condor_log.running_time_in_days
+                                job.run_time = run_time
+                                run_time_minutes = run_time * 24 * 60
+                            except:
+                                run_time = None
+                                run_time_minutes = None
+                            log.debug('Job output exists and is nonempty. Marking job as finished with run time %s minutes' % run_time_minutes)
                             job.status = 'F'
+                            if run_time == None:
+                                status_changes.setdefault('F', []).append(job.id)
+                            else:
+                                run_time_changes.setdefault(('F', run_time), []).append(job.id)
+                        except:
+                            log.debug('Job output exists but is empty. Leaving status as running')
                     else:
-                        log.debug('Log indicates abnormal termination. Marking job as error')
-                        job.status = 'E'
+                        log.debug('Output file does not exist. Leaving status as running')
+                
                 else:
-                    #log.debug('Log indicates job not terminated. Leaving status as running')
-                    pass
-                job.save()
+                    log.debug('Job has no output specified. Assuming job has finished.')
+                    job.status = 'F'
+                    status_changes.setdefault('F', []).append(job.id)
+            else:
+                log.debug('Log indicates abnormal termination. Marking job as error')
+                job.status = 'E'
+                status_changes.setdefault('E', []).append(job.id)
+        else:
+            #log.debug('Log indicates job not terminated. Leaving status as running')
+            pass
+    
+    #Work out the changes to the subtask job counters
+    counter_changes = {}
+    for job in condor_jobs:
+        original_status, original_run_time = original_state[job.id]
+        run_time = job.run_time or 0.0
+        if job.status == original_status and run_time == original_run_time:
+            continue
+        changes = counter_changes.setdefault(job.subtask_id, {})
+        if job.status != original_status:
+            for status, change in ((original_status, -1), (job.status, 1)):
+                field = Subtask.job_counter_fields.get(status)
+                if field:
+                    changes[field] = changes.get(field, 0) + change
+        if run_time != original_run_time:
+            changes['job_run_time'] = changes.get('job_run_time', 0.0) + run_time - original_run_time
+    
+    #Write back only the rows that changed, together with the job counters, in a single transaction
+    #Only finished jobs with different run times need separate updates
+    rows_updated = 0
+    with transaction.commit_on_success():
+        for status, job_ids in status_changes.items():
+            rows_updated += CondorJob.objects.filter(id__in=job_ids).update(status=status)
+        for (status, run_time), job_ids in run_time_changes.items():
+            rows_updated += CondorJob.objects.filter(id__in=job_ids).update(status=status, run_time=run_time)
+        for subtask_id, changes in counter_changes.items():
+            rows_updated += Subtask.objects.filter(id=subtask_id).update(**dict([(field, F(field) + change) for field, change in changes.items()]))
+    metrics.increment('jobs_reconciled', sum([len(job_ids) for job_ids in status_changes.values() + run_time_changes.values()]))
+    metrics.increment('rows_updated', rows_updated)
+    
+    #Stop tracking the logs of jobs that have left the queue for good, unless still shared with an active job
+    active_logs = set()
+    finished_logs = set()
+    for job in condor_jobs:
+        log_path = os.path.join(job.subtask.task.directory, job.log_file)
+        if job.status == 'F' or job.status == 'E':
+            finished_logs.add(log_path)
+        else:
+            active_logs.add(log_path)
+    for log_path in finished_logs - active_logs:
+        condor_log_tools.forget(log_path)
+    
+    return len(condor_jobs) + queued_subtask_count
 
 def cancel_task(task):
     #TODO: implement this method
@@ -0,0 +1,102 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Fair-share scheduling between the users of a pool
+#A pool and its shared copies (see CondorPool.copy_of) are submitted to through the same condor user, so condor
+#can't tell Cloud-COPASI users apart. Instead, each subtask is submitted with a job priority based on the compute
+#time its user and task have used on the pool recently, with a bonus for small tasks so that they finish quickly.
+#Subtasks submitted in chunks also only get their share of the queue when several users are running tasks on the pool
+
+import math, datetime, re
+from cloud_copasi import settings
+from cloud_copasi.web_interface.models import CondorPool, Task, Subtask
+from django.db.models import Q, Sum
+from django.utils.timezone import now
+import logging
+
+log = logging.getLogger(__name__)
+
+#The job priority is kept within these bounds
+MIN_PRIORITY = -20
+MAX_PRIORITY = 20
+
+priority_re = re.compile(r'^priority\s*=.*$\n?', re.MULTILINE | re.IGNORECASE)
+queue_re = re.compile(r'^\s*queue\b.*$', re.MULTILINE | re.IGNORECASE)
+
+def is_enabled():
+    return getattr(settings, 'FAIR_SHARE_SCHEDULING', False)
+
+def get_pool_family(pool):
+    """Return the ids of the pool, the pool it's a copy of, and all the other copies of that pool
+    """
+    original_id = pool.copy_of_id or pool.id
+    return list(CondorPool.objects.filter(Q(id=original_id) | Q(copy_of=original_id)).values_list('id', flat=True))
+
+def get_recent_usage(user, pool_ids):
+    """Return the compute time in hours used by the user's subtasks started on the pools within the last FAIR_SHARE_WINDOW days
+    """
+    since = now() - datetime.timedelta(days=getattr(settings, 'FAIR_SHARE_WINDOW', 7))
+    usage = Subtask.objects.filter(task__user=user, task__condor_pool__in=pool_ids, start_time__gte=since).aggregate(usage=Sum('job_run_time'))['usage']
+    return (usage or 0.0) * 24
+
+def get_task_usage(task):
+    """Return the compute time in hours used by the task so far
+    """
+    usage = Subtask.objects.filter(task=task).aggregate(usage=Sum('job_run_time'))['usage']
+    return (usage or 0.0) * 24
+
+def get_usage_penalty(hours):
+    #Halve the priority weight for every doubling of the compute time used
+    return int(math.log(1 + hours / getattr(settings, 'FAIR_SHARE_USAGE_UNIT', 1.0), 2))
+
+def get_job_priority(subtask, number_of_jobs):
+    """Return the condor job priority for the jobs of a subtask. Higher priority jobs run first
+    """
+    task = subtask.task
+    pool_ids = get_pool_family(task.condor_pool)
+    priority = -get_usage_penalty(get_recent_usage(task.user, pool_ids))
+    priority -= get_usage_penalty(get_task_usage(task))
+    if number_of_jobs <= getattr(settings, 'FAIR_SHARE_SMALL_TASK_JOBS', 100):
+        priority += getattr(settings, 'FAIR_SHARE_SMALL_TASK_PRIORITY', 10)
+    return max(MIN_PRIORITY, min(priority, MAX_PRIORITY))
+
+def set_spec_priority(spec_file_path, priority):
+    """Set the priority of the jobs in the spec file, replacing any existing priority
+    """
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+
+    spec_string = priority_re.sub('', spec_string)
+    spec_string = queue_re.sub(lambda match: 'priority = %d\n%s' % (priority, match.group(0)), spec_string, count=1)
+
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
+
+def apply_priority(subtask, spec_file_path, number_of_jobs):
+    """If fair-share scheduling is enabled, set the priority of the jobs in the spec file for the subtask
+    """
+    if not is_enabled() or subtask.task.condor_pool == None:
+        return
+    priority = get_job_priority(subtask, number_of_jobs)
+    log.debug('Task %s, subtask %d: submitting with priority %d' % (subtask.task.name, subtask.index, priority))
+    set_spec_priority(spec_file_path, priority)
+
+def get_queue_share(subtask, max_queued_jobs, pool=None):
+    """Return the number of jobs the subtask may have in the queue, when the pool's queue limit is shared equally
+    between the users running tasks on the pool. The pool is the task's own pool unless given
+    """
+    if pool == None:
+        pool = subtask.task.condor_pool
+    if not is_enabled() or max_queued_jobs <= 0 or pool == None:
+        return max_queued_jobs
+    pool_ids = get_pool_family(pool)
+    user_count = Task.objects.filter(status='running', condor_pool__in=pool_ids).values('user').distinct().count()
+    return max(max_queued_jobs / max(user_count, 1), 1)
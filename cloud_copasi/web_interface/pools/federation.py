@@ -0,0 +1,138 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Federation of the jobs of a task across several of a user's pools
+#As well as its own pool, a task can be given additional pools to run on (the federated_pools custom field).
+#The jobs of each subtask are then submitted in chunks (see condor_tools.submit_federated_chunks), and split
+#between the pools by their throughput. Every pool is reached through the local Bosco schedd, so the only
+#difference between the chunks is the grid resource they are submitted to. Each CondorJob records its pool
+
+import re, math, datetime
+from cloud_copasi import settings
+from cloud_copasi.web_interface.models import CondorPool, CondorJob
+from django.db.models import Count, Sum, Q
+from django.utils.timezone import now
+import logging
+
+log = logging.getLogger(__name__)
+
+#The number of finished jobs a pool needs in a subtask before its throughput is measured from the subtask itself
+MIN_THROUGHPUT_SAMPLES = 10
+
+grid_resource_re = re.compile(r'^grid_resource\s*=.*$', re.MULTILINE)
+
+def is_compatible(primary_pool, pool):
+    """Return True if jobs prepared for primary_pool can also be run on pool
+    """
+    #Jobs prepared for an EC2 pool expect COPASI to be installed on the workers rather than transferred with the job
+    return primary_pool.get_pool_type() != 'ec2' or pool.get_pool_type() == 'ec2'
+
+def get_task_pools(task):
+    """Return the pools the jobs of the task are run on: its own pool, followed by any compatible additional pools
+    """
+    if task.condor_pool == None:
+        return []
+    pools = [task.condor_pool]
+    pool_ids = task.get_custom_field('federated_pools')
+    if not pool_ids:
+        return pools
+    for pool in CondorPool.objects.filter(id__in=pool_ids, user=task.user).exclude(id=task.condor_pool_id).order_by('id'):
+        if is_compatible(task.condor_pool, pool):
+            pools.append(pool)
+        else:
+            log.debug('Task %s: pool %s is not compatible with %s. Not using it' % (task.name, pool.name, task.condor_pool.name))
+    return pools
+
+def is_federated(task):
+    return len(get_task_pools(task)) > 1
+
+def get_pool_throughput(pool):
+    """Return the number of jobs per hour the pool has completed in recently finished subtasks, or None if not known.
+    Jobs are counted by the pool they ran on, including the jobs of federated tasks whose own pool is another one.
+    A pool can't have been busy with a subtask for longer than the total run time of its jobs, so if it finished
+    its share early, it isn't penalised for the time the subtask spent waiting on the other pools
+    """
+    since = now() - datetime.timedelta(days=getattr(settings, 'FEDERATION_THROUGHPUT_WINDOW', 30))
+    #Jobs with no pool recorded ran on their task's own pool
+    jobs = CondorJob.objects.filter(Q(condor_pool=pool) | Q(condor_pool__isnull=True, subtask__task__condor_pool=pool))
+    jobs = jobs.filter(status='F', subtask__status='finished', subtask__finish_time__gte=since, subtask__start_time__isnull=False)
+    rows = jobs.order_by('-subtask__finish_time').values('subtask', 'subtask__start_time', 'subtask__finish_time').annotate(count=Count('id'), job_run_time=Sum('run_time'))
+    job_count = 0
+    hours = 0.0
+    for row in rows[:20]:
+        wall_hours = (row['subtask__finish_time'] - row['subtask__start_time']).total_seconds() / 3600.0
+        if row['job_run_time']:
+            wall_hours = min(wall_hours, row['job_run_time'] * 24)
+        job_count += row['count']
+        hours += wall_hours
+    if job_count == 0 or hours <= 0:
+        return None
+    return job_count / hours
+
+def get_pool_weights(subtask, pools):
+    """Return the fraction of the subtask's jobs each pool should run, in proportion to its throughput.
+    Once every pool has finished enough of the subtask's jobs, the throughput is measured from the subtask itself,
+    otherwise from each pool's recent subtasks. If neither is known, the jobs are split equally
+    """
+    primary_pool_id = subtask.task.condor_pool_id
+    finished = {}
+    for row in CondorJob.objects.filter(subtask=subtask, status='F').order_by().values('condor_pool').annotate(count=Count('id')):
+        pool_id = row['condor_pool'] or primary_pool_id
+        finished[pool_id] = finished.get(pool_id, 0) + row['count']
+
+    throughputs = None
+    if subtask.start_time != None and min([finished.get(pool.id, 0) for pool in pools]) >= MIN_THROUGHPUT_SAMPLES:
+        hours = (now() - subtask.start_time).total_seconds() / 3600.0
+        if hours > 0:
+            throughputs = [finished[pool.id] / hours for pool in pools]
+    if throughputs == None:
+        throughputs = [get_pool_throughput(pool) for pool in pools]
+        if None in throughputs:
+            throughputs = [1.0] * len(pools)
+
+    total = sum(throughputs)
+    if total <= 0:
+        return [1.0 / len(pools)] * len(pools)
+    return [throughput / total for throughput in throughputs]
+
+def get_queued_jobs_by_pool(subtask):
+    """Return the number of the subtask's jobs in the queue on each pool, indexed by pool id
+    """
+    primary_pool_id = subtask.task.condor_pool_id
+    queued = {}
+    for row in CondorJob.objects.filter(subtask=subtask, status__in=['I', 'R', 'H']).order_by().values('condor_pool').annotate(count=Count('id')):
+        pool_id = row['condor_pool'] or primary_pool_id
+        queued[pool_id] = queued.get(pool_id, 0) + row['count']
+    return queued
+
+def get_chunk_shares(subtask, pools):
+    """Split the subtask's remaining unsubmitted jobs between the pools by throughput.
+    Returns a list of (pool, number of jobs), largest share first
+    """
+    remaining = subtask.unsubmitted_job_count
+    weights = get_pool_weights(subtask, pools)
+    shares = [[pool, int(math.floor(remaining * weight))] for pool, weight in zip(pools, weights)]
+    shares.sort(key=lambda share: -share[1])
+    #Rounding down leaves a few jobs over. Give them to the largest share, so that the shares add up to the remaining jobs
+    if len(shares) > 0:
+        shares[0][1] += remaining - sum([share[1] for share in shares])
+    return [(pool, share) for pool, share in shares]
+
+def retarget_spec(spec_file_path, pool):
+    """Rewrite the spec file to submit its jobs to pool
+    """
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+
+    spec_string = grid_resource_re.sub('grid_resource = batch %s %s' % (pool.pool_type, pool.address), spec_string, count=1)
+
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
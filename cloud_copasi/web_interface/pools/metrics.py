@@ -0,0 +1,170 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Timing metrics for the background daemon
+#Kept with the pool tools it instruments, so that they needn't depend on the background daemon package
+#Each phase of the daemon records its wall time, the number of database queries it made, and any counters
+#incremented while it was running (e.g. jobs reconciled, log files read). Samples are kept as rolling histograms
+#and periodically written to a JSON file, which can be summarised with the daemon_metrics management command
+
+import time, json, os, threading, tempfile
+from collections import deque
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.util import CursorWrapper
+from cloud_copasi import settings
+import logging
+
+log = logging.getLogger(__name__)
+
+#The number of samples kept for each metric
+HISTORY_SIZE = 1000
+
+def get_metrics_file():
+    return getattr(settings, 'DAEMON_METRICS_FILE', os.path.join(settings.LOG_DIR, 'daemon_metrics.json'))
+
+class Histogram(object):
+    """Rolling histogram of the last HISTORY_SIZE samples of a metric
+    """
+    def __init__(self, size=HISTORY_SIZE):
+        self.samples = deque(maxlen=size)
+        self.total_count = 0
+        self.last = None
+
+    def add(self, value):
+        self.samples.append(value)
+        self.total_count += 1
+        self.last = value
+
+    def percentile(self, sorted_samples, percent):
+        index = int(round((percent / 100.0) * (len(sorted_samples) - 1)))
+        return sorted_samples[index]
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if len(samples) == 0:
+            return {'count': 0, 'total_count': self.total_count}
+        return {
+                'count': len(samples),
+                'total_count': self.total_count,
+                'last': self.last,
+                'mean': sum(samples) / float(len(samples)),
+                'min': samples[0],
+                'p50': self.percentile(samples, 50),
+                'p90': self.percentile(samples, 90),
+                'p99': self.percentile(samples, 99),
+                'max': samples[-1],
+                }
+
+_histograms = {}
+_lock = threading.Lock()
+#The counters of the phase running in the current thread, if any
+_current = threading.local()
+
+def record(name, value):
+    """Add a sample to the named histogram
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram == None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(value)
+
+def increment(name, value=1):
+    """Add value to the named counter of the phase running in this thread. Does nothing outside a phase
+    """
+    counters = getattr(_current, 'counters', None)
+    if counters != None:
+        counters[name] = counters.get(name, 0) + value
+
+class QueryCountingCursor(object):
+    """Wraps a database cursor to count the statements executed through it as the phase's db_queries counter.
+    Unlike Django's debug cursor, the SQL isn't formatted or kept, so this adds almost nothing to large bulk writes
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        increment('db_queries')
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        increment('db_queries')
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def run_phase(name, function):
+    """Run function as the named daemon phase, and record its wall time, database queries and counters.
+    Returns the return value of function
+    """
+    counters = {'db_queries': 0}
+    _current.counters = counters
+
+    #Count the queries made on this thread's connection while the phase is running. The connection hands out
+    #the cursor from make_debug_cursor when use_debug_cursor is set, so that is replaced with a counting cursor
+    connection = connections[DEFAULT_DB_ALIAS]
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: QueryCountingCursor(CursorWrapper(cursor, connection))
+
+    start_time = time.time()
+    try:
+        return function()
+    finally:
+        record('%s.wall_time' % name, time.time() - start_time)
+        for counter, value in counters.items():
+            record('%s.%s' % (name, counter), value)
+
+        connection.use_debug_cursor = use_debug_cursor
+        del connection.make_debug_cursor
+        _current.counters = None
+
+def get_summaries():
+    with _lock:
+        return dict([(name, histogram.summary()) for name, histogram in _histograms.items()])
+
+def write_metrics(path=None):
+    """Write a summary of each histogram to the metrics file. The file is replaced atomically
+    """
+    if path == None:
+        path = get_metrics_file()
+    if not path:
+        return
+
+    data = {
+            'updated': time.time(),
+            'pid': os.getpid(),
+            'metrics': get_summaries(),
+            }
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.daemon_metrics')
+        temp_file = os.fdopen(handle, 'w')
+        try:
+            json.dump(data, temp_file, indent=1, sort_keys=True)
+        finally:
+            temp_file.close()
+        os.rename(temp_path, path)
+    except Exception, e:
+        log.debug('Could not write daemon metrics: %s' % str(e))
+
+def read_metrics(path=None):
+    """Read the metrics file written by the daemon
+    """
+    if path == None:
+        path = get_metrics_file()
+    metrics_file = open(path, 'r')
+    try:
+        return json.load(metrics_file)
+    finally:
+        metrics_file.close()
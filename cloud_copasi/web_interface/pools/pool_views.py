@@ -21,12 +21,12 @@ import sys
 from django.contrib.auth.forms import PasswordChangeForm
 from cloud_copasi.web_interface.aws import vpc_tools, aws_tools, ec2_tools,\
     ec2_config
-from cloud_copasi.web_interface.pools import condor_tools
+from cloud_copasi.web_interface.pools import condor_tools, command_runner
 from cloud_copasi.web_interface import models
 from boto.exception import EC2ResponseError, BotoServerError
 from cloud_copasi.web_interface.models import VPC
 import logging
-import tempfile, subprocess
+import tempfile, subprocess, json
 from django.core.validators import RegexValidator
 import os
 from django.forms.forms import NON_FIELD_ERRORS
@@ -688,6 +688,11 @@ class AddBoscoPoolForm(forms.Form):
                                        label='Pool status page',
                                        help_text='Optional link to a status page for the pool to be displayed alongside the pool information')
 
+    max_queued_jobs = forms.IntegerField(required=False,
+                                         min_value=0,
+                                         label='Maximum queued jobs per subtask',
+                                         help_text='Optional. The maximum number of jobs of a subtask to have in the queue at once. Larger subtasks are submitted in chunks. Leave blank to use the server default, or 0 for no limit.')
+
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user')
         return super(AddBoscoPoolForm, self).__init__(*args, **kwargs)
@@ -698,7 +703,8 @@ class AddBoscoPoolForm(forms.Form):
         
         address = cleaned_data.get('address')
         username = cleaned_data.get('username')
-        if BoscoPool.objects.filter(name=name,user=self.user).count() > 0:
+        #A pool that couldn't be added is replaced when adding it again
+        if BoscoPool.objects.filter(name=name,user=self.user).exclude(add_status='failed').count() > 0:
             raise forms.ValidationError('A pool with this name already exists')
         
         return cleaned_data
@@ -718,7 +724,7 @@ class BoscoPoolAddView(RestrictedFormView):
         
         kwargs['show_loading_screen'] = True
         kwargs['loading_title'] = 'Connecting to pool'
-        kwargs['loading_description'] = 'Please do not navigate away from this page. Connecting to a pool can take several minutes.'
+        kwargs['loading_description'] = 'Please do not navigate away from this page while the SSH credentials are checked.'
         
         return super(BoscoPoolAddView, self).dispatch(*args, **kwargs)
 
@@ -758,42 +764,61 @@ class BoscoPoolAddView(RestrictedFormView):
             return self.form_invalid(self, *args, **kwargs)
         
         #Assume the SSH credentails are good
-        #Next, we try to add the pool using bosco_cluster --add
-        
-        ##Only do this if no other pools exist with the same address!
-        
-        if BoscoPool.objects.filter(address = username + '@' + address).count() == 0:
-            output, errors, exit_status = condor_tools.add_bosco_pool(form.cleaned_data['platform'], username+'@'+address, ssh_key_filename, form.cleaned_data['pool_type'])
-        
-            if exit_status != 0:
-                os.remove(ssh_key_filename)
-    
-                form._errors[NON_FIELD_ERRORS] = ErrorList(['There was an error adding the pool'] + output + errors)
-                
-                try:
-                    log.debug('Error adding pool. Attempting to remove from bosco_cluster')
-                    condor_tools.remove_bosco_pool(username+'@'+address)
-                except:
-                    pass
-                
-                return self.form_invalid(self, *args, **kwargs)
-        else:
-            log.debug('Adding new bosco pool %s to db, skipping bosco_cluster --add because it already exists ' % (username + '@' + address))
-        
-        #Assume everything went well
-        os.remove(ssh_key_filename)
-        
+        BoscoPool.objects.filter(name=form.cleaned_data['name'], user=self.request.user, add_status='failed').delete()
         pool = BoscoPool(name = form.cleaned_data['name'],
                          user = self.request.user,
                          platform = form.cleaned_data['platform'],
                          address = form.cleaned_data['username'] + '@' + form.cleaned_data['address'],
                          pool_type = form.cleaned_data['pool_type'],
                          status_page = form.cleaned_data['status_page_link'],
+                         max_queued_jobs = form.cleaned_data['max_queued_jobs'],
                          )
+        
+        ##Only add the pool using bosco_cluster --add if no other pools exist with the same address!
+        if BoscoPool.objects.filter(address = username + '@' + address).exclude(add_status='failed').count() == 0:
+            #This can take several minutes, so it runs in the background. The status page polls for the result
+            pool.add_status = 'running'
+            pool.save()
+            condor_tools.start_bosco_pool_add(pool, ssh_key_filename)
+            return HttpResponseRedirect(reverse_lazy('bosco_pool_add_status', kwargs={'pool_id': pool.id}))
+        
+        log.debug('Adding new bosco pool %s to db, skipping bosco_cluster --add because it already exists ' % (username + '@' + address))
+        os.remove(ssh_key_filename)
+        pool.add_status = 'success'
         pool.save()
                          
         return HttpResponseRedirect(reverse_lazy('pool_test', kwargs={'pool_id': pool.id}))
     
+class BoscoPoolAddStatusView(RestrictedView):
+    
+    page_title = 'Adding existing compute pool'
+    template_name = 'pool/bosco_pool_add_status.html'
+    
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        pool = BoscoPool.objects.get(id=kwargs.get('pool_id'))
+        assert pool.user == request.user
+        kwargs['pool'] = pool
+        
+        if condor_tools.is_bosco_pool_add_running(pool):
+            kwargs['running'] = True
+            return super(BoscoPoolAddStatusView, self).dispatch(request, *args, **kwargs)
+        
+        if pool.add_status == 'success' or pool.add_status == '':
+            return HttpResponseRedirect(reverse_lazy('pool_test', kwargs={'pool_id': pool.id}))
+        
+        #The pool couldn't be added. It is kept, with the output, until the user dismisses it
+        if request.method == 'POST':
+            pool.delete()
+            return HttpResponseRedirect(reverse_lazy('pool_list'))
+        
+        if pool.add_output:
+            add_output = json.loads(pool.add_output)
+            kwargs['output'] = add_output['output'] + add_output['stderr']
+        else:
+            kwargs['output'] = ['Adding the pool did not finish']
+        
+        return super(BoscoPoolAddStatusView, self).dispatch(request, *args, **kwargs)
 
         
 class PoolTestView(RestrictedView):
@@ -825,13 +850,22 @@ class PoolTestResultView(RestrictedView):
         
         kwargs['pool'] = pool
         
-        output, errors, exit_status = condor_tools.test_bosco_pool(pool.address)
+        #The test can take several minutes, so it runs in the background. This page polls for the result
+        running = condor_tools.is_pool_test_running(pool)
+        if not running and (not request.GET.get('poll') or pool.test_output == ''):
+            condor_tools.start_pool_test(pool)
+            return HttpResponseRedirect(reverse_lazy('pool_test_result', kwargs={'pool_id': pool.id}) + '?poll=1')
+        
+        if running:
+            kwargs['running'] = True
+            return super(PoolTestResultView, self).dispatch(request, *args, **kwargs)
         
-        kwargs['output'] = output
-        kwargs['stderr'] = errors
-        kwargs['exit_status'] = exit_status
+        test_output = json.loads(pool.test_output)
+        kwargs['output'] = test_output['output']
+        kwargs['stderr'] = test_output['stderr']
+        kwargs['exit_status'] = test_output['exit_status']
         
-        if exit_status == 0: kwargs['success'] = True
+        if pool.test_status == 'success': kwargs['success'] = True
         else: kwargs['success'] = False
         
 
@@ -862,6 +896,8 @@ class PoolRemoveView(RestrictedView):
         pool_tasks = Task.objects.filter(condor_pool=pool) | Task.objects.filter(condor_pool__in=copied_pools)
         running_tasks = pool_tasks.filter(status='running')|pool_tasks.filter(status='new')
         other_tasks = pool_tasks.exclude(pk__in=running_tasks)
+        #Tasks of other pools with jobs federated to this one are also cancelled
+        federated_tasks = Task.objects.filter(status='running', subtask__condorjob__condor_pool__in=[pool] + list(copied_pools)).exclude(pk__in=pool_tasks).distinct()
         if not confirmed:
             kwargs['show_loading_screen'] = True
             if pool.get_pool_type() == 'ec2' and pool.copy_of == None:
@@ -874,7 +910,7 @@ class PoolRemoveView(RestrictedView):
                 kwargs['loading_description'] = 'Please do not navigate away from this page. Removing a pool can take several minutes.'
                 kwargs['button_text']='Remove pool'
 
-            kwargs['running_tasks'] = running_tasks
+            kwargs['running_tasks'] = list(running_tasks) + list(federated_tasks)
             return super(PoolRemoveView, self).dispatch(request, *args, **kwargs)
         else:
             #Remove the pool
@@ -892,6 +928,15 @@ class PoolRemoveView(RestrictedView):
                 task.condor_pool = None
                 task.set_custom_field('condor_pool_name', pool.name)
                 task.save()
+            for task in federated_tasks:
+                for subtask in task.subtask_set.all():
+                    condor_tools.remove_task(subtask)
+                task.status = 'cancelled'
+                try:
+                    email_tools.send_task_cancellation_email(task)
+                except:
+                    pass
+                task.save()
             #Then 'prune' the remaining tasks to remove the pool as a foreignkey
             for task in other_tasks:
                 task.condor_pool = None
@@ -910,9 +955,9 @@ class PoolRemoveView(RestrictedView):
                     except Exception, e:
                         log.exception(e)
                         error_list += ['Error deleting duplicate pool', str(e)]
-                #Remove from bosco
+                #Remove from bosco. This can take several minutes, so runs in the background
                 try:
-                    condor_tools.remove_ec2_pool(pool)
+                    command_runner.run_in_background(condor_tools.remove_bosco_pool, str(pool.address))
                 except Exception, e:
                     log.exception(e)
                     error_list += ['Error removing pool from bosco', str(e)]
@@ -930,7 +975,7 @@ class PoolRemoveView(RestrictedView):
                     
                     #Only remove the pool from bosco if the same address is not registered with any other user
                     if CondorPool.objects.filter(address=pool.address).count() == 1:
-                        condor_tools.remove_bosco_pool(pool.address)
+                        command_runner.run_in_background(condor_tools.remove_bosco_pool, pool.address)
                         log.debug('Removing pool %s from bosco' % pool.address)
                     else:
                         log.debug('Not removing pool %s from bosco, since in use by another user' % pool.address)
@@ -0,0 +1,196 @@
+#-------------------------------------------------------------------------------
+# Cloud-COPASI
+# Copyright (c) 2013 Edward Kent.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the GNU Public License v3.0
+# which accompanies this distribution, and is available at
+# http://www.gnu.org/licenses/gpl.html
+#-------------------------------------------------------------------------------
+
+#Staging of input files shared by every job in a cluster (e.g. experimental data files, the CopasiSE binary)
+#Rather than transferring these files with every job, they are uploaded once to a cache directory
+#on the remote submit host, named by the SHA1 of their contents. The spec file is rewritten to run
+#a small wrapper script, which links the cached copies into the job directory before running the job.
+#The cache must be on a filesystem shared with the worker nodes (e.g. the home directory on most PBS,
+#SGE and LSF clusters), so staging is only used for the pool types listed in INPUT_STAGING_POOL_TYPES
+#Files are cached once per submit host rather than on each worker node: the nodes read them from the shared filesystem
+
+import os, re, hashlib
+from cloud_copasi import settings
+from cloud_copasi.web_interface.pools import command_runner
+import logging
+
+log = logging.getLogger(__name__)
+
+#The cache directory on the remote submit host, relative to the home directory
+REMOTE_CACHE_DIR = '.cloud_copasi_cache'
+
+#Files smaller than this aren't worth staging
+MIN_STAGED_FILE_SIZE = 64 * 1024 #Bytes
+
+transfer_input_files_re = re.compile(r'^transfer_input_files\s*=(?P<files>.*)$', re.MULTILINE)
+executable_re = re.compile(r'^executable\s*=\s*(?P<executable>\S+)\s*$', re.MULTILINE)
+transfer_executable_re = re.compile(r'^transfer_executable\s*=\s*(?P<transfer>\S+)\s*$', re.MULTILINE)
+
+wrapper_template = """#!/bin/sh
+#Link the shared input files staged on the submit host into the job directory, then run the job
+CACHE=%(cache)s
+%(links)s
+exec %(executable)s "$@"
+"""
+
+def get_ssh_key():
+    #By default, the key bosco_cluster --add installs on the remote submit hosts
+    ssh_key = getattr(settings, 'INPUT_STAGING_SSH_KEY', os.path.join(settings.HOME_DIR, '.ssh', 'bosco_key.rsa'))
+    if not os.path.isfile(ssh_key):
+        raise Exception('SSH key %s for input staging not found. Set INPUT_STAGING_SSH_KEY' % ssh_key)
+    return ssh_key
+
+def is_staging_enabled(pool):
+    if not getattr(settings, 'SHARED_INPUT_STAGING', False):
+        return False
+    return pool.pool_type in getattr(settings, 'INPUT_STAGING_POOL_TYPES', ['pbs', 'sge', 'lsf'])
+
+def get_file_hash(path):
+    sha1 = hashlib.sha1()
+    staged_file = open(path, 'rb')
+    try:
+        while True:
+            data = staged_file.read(1024 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+    finally:
+        staged_file.close()
+    return sha1.hexdigest()
+
+def _ssh(address, remote_command):
+    return command_runner.run_command(['ssh', '-o', 'BatchMode=yes', '-i', get_ssh_key(), address, remote_command],
+                                      timeout=getattr(settings, 'BOSCO_CLUSTER_TIMEOUT', 900), cluster=address)
+
+def _upload(address, local_path, remote_path):
+    """Copy local_path to remote_path, writing to a temporary file first so that a partial upload is never used
+    """
+    output, error, exit_status = command_runner.run_command(['scp', '-B', '-q', '-i', get_ssh_key(), local_path, '%s:%s.part' % (address, remote_path)],
+                                                           timeout=getattr(settings, 'BOSCO_CLUSTER_TIMEOUT', 900), cluster=address)
+    if exit_status != 0:
+        raise Exception('Could not upload %s: %s' % (local_path, ' '.join(error)))
+    output, error, exit_status = _ssh(address, 'chmod 755 %s.part && mv %s.part %s' % (remote_path, remote_path, remote_path))
+    if exit_status != 0:
+        raise Exception('Could not upload %s: %s' % (local_path, ' '.join(error)))
+
+def get_remote_cache(address):
+    """Return the absolute path of the cache directory on the remote submit host, and the set of hashes already cached there
+    """
+    output, error, exit_status = _ssh(address, 'mkdir -p ~/%s && cd ~/%s && pwd && ls' % (REMOTE_CACHE_DIR, REMOTE_CACHE_DIR))
+    if exit_status != 0 or len(output) == 0:
+        raise Exception('Could not read the input staging cache on %s: %s' % (address, ' '.join(error)))
+    return output[0].strip(), set([line.strip() for line in output[1:]])
+
+def stage_shared_inputs(subtask, number_of_jobs):
+    """Stage the input files shared by every job of the subtask on the remote submit host, and rewrite
+    the spec file to use the cached copies. Upload progress and cache hits are recorded in the task's
+    input_staging custom field.
+    Returns True if the spec file was changed. If anything goes wrong, the spec file is left as it is
+    and the files are transferred with each job as usual
+    """
+    task = subtask.task
+    pool = task.condor_pool
+    if number_of_jobs < 2 or pool == None or not is_staging_enabled(pool):
+        return False
+
+    spec_file_path = os.path.join(task.directory, subtask.spec_file)
+    spec_file = open(spec_file_path, 'r')
+    spec_string = spec_file.read()
+    spec_file.close()
+
+    transfer_match = transfer_input_files_re.search(spec_string)
+    executable_match = executable_re.search(spec_string)
+    transfer_executable_match = transfer_executable_re.search(spec_string)
+    if not transfer_match or not executable_match:
+        return False
+
+    executable = executable_match.group('executable')
+    transfer_executable = not transfer_executable_match or transfer_executable_match.group('transfer').upper() in ['YES', 'TRUE']
+
+    #Only files that are the same for every job (i.e. not containing $(Process) etc.) are shared
+    input_files = [name.strip() for name in transfer_match.group('files').split(',') if name.strip() != '']
+    staged_files = []
+    unstaged_files = []
+    for name in input_files:
+        path = os.path.join(task.directory, name)
+        if '$' not in name and os.path.isfile(path) and os.path.getsize(path) >= MIN_STAGED_FILE_SIZE:
+            staged_files.append((name, path))
+        else:
+            unstaged_files.append(name)
+    #The executable may be given relative to the task directory, e.g. a wrapper script
+    executable_path = os.path.join(task.directory, executable)
+    if transfer_executable and os.path.isfile(executable_path):
+        staged_executable = (os.path.basename(executable), executable_path)
+    else:
+        staged_executable = None
+
+    if len(staged_files) == 0 and staged_executable == None:
+        return False
+
+    stats = task.get_custom_field('input_staging') or {}
+    for key in ['files', 'cache_hits', 'uploads', 'bytes_uploaded', 'bytes_saved']:
+        stats.setdefault(key, 0)
+
+    try:
+        address = pool.address
+        cache_dir, cached_hashes = get_remote_cache(address)
+
+        to_stage = staged_files + ([staged_executable] if staged_executable else [])
+        hashes = {}
+        for count, (name, path) in enumerate(to_stage):
+            file_hash = get_file_hash(path)
+            hashes[path] = file_hash
+            size = os.path.getsize(path)
+            stats['files'] += 1
+            if file_hash in cached_hashes:
+                stats['cache_hits'] += 1
+                stats['bytes_saved'] += size * number_of_jobs
+            else:
+                stats['progress'] = 'Uploading %s (%d of %d)' % (name, count + 1, len(to_stage))
+                task.set_custom_field('input_staging', stats)
+                log.debug('Staging %s on %s as %s' % (name, address, file_hash))
+                _upload(address, path, '%s/%s' % (cache_dir, file_hash))
+                cached_hashes.add(file_hash)
+                stats['uploads'] += 1
+                stats['bytes_uploaded'] += size
+                stats['bytes_saved'] += size * (number_of_jobs - 1)
+        stats['progress'] = 'Complete'
+    except Exception, e:
+        log.exception(e)
+        stats['progress'] = 'Failed, transferring input files with each job'
+        task.set_custom_field('input_staging', stats)
+        return False
+
+    #Write the wrapper script. Condor transfers input files into the job directory under their base name
+    links = '\n'.join(["ln -sf \"$CACHE/%s\" '%s' || exit 1" % (hashes[path], os.path.basename(name)) for name, path in staged_files])
+    if staged_executable:
+        wrapper_executable = '"$CACHE/%s"' % hashes[staged_executable[1]]
+    else:
+        wrapper_executable = executable
+    wrapper_filename = 'auto_stage_%d.sh' % subtask.index
+    wrapper_file = open(os.path.join(task.directory, wrapper_filename), 'w')
+    wrapper_file.write(wrapper_template % {'cache': cache_dir, 'links': links, 'executable': wrapper_executable})
+    wrapper_file.close()
+    os.chmod(os.path.join(task.directory, wrapper_filename), 0755)
+
+    #Run the wrapper in place of the executable, and stop transferring the staged files
+    spec_string = executable_re.sub('executable = %s' % wrapper_filename, spec_string, count=1)
+    if transfer_executable_match:
+        spec_string = transfer_executable_re.sub('transfer_executable = YES', spec_string, count=1)
+    if len(unstaged_files) > 0:
+        spec_string = transfer_input_files_re.sub('transfer_input_files = %s' % ', '.join(unstaged_files), spec_string, count=1)
+    else:
+        spec_string = transfer_input_files_re.sub('', spec_string, count=1)
+
+    spec_file = open(spec_file_path, 'w')
+    spec_file.write(spec_string)
+    spec_file.close()
+
+    task.set_custom_field('input_staging', stats)
+    return True
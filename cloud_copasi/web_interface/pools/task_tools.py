@@ -12,19 +12,149 @@ from cloud_copasi.web_interface.aws import aws_tools
 from boto.sqs.message import Message
 from cloud_copasi.web_interface.task_plugins import tools
 import logging
-from cloud_copasi.web_interface.pools import condor_tools
+from cloud_copasi.web_interface.pools import condor_tools, federation
+from cloud_copasi.copasi.model import expand_fan_out_models
 import tarfile
 import datetime
 from django.utils.timezone import now
+from django.db import transaction
 from cloud_copasi.web_interface.email import email_tools
+from cloud_copasi.background_daemon.tools import wakeup
+from cloud_copasi.web_interface.pools import metrics
+from cloud_copasi import settings
+from django.db import connection
+import threading, Queue, time
 
 log = logging.getLogger(__name__)
 #Note: 31/7/2013, rewritten to support only local task submission with Bosco
 
 
+#Subtask preparation (writing the model files, spec files, etc., and submitting to condor) can be slow for large tasks.
+#It is handed over to a small pool of worker threads so that the daemon loop isn't held up.
+#Only one subtask of a given task is prepared at a time
+_preparation_queue = Queue.Queue()
+_preparation_workers = []
+_preparing_tasks = set()
+_preparing_tasks_lock = threading.Lock()
+
+def is_task_preparing(task_id):
+    with _preparing_tasks_lock:
+        return task_id in _preparing_tasks
+
+def queue_subtask_preparation(task_id, index):
+    """Prepare and submit the subtask of the task with id task_id and index index.
+    Runs in the background if SUBTASK_PREPARATION_THREADS > 0, otherwise straight away
+    """
+    with _preparing_tasks_lock:
+        if task_id in _preparing_tasks:
+            return
+        _preparing_tasks.add(task_id)
+    
+    thread_count = getattr(settings, 'SUBTASK_PREPARATION_THREADS', 2)
+    if thread_count < 1:
+        _prepare_subtask(task_id, index)
+        return
+    
+    while len(_preparation_workers) < thread_count:
+        worker = threading.Thread(target=_preparation_worker)
+        worker.daemon = True
+        worker.start()
+        _preparation_workers.append(worker)
+    
+    _preparation_queue.put((task_id, index))
+
+def _preparation_worker():
+    while True:
+        task_id, index = _preparation_queue.get()
+        start_time = time.time()
+        try:
+            _prepare_subtask(task_id, index)
+        except Exception, e:
+            log.exception(e)
+        finally:
+            metrics.record('subtask_preparation_time', time.time() - start_time)
+            #Each thread has its own database connection
+            connection.close()
+        #Let the daemon know it can check on the subtask
+        wakeup.send_wakeup('task %d subtask %d prepared' % (task_id, index))
+
+def _prepare_subtask(task_id, index):
+    """Prepare the subtask and, unless it is run locally, submit it to condor
+    """
+    try:
+        task = Task.objects.get(id=task_id)
+        subtask = Subtask.objects.get(task=task, index=index)
+        if subtask.status != 'preparing' or task.status != 'running':
+            return
+        
+        try:
+            TaskClass = tools.get_task_class(task.task_type)
+            task_instance = TaskClass(task)
+            log.debug('Preparing new subtask %d' % (subtask.index))
+            prepared_subtask = task_instance.prepare_subtask(subtask.index)
+            #If this wasn't a local subtask, submit to condor  
+            if not subtask.local:
+                submit_subtask(task_instance, prepared_subtask)
+        except Exception, e:
+            log.exception(e)
+            subtask = Subtask.objects.get(id=subtask.id)
+            subtask.status = 'error'
+            subtask.set_job_count()
+            subtask.set_run_time()
+            subtask.finish_time=  now()
+            subtask.save()
+            
+            task = Task.objects.get(id=task_id)
+            task.status = 'error'
+            
+            task.set_job_count()
+            task.set_run_time()
+            task.set_custom_field('error', str(e))
+            task.finish_time = now()
+            task.save()
+            email_tools.send_task_completion_email(task)
+    finally:
+        with _preparing_tasks_lock:
+            _preparing_tasks.discard(task_id)
+
+def submit_subtask(task_instance, subtask):
+    """Submit a prepared subtask to condor. If DAG submission is enabled, any following subtasks that
+    don't need its results are prepared and submitted with it as a DAG
+    """
+    dag_subtasks = _prepare_dag_subtasks(task_instance.task, task_instance, subtask)
+    if len(dag_subtasks) > 1:
+        condor_tools.submit_dag(dag_subtasks)
+    else:
+        condor_tools.submit_task(subtask)
+
+def _prepare_dag_subtasks(task, task_instance, subtask):
+    """If DAG submission is enabled, also prepare the subtasks following subtask that don't need its results.
+    Returns the list of subtasks to submit together, starting with subtask
+    """
+    dag_subtasks = [subtask]
+    if not getattr(settings, 'CONDOR_USE_DAG', False):
+        return dag_subtasks
+    #Subtasks submitted in chunks, or across several pools, are followed up by the daemon, so can't be part of a DAG
+    if condor_tools.needs_chunked_submission(subtask) or federation.is_federated(task):
+        return dag_subtasks
+    
+    index = subtask.index + 1
+    while True:
+        try:
+            next_subtask = Subtask.objects.get(task=task, index=index)
+        except Subtask.DoesNotExist:
+            break
+        if next_subtask.local or next_subtask.status != 'waiting' or task_instance.needs_previous_results(index):
+            break
+        log.debug('Preparing subtask %d to run in a DAG after subtask %d' % (index, index - 1))
+        dag_subtasks.append(task_instance.prepare_subtask(index))
+        index += 1
+    return dag_subtasks
+
 def update_tasks(user=None, task=None):
     """Examines the status of all CondorJob objects. If the status of upstream subtasks and tasks need changing, then this is done.
     If requested, can filter by a specific user or subtask
+    Returns the number of tasks that were running
     """
     
     
@@ -36,85 +166,92 @@ def update_tasks(user=None, task=None):
     if task:
         tasks = tasks.filter(id=task.id)
     
-    for task in tasks:
-        #Next, get the corresponding running subtasks
-        subtasks = Subtask.objects.filter(task=task).filter(status='running')
-        log.debug(subtasks)
-        for subtask in subtasks:
-            #log.debug('Checking subtask status: %s'%subtask.status)
-            jobs = CondorJob.objects.filter(subtask=subtask)
-            
-            
-            #Does any of the jobs have an error status? Then mark the whole task as having failed
-            errors = jobs.filter(status='E') | jobs.filter(status='H')
-            if errors.count() > 0:
-                for job in errors:
-                    log.debug('Job %d.%d has status %s. Marking task as errored' % (job.subtask.cluster_id, job.process_id, job.status))
-                subtask.status = 'error'
-                task.status = 'error'
-                subtask.finish_time = now()
-                subtask.save()
-                task.save()
-                break
-                #TODO: Can we have a more graceful error handling procedure here?
-                
-            
-            #Next, check to see if all the jobs have finished
-            finished = jobs.filter(status='F')
-            if finished.count() == jobs.count():
-                #The subtask has finished!
-                log.debug('Task %s, subtask %d: successfully finished. Updating status' % (task.name, subtask.index))
-                subtask.status = 'finished'
-                subtask.set_run_time() #Set the run time as the sum from the associated jobs
-                subtask.set_job_count() #And the number of condor jobs
-                subtask.finish_time = now()
-                subtask.save()
-                    
-            else:
-                #Something not right. TODO: determine if bad exit status, files not transferred yet, etc., and respond appropriatley
-                #log.debug('%d jobs still in queue.' % (jobs.count() - finished.count()))
-                pass
-            
+    tasks = dict([(running_task.id, running_task) for running_task in tasks])
+    task_count = len(tasks)
+    metrics.increment('tasks_checked', task_count)
+    if task_count == 0:
+        return 0
+    
+    #Step 2: Work out the progress of every running subtask from its job counters
+    running_subtasks = Subtask.objects.filter(task__in=tasks.keys()).filter(status='running')
+    
+    errored_subtasks = []
+    errored_tasks = set()
+    finished_subtasks = []
+    for subtask in running_subtasks:
+        job_count = subtask.get_queued_job_count()
+        
+        #Does any of the jobs have an error status? Then mark the whole task as having failed
+        error_count = subtask.error_job_count + subtask.held_job_count
+        if error_count > 0:
+            log.debug('Task %s, subtask %d: %d jobs have error or held status. Marking task as errored' % (tasks[subtask.task_id].name, subtask.index, error_count))
+            errored_subtasks.append(subtask.id)
+            errored_tasks.add(subtask.task_id)
+            #TODO: Can we have a more graceful error handling procedure here?
+        
+        #Next, check to see if all the jobs have finished
+        #A subtask with no jobs yet, or with jobs still waiting to be submitted in chunks, hasn't finished
+        elif job_count > 0 and subtask.unsubmitted_job_count == 0 and subtask.finished_job_count == job_count:
+            #The subtask has finished!
+            log.debug('Task %s, subtask %d: successfully finished. Updating status' % (tasks[subtask.task_id].name, subtask.index))
+            #Set the run time as the sum from the associated jobs, and the number of condor jobs
+            finished_subtasks.append((subtask.id, subtask.job_run_time, job_count))
+        
+        else:
+            #Something not right. TODO: determine if bad exit status, files not transferred yet, etc., and respond appropriatley
+            pass
+    
+    #Apply the state changes in bulk
+    time_now = now()
+    with transaction.commit_on_success():
+        if len(errored_subtasks) > 0:
+            Subtask.objects.filter(id__in=errored_subtasks).update(status='error', finish_time=time_now)
+            Task.objects.filter(id__in=errored_tasks).update(status='error', last_update_time=time_now)
+        for subtask_id, run_time, job_count in finished_subtasks:
+            Subtask.objects.filter(id=subtask_id).update(status='finished', run_time=run_time, job_count=job_count, finish_time=time_now)
+    
+    metrics.increment('subtasks_errored', len(errored_subtasks))
+    metrics.increment('subtasks_finished', len(finished_subtasks))
+    
+    for task_id in errored_tasks:
+        del tasks[task_id]
+    if len(tasks) == 0:
+        return task_count
+    
+    #Step 3: Go through the subtasks and submit any that are waiting, provided that their preceding one has finished
+    subtask_statuses = {}
+    for task_id, index, status in Subtask.objects.filter(task__in=tasks.keys()).values_list('task', 'index', 'status'):
+        subtask_statuses.setdefault(task_id, {}).setdefault(index, []).append(status)
     
-        #Now go through the subtasks and submit any that are waiting, provided that their preceding one has finished
+    for task_id, task in tasks.items():
+        statuses = subtask_statuses.get(task_id, {})
         
-        subtasks = Subtask.objects.filter(task=task).filter(status='waiting').order_by('index')
-        for subtask in subtasks:
-            try:
-                if subtask.index > 1:
-                    previous_subtasks = Subtask.objects.filter(task=task, index=(subtask.index -1))
-                    all_previous_subtasks_finished = True
-                    for previous_subtask in previous_subtasks:
-                        if previous_subtask.status != 'finished': all_previous_subtasks_finished = False
-                    if all_previous_subtasks_finished:
-                        #We have a new subtask to submit
-                        TaskClass = tools.get_task_class(task.task_type)
-                        task_instance = TaskClass(task)
-                        log.debug('Preparing new subtask %d' % (subtask.index))
-                        prepared_subtask = task_instance.prepare_subtask(subtask.index)
-                        #If this wasn't a local subtask, submit to condor  
-                        if not subtask.local:
-                            condor_tools.submit_task(prepared_subtask)
-            except Exception, e:
-                subtask.status = 'error'
-                subtask.set_job_count()
-                subtask.set_run_time()
-                subtask.finish_time=  now()
-                subtask.save()
-                
-                task.status = 'error'
-                
-                task.set_job_count()
-                task.set_run_time()
-                task.set_custom_field('error', str(e))
-                task.finish_time = now()
-                task.save()
-                email_tools.send_task_completion_email(task)
-                
-        #Get the list of subtasks again
-        task_subtasks = Subtask.objects.filter(task=task)
-        finished = task_subtasks.filter(status='finished').order_by('index')
-        if task_subtasks.count() == finished.count():
+        #Pick up any subtask left in the preparing state, e.g. if the daemon was restarted mid-preparation
+        for index in sorted(statuses.keys()):
+            if 'preparing' in statuses[index] and not is_task_preparing(task_id):
+                log.debug('Task %s, subtask %d: resuming preparation' % (task.name, index))
+                queue_subtask_preparation(task_id, index)
+        
+        for index in sorted(statuses.keys()):
+            if index <= 1 or 'waiting' not in statuses[index]:
+                continue
+            all_previous_subtasks_finished = True
+            for previous_status in statuses.get(index - 1, []):
+                if previous_status != 'finished': all_previous_subtasks_finished = False
+            if not all_previous_subtasks_finished:
+                continue
+            
+            #We have a new subtask to submit. Mark it as preparing, and hand it over to the preparation workers
+            log.debug('Task %s, subtask %d: queueing for preparation' % (task.name, index))
+            Subtask.objects.filter(task=task, index=index, status='waiting').update(status='preparing')
+            statuses[index] = ['preparing']
+            metrics.increment('subtasks_queued')
+            queue_subtask_preparation(task_id, index)
+            break
+        
+        #Check whether all the subtasks have now finished
+        all_statuses = sum(statuses.values(), [])
+        if task.status == 'running' and all_statuses.count('finished') == len(all_statuses):
             task.status = 'finished'
             task.finish_time = now()
             log.debug('Task %s (user %s), all subtasks finished. Marking task as finished.' % (task.name, task.user.username))
@@ -124,9 +261,9 @@ def update_tasks(user=None, task=None):
             
             task.save()
             email_tools.send_task_completion_email(task)
-            
-        task.last_update_time=now()
-        task.save()
+    
+    Task.objects.filter(id__in=tasks.keys()).update(last_update_time=now())
+    return task_count
 
 def delete_task(task):
     task.delete()
@@ -136,6 +273,8 @@ def zip_up_task(task):
     name = str(task.name).replace(' ', '_')
     filename = os.path.join(task.directory, name + '.tar.bz2')
     if not os.path.isfile(filename):
+        #Include the model of each job, even if the jobs created them from a base model (fan-out mode)
+        expand_fan_out_models(task.directory)
         tar = tarfile.open(name=filename, mode='w:bz2')
         tar.add(task.directory, name)
         tar.close()
@@ -38,6 +38,7 @@ import shutil
 from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
 import zipfile
 import json
+from cloud_copasi.background_daemon.tools import wakeup
 
 log = logging.getLogger(__name__)
 
@@ -137,6 +138,13 @@ class NewTaskView(RestrictedFormView):
         directory_created = False
         task.save() # Save the task so we can get a valid id
         
+        #Any other pools to federate the jobs across
+        additional_pools = [pool for pool in form.cleaned_data.get('additional_pools') or [] if pool.id != compute_pool.id]
+        if len(additional_pools) > 0:
+            for pool in additional_pools:
+                assert pool.user == request.user
+            task.set_custom_field('federated_pools', [pool.id for pool in additional_pools])
+        
         #Save the custom task fields
         for field_name, field_object in extra_fields:
             
@@ -258,15 +266,24 @@ class NewTaskView(RestrictedFormView):
             
             return self.form_invalid(self, *args, **kwargs)
         
+        #Precompute the details of the model shown on the results pages, so they don't need to load the model
+        try:
+            task_instance.copasi_model.write_metadata()
+        except Exception, e:
+            log.exception(e)
+        
         try:
             task_instance.initialize_subtasks()
             
             subtask = task_instance.prepare_subtask(1)
             
-            condor_tools.submit_task(subtask)
+            task_tools.submit_subtask(task_instance, subtask)
             
             task.status = 'running'
             task.save()
+            
+            #Let the background daemon know there's a new task to follow
+            wakeup.send_wakeup('task %d submitted' % task.id)
         except Exception, e:
             log.exception(e)
             error_messages = ['An error occured while preparing the task',
@@ -337,6 +354,7 @@ class TaskDetailsView(RestrictedView):
         kwargs['task'] = task
         kwargs['task_display_type'] = task_plugins.tools.get_task_display_name(task.task_type)
         kwargs['config_options'] = task_custom_fields
+        kwargs['input_staging'] = task.get_custom_field('input_staging')
         
         if task.status == 'finished':
             
@@ -374,10 +392,11 @@ class SubtaskDetailsView(RestrictedView):
         
         kwargs['subtask'] = subtask
         
-        kwargs['running_count'] = subtask.condorjob_set.filter(status='R').count()
-        kwargs['finished_count'] = subtask.condorjob_set.filter(status='F').count()
-        kwargs['idle_count'] = subtask.condorjob_set.filter(status='I').count()
-        kwargs['held_count'] = subtask.condorjob_set.filter(status='H').count()
+        kwargs['running_count'] = subtask.running_job_count
+        kwargs['finished_count'] = subtask.finished_job_count
+        kwargs['idle_count'] = subtask.idle_job_count
+        kwargs['held_count'] = subtask.held_job_count
+        kwargs['unsubmitted_count'] = subtask.unsubmitted_job_count
         
         
         return super(SubtaskDetailsView, self).dispatch(request, *args, **kwargs)
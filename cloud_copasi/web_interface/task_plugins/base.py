@@ -28,7 +28,9 @@ class BaseTaskForm(forms.Form):
     #access_key = form_tools.NameChoiceField(queryset=None, initial=0)
     model_file = forms.FileField()
     compute_pool = form_tools.PoolChoiceField(queryset=None, initial=0)
-
+    #Other pools to run some of the jobs on, in proportion to their throughput
+    additional_pools = form_tools.PoolMultipleChoiceField(queryset=None, required=False,
+                                                          help_text='Optional. Other pools to share the jobs with. Hold Ctrl to select more than one')
     
     def __init__(self, user, task_types,  *args, **kwargs):
         super(BaseTaskForm, self).__init__(*args, **kwargs)
@@ -43,12 +45,14 @@ class BaseTaskForm(forms.Form):
         shared_ec2_pools = EC2Pool.objects.filter(user=user).filter(copy_of__isnull=False)
         shared_ec2_pool_ids = [pool.pk for pool in shared_ec2_pools]
         
-        bosco_pools = BoscoPool.objects.filter(user=user)
+        #Pools still being added to bosco, or that failed to be added, can't be used
+        bosco_pools = BoscoPool.objects.filter(user=user).exclude(add_status__in=['running', 'failed'])
         bosco_pool_ids = [pool.pk for pool in bosco_pools]
         
         condor_pools = CondorPool.objects.filter(pk__in=ec2_pool_ids + shared_ec2_pool_ids + bosco_pool_ids)
         
         self.fields['compute_pool'].queryset = condor_pools
+        self.fields['additional_pools'].queryset = condor_pools
         
 
 
@@ -75,6 +79,19 @@ class BaseTask(object):
     def initialize_subtasks(self):
         pass
     
+    def needs_previous_results(self, index):
+        """Return False if subtask index can be prepared before the preceding subtask has finished,
+        i.e. it doesn't need any server-side processing of the preceding results. If DAG submission is enabled,
+        such subtasks are submitted to condor together with the preceding subtask as a DAG
+        """
+        return True
+    
+    def needs_saved_model(self, index):
+        """Return False if the jobs of subtask index only need their report output, and not the model saved by COPASI
+        after running (run_<model file>). If so, the saved model isn't transferred back from the pool
+        """
+        return True
+    
     def create_new_subtask(self, subtask_type, local=False):
         #Get a count of the number of existing subtasks
         subtask_count = len(Subtask.objects.filter(task=self.task))
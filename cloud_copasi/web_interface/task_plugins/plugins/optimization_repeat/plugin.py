@@ -73,6 +73,9 @@ class TaskPlugin(BaseTask):
         #And a subtask to process any results
         self.create_new_subtask('process', local=True)
         
+    def needs_saved_model(self, index):
+        return False
+    
     def prepare_subtask(self, index):
         """Prepare the indexed subtask"""
         
@@ -211,7 +214,8 @@ class TaskPlugin(BaseTask):
                                                                   condor_pool.address,
                                                                   len(model_files),
                                                                   subtask.index,
-                                                                  rank='')
+                                                                  rank='',
+                                                                  save_model=self.needs_saved_model(subtask.index))
         
         log.debug('Prepared copasi files %s'%model_files)
         log.debug('Prepared condor job %s' %condor_job_file)
@@ -12,12 +12,15 @@ from cloud_copasi.copasi import model
 from cloud_copasi import settings
 from lxml import etree
 import os, time, math
-from cloud_copasi.condor import condor_spec
 from string import Template
 import re
 
 xmlns = model.xmlns
 
+#Match a string of the format (    0.0995749    0.101685    0.108192    0.091224    )    0.091224    0    
+#Contains parameter values, the best optimization value, the cpu time, and some other values.
+output_re = re.compile(r'\(\s(?P<params>.+)\s\)\s+(?P<best_value>\S+)\s+(?P<cpu_time>\S+)\s+(?P<function_evals>\S+)\.*')
+
 class ODCopasiModel(CopasiModel):
     
     def prepare_od_jobs(self, algorithms):
@@ -52,6 +55,8 @@ class ODCopasiModel(CopasiModel):
         
         model_files = []
         
+        #Unlike the job models of other tasks, each model here has a different method element, rather than different values,
+        #so the models can't be written with _write_model_variants. There is at most one model per algorithm
         for algorithm in algorithms:
             if algorithm['prefix'] == 'current_solution_statistics':
                 method.clear()
@@ -484,7 +489,7 @@ class ODCopasiModel(CopasiModel):
                     
         return model_files, output_files
     
-    def prepare_od_condor_jobs(self, pool_type, pool_address, number_of_jobs, rank='0', extraArgs=''):
+    def prepare_od_condor_jobs(self, pool_type, pool_address, number_of_jobs, rank='0', extraArgs='', save_model=True):
         copasi_file = 'auto_copasi_1.$(Process).cps'
         output_file = 'output_1.$(Process).txt'
         
@@ -498,7 +503,7 @@ class ODCopasiModel(CopasiModel):
             transfer_executable = 'YES'
         
         
-        condor_job_string = Template(condor_spec.raw_condor_job_string).substitute(copasiFile=copasi_file, 
+        condor_job_string = Template(model.get_condor_job_template(save_model)).substitute(copasiFile=copasi_file, 
                                                                                    otherFiles='',
                                                                                    rank=rank,
                                                                                    binary_dir = binary_dir,
@@ -532,11 +537,6 @@ class ODCopasiModel(CopasiModel):
         else:
             maximize = True
 
-        #Match a string of the format (    0.0995749    0.101685    0.108192    0.091224    )    0.091224    0    
-        #Contains parameter values, the best optimization value, the cpu time, and some other values.
-        output_string = r'\(\s(?P<params>.+)\s\)\s+(?P<best_value>\S+)\s+(?P<cpu_time>\S+)\s+(?P<function_evals>\S+)\.*'
-        output_re = re.compile(output_string)
-        
         best_values = [] # In this list, store a tuple containing the best value, and the file containing it
         none_values = [] #And here we keep a note of any algorithms for which no result was found
         best_value = None
@@ -629,6 +629,29 @@ class ODCopasiModel(CopasiModel):
             
             return [index for (value, index) in full_list]
         
+    def create_od_best_value_model(self, model_index, output_file):
+        """Write a copy of the model of job model_index, with the start values of the optimization items set to the last
+        values reported in its output file, and return its filename. Returns None if the output has no values"""
+        params = None
+        for line in open(os.path.join(self.path, output_file), 'r'):
+            match = output_re.match(line)
+            if match:
+                params = [value.strip() for value in match.group('params').split('\t') if value.strip() != '']
+        if params == None:
+            return None
+        
+        job_model = ODCopasiModel(os.path.join(self.path, 'auto_copasi_1.%d.cps' % model_index), binary=self.binary, binary_dir=self.binary_dir)
+        optTask = job_model._getTask('optimization')
+        optimizationItems = optTask.find(xmlns + 'Problem').find(xmlns + 'ParameterGroup')
+        for subGroup, value in zip(optimizationItems, params):
+            for item in subGroup:
+                if item.attrib['name'] == 'StartValue':
+                    item.attrib['value'] = value
+        
+        filename = 'best_auto_copasi_1.%d.cps' % model_index
+        job_model.write(os.path.join(self.path, filename))
+        return filename
+    
     def get_od_results(self):
         """Open results.txt, parse the output and return it"""
         output = []
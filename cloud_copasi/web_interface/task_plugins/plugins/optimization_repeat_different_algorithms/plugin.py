@@ -261,6 +261,10 @@ class TaskPlugin(BaseTask):
         #And a subtask to process any results
         self.create_new_subtask('process', local=True)
         
+    def needs_saved_model(self, index):
+        #The model download is created from the job's model and output (see create_od_best_value_model)
+        return False
+    
     def prepare_subtask(self, index):
         """Prepare the indexed subtask"""
         
@@ -298,7 +302,8 @@ class TaskPlugin(BaseTask):
         condor_job_file = self.copasi_model.prepare_or_condor_job(condor_pool.pool_type,
                                                                   condor_pool.address,
                                                                   len(model_files),
-                                                                  rank='')
+                                                                  rank='',
+                                                                  save_model=self.needs_saved_model(subtask.index))
         
         log.debug('Prepared copasi files %s'%model_files)
         log.debug('Prepared condor job %s' %condor_job_file)
@@ -417,7 +422,12 @@ class TaskPlugin(BaseTask):
             
             model_index = key[index]
             
+            #Tasks run before the saved models stopped being transferred back still have them
             filename = os.path.join(self.task.directory, 'run_auto_copasi_1.%d.cps'%model_index)
+            if not os.path.isfile(filename):
+                best_model = self.copasi_model.create_od_best_value_model(model_index, 'output_1.%d.txt' % model_index)
+                if best_model:
+                    filename = os.path.join(self.task.directory, best_model)
             if not os.path.isfile(filename):
                 request.session['errors'] = [('Cannot Return Output', 'There was an internal error processing the results file')]
                 return HttpResponseRedirect(reverse_lazy('task_details', kwargs={'task_id':self.task.id}))
@@ -15,7 +15,7 @@
 # http://www.gnu.org/licenses/gpl.html
 #-------------------------------------------------------------------------------
 
-from cloud_copasi.copasi.model import CopasiModel
+from cloud_copasi.copasi.model import CopasiModel, reads_model
 from cloud_copasi.copasi import model
 from cloud_copasi import settings
 from lxml import etree
@@ -97,6 +97,7 @@ class PSCopasiModel(CopasiModel):
         #############################
         return ['load_balancing_%d.cps' % repeat for repeat in repeats]
     
+    @reads_model
     def get_number_of_intervals(self):
         """Get the number of intervals set for the top level scan task
         """
@@ -77,6 +77,12 @@ class TaskPlugin(BaseTask):
                 
         self.create_new_subtask('file')
 
+    def needs_saved_model(self, index):
+        #Only the model saved by the optimal model subtask is used, for the optimal model download
+        if self.use_load_balancing:
+            return index == 4
+        return index == 3
+    
     def prepare_subtask(self, index):
         """Prepare the indexed subtask"""
         
@@ -221,7 +227,8 @@ class TaskPlugin(BaseTask):
                                                                   len(model_files),
                                                                   subtask.index,
                                                                   self.data_files,
-                                                                  rank='')
+                                                                  rank='',
+                                                                  save_model=self.needs_saved_model(subtask.index))
         
         log.debug('Prepared copasi files %s'%model_files)
         log.debug('Prepared condor job %s' %condor_job_file)
@@ -309,7 +316,8 @@ class TaskPlugin(BaseTask):
                                                                   1,
                                                                   subtask.index,
                                                                   self.data_files,
-                                                                  rank='')
+                                                                  rank='',
+                                                                  save_model=self.needs_saved_model(subtask.index))
         subtask.status = 'ready'
         subtask.spec_file = optimal_condor_job_file
         subtask.set_custom_field('job_output', '')
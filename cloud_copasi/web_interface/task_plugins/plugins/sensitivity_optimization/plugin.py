@@ -56,6 +56,9 @@ class TaskPlugin(BaseTask):
         #And a subtask to process any results
         self.create_new_subtask('process', local=True)
         
+    def needs_saved_model(self, index):
+        return False
+    
     def prepare_subtask(self, index):
         """Prepare the indexed subtask"""
         
@@ -81,7 +84,7 @@ class TaskPlugin(BaseTask):
         
         condor_pool = self.task.condor_pool
         
-        condor_job_file = self.copasi_model.prepare_so_condor_job(condor_pool.pool_type, condor_pool.address, subtask_index=1, rank='')
+        condor_job_file = self.copasi_model.prepare_so_condor_job(condor_pool.pool_type, condor_pool.address, subtask_index=1, rank='', save_model=self.needs_saved_model(1))
         
         log.debug('Prepared copasi files %s'%model_files)
         log.debug('Prepared condor job %s' %condor_job_file)
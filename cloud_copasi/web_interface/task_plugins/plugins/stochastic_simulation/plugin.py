@@ -21,6 +21,7 @@ from django.core.urlresolvers import reverse_lazy
 from cloud_copasi.condor import condor_spec
 from string import Template
 from cloud_copasi.web_interface.task_plugins import load_balancing
+from cloud_copasi.web_interface.pools import condor_tools
 import re
 from django.utils.timezone import now
 log = logging.getLogger(__name__)
@@ -71,6 +72,13 @@ class TaskPlugin(BaseTask):
         self.create_new_subtask('main')
         #And a subtask to process any results
         self.create_new_subtask('process')
+    
+    def needs_previous_results(self, index):
+        #The results processing job only needs to know the output filenames of the main jobs, which are known in advance
+        return index != self.subtasks
+    
+    def needs_saved_model(self, index):
+        return False
         
     def prepare_subtask(self, index):
         """Prepare the indexed subtask"""
@@ -206,7 +214,7 @@ class TaskPlugin(BaseTask):
         
         condor_pool = self.task.condor_pool
         
-        condor_job_file = self.copasi_model.prepare_ss_condor_job(condor_pool.pool_type, condor_pool.address, len(model_files), subtask.index, rank='')
+        condor_job_file = self.copasi_model.prepare_ss_condor_job(condor_pool.pool_type, condor_pool.address, len(model_files), subtask.index, rank='', save_model=self.needs_saved_model(subtask.index))
         
         log.debug('Prepared copasi files %s'%model_files)
         log.debug('Prepared condor job %s' %condor_job_file)
@@ -239,6 +247,9 @@ class TaskPlugin(BaseTask):
         
         
         main_jobs = CondorJob.objects.filter(subtask=main_subtask)
+        if main_subtask.status != 'running' and main_subtask.status != 'finished':
+            #The main subtask is being submitted together with this one as a DAG, so its jobs don't exist yet
+            main_jobs = condor_tools.build_condor_jobs(main_subtask, condor_tools.count_spec_jobs(os.path.join(self.task.directory, main_subtask.spec_file)))
 
         #Get the path of the results_process script        
         path = os.path.abspath(__file__)
@@ -7,18 +7,701 @@
 # http://www.gnu.org/licenses/gpl.html
 #-------------------------------------------------------------------------------
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+Unit tests for the web interface. Run with "manage.py test web_interface".
+"""
+
+from django.test import TestCase, SimpleTestCase
+from django.contrib.auth.models import User
+from cloud_copasi.web_interface.models import Task, Subtask, CondorJob, CondorPool
+from cloud_copasi.web_interface.pools import condor_tools, condor_log_tools, fair_share, federation
+from cloud_copasi.background_daemon.tools.scheduler import Scheduler
+from cloud_copasi.background_daemon.tools import background_script
+from cloud_copasi.copasi import model_cache
+from cloud_copasi.copasi.model import CopasiModel
+from cloud_copasi import settings
+import os, shutil, tempfile, datetime
+from django.utils.timezone import now
+
+
+class ReadCondorQClustersTest(SimpleTestCase):
+    """read_condor_q_clusters parses the -autoformat output of condor_q"""
+
+    def setUp(self):
+        self.run_bosco_command = condor_tools.run_bosco_command
+        self.commands = []
+
+    def tearDown(self):
+        condor_tools.run_bosco_command = self.run_bosco_command
+
+    def set_output(self, output, exit_status=0):
+        def run_bosco_command(command, error=False, **kwargs):
+            self.commands.append(command)
+            return output, [], exit_status
+        condor_tools.run_bosco_command = run_bosco_command
+
+    def test_parse(self):
+        self.set_output(['18756 0 2 1203.0 1',
+                         '18756 1 5 undefined undefined',
+                         '18757 0 1 86400.0 2',
+                         ])
+        condor_q = condor_tools.read_condor_q_clusters([18757, 18756, 18756, None])
+        self.assertEqual(condor_q, [(18756, 0, 'R', 1203.0 / 86400.0, 1),
+                                    (18756, 1, 'H', 0.0, 0),
+                                    (18757, 0, 'I', 1.0, 2),
+                                    ])
+        #Only our own clusters are asked for, once each
+        self.assertEqual(self.commands, [[condor_tools.CONDOR_Q, '18756', '18757', '-autoformat'] + condor_tools.CONDOR_Q_ATTRIBUTES])
+
+    def test_malformed_lines(self):
+        self.set_output(['',
+                         '-- Schedd: localhost',
+                         'x 0 2 1.0 1',
+                         '18756 0 2 1.0',
+                         '18756 1 2 1.0 1',
+                         ])
+        self.assertEqual(condor_tools.read_condor_q_clusters([18756]), [(18756, 1, 'R', 1.0 / 86400.0, 1)])
+
+    def test_unknown_status(self):
+        #An unknown status is reported as None, so the job keeps its last known status
+        self.set_output(['18756 0 99 0.0 0'])
+        self.assertEqual(condor_tools.read_condor_q_clusters([18756]), [(18756, 0, None, 0.0, 0)])
+
+    def test_no_clusters(self):
+        self.set_output([])
+        self.assertEqual(condor_tools.read_condor_q_clusters([None]), [])
+        self.assertEqual(self.commands, [])
+
+    def test_error(self):
+        self.set_output([], exit_status=1)
+        self.assertRaises(AssertionError, condor_tools.read_condor_q_clusters, [18756])
+
+
+SUBMIT_EVENT = """000 (20949.000.000) 2013-02-07 11:27:00 Job submitted from host: <130.88.110.118:9618>
+...
+"""
+
+EXECUTE_EVENT = """001 (20949.000.000) 2013-02-07 11:27:10 Job executing on host: <130.88.110.119:60608>
+...
+"""
+
+TERMINATE_EVENT = """005 (20949.000.000) 2013-02-07 11:28:10 Job terminated.
+\t(1) Normal termination (return value 0)
+\t\tUsr 0 00:00:54, Sys 0 00:00:01  -  Run Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+\t\tUsr 0 00:00:54, Sys 0 00:00:01  -  Total Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Total Local Usage
+...
+"""
+
+ABORT_EVENT = """009 (20949.000.000) 2013-02-07 11:28:10 Job was aborted by the user.
+\tvia condor_rm (by user ed)
+...
+"""
+
+DAG_SUBMIT_EVENT = """000 (20950.000.000) 2013-02-07 11:29:00 Job submitted from host: <130.88.110.118:9618>
+    DAG Node: subtask_2
+...
+"""
+
+
+class LogReaderTest(SimpleTestCase):
+    """LogReader only parses the events appended to a condor user log since it was last updated"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'auto_condor_0.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text, mode='a'):
+        log_file = open(self.path, mode)
+        log_file.write(text)
+        log_file.close()
+
+    def test_missing_log(self):
+        reader = condor_log_tools.LogReader(self.path)
+        self.assertEqual(reader.update(), [])
+        self.assertFalse(reader.get_log(20949, 0).has_terminated)
+
+    def test_incremental_reads(self):
+        self.write(SUBMIT_EVENT + EXECUTE_EVENT)
+        reader = condor_log_tools.LogReader(self.path)
+        events = reader.update()
+        self.assertEqual([event.event_type for event in events], ['submit', 'execute'])
+        self.assertFalse(reader.get_log(20949, 0).has_terminated)
+
+        #Nothing new has been written
+        self.assertEqual(reader.update(), [])
+
+        #A partially written event is left until it is complete
+        self.write(TERMINATE_EVENT[:60])
+        self.assertEqual(reader.update(), [])
+        self.write(TERMINATE_EVENT[60:])
+        events = reader.update()
+        self.assertEqual([event.event_type for event in events], ['terminate'])
+        self.assertEqual(reader.offset, os.path.getsize(self.path))
+
+        condor_log = reader.get_log(20949, 0)
+        self.assertTrue(condor_log.has_terminated)
+        self.assertFalse(condor_log.has_aborted)
+        self.assertEqual(condor_log.termination_status, 0)
+        self.assertEqual(condor_log.host, '130.88.110.119:60608')
+        self.assertEqual(condor_log.running_time.seconds, 55)
+
+        #Other jobs in the log are unaffected
+        self.assertFalse(reader.get_log(20949, 1).has_terminated)
+
+    def test_abort(self):
+        #A job removed with condor_rm has terminated, but has no termination status
+        self.write(SUBMIT_EVENT + EXECUTE_EVENT + ABORT_EVENT)
+        condor_log = condor_log_tools.Log(self.path)
+        self.assertTrue(condor_log.has_terminated)
+        self.assertTrue(condor_log.has_aborted)
+        self.assertEqual(condor_log.termination_status, None)
+
+    def test_dag_nodes(self):
+        self.write(SUBMIT_EVENT + DAG_SUBMIT_EVENT)
+        reader = condor_log_tools.LogReader(self.path)
+        reader.update()
+        self.assertEqual(reader.get_dag_node_cluster_id('subtask_2'), 20950)
+        self.assertEqual(reader.get_dag_node_cluster_id('subtask_3'), None)
+
+    def test_truncation(self):
+        self.write(SUBMIT_EVENT + EXECUTE_EVENT + TERMINATE_EVENT)
+        reader = condor_log_tools.LogReader(self.path)
+        reader.update()
+        self.assertTrue(reader.get_log(20949, 0).has_terminated)
+
+        #The log is truncated in place, and the job resubmitted
+        self.write(SUBMIT_EVENT, mode='w')
+        events = reader.update()
+        self.assertEqual([event.event_type for event in events], ['submit'])
+        self.assertFalse(reader.get_log(20949, 0).has_terminated)
+
+    def test_rotation(self):
+        self.write(SUBMIT_EVENT + EXECUTE_EVENT)
+        reader = condor_log_tools.LogReader(self.path)
+        reader.update()
+
+        #The log is replaced by a new file, which is read from the beginning
+        rotated_path = self.path + '.new'
+        rotated_file = open(rotated_path, 'w')
+        rotated_file.write(SUBMIT_EVENT + EXECUTE_EVENT + ABORT_EVENT)
+        rotated_file.close()
+        os.rename(rotated_path, self.path)
+
+        events = reader.update()
+        self.assertEqual([event.event_type for event in events], ['submit', 'execute', 'abort'])
+        self.assertTrue(reader.get_log(20949, 0).has_aborted)
+
+
+class JobCountersTest(TestCase):
+    """The subtask job counters kept up to date by process_condor_q match those recomputed from the jobs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.read_condor_q_clusters = condor_tools.read_condor_q_clusters
+        user = User.objects.create_user('test', 'test@example.com', 'test')
+        self.task = Task.objects.create(name='test', user=user, task_type='test', original_model='model.cps', directory=self.directory, status='running')
+        self.subtask = Subtask.objects.create(task=self.task, index=0, type='main')
+
+    def tearDown(self):
+        condor_tools.read_condor_q_clusters = self.read_condor_q_clusters
+        shutil.rmtree(self.directory)
+
+    def set_queue(self, condor_q):
+        condor_tools.read_condor_q_clusters = lambda cluster_ids: condor_q
+
+    def get_counters(self, subtask):
+        fields = Subtask.job_counter_fields.values() + ['job_run_time']
+        return dict([(field, getattr(subtask, field)) for field in fields])
+
+    def assert_counters_consistent(self):
+        subtask = Subtask.objects.get(id=self.subtask.id)
+        counters = self.get_counters(subtask)
+        subtask.update_job_counters()
+        recomputed = self.get_counters(subtask)
+        #The run time is accumulated in a different order, so may differ by rounding
+        self.assertAlmostEqual(counters.pop('job_run_time'), recomputed.pop('job_run_time'))
+        self.assertEqual(counters, recomputed)
+        return subtask
+
+    def test_counters(self):
+        condor_tools.start_subtask_jobs(self.subtask, 100, 4)
+        subtask = self.assert_counters_consistent()
+        self.assertEqual(subtask.idle_job_count, 4)
+
+        self.set_queue([(100, 0, 'R', 0.5, 1),
+                        (100, 1, 'H', 0.0, 1),
+                        (100, 2, 'I', 0.0, 0),
+                        (100, 3, 'R', 0.25, 1),
+                        ])
+        condor_tools.process_condor_q(subtask=self.subtask)
+        subtask = self.assert_counters_consistent()
+        self.assertEqual((subtask.idle_job_count, subtask.running_job_count, subtask.held_job_count), (1, 2, 1))
+        #Run times are only stored once the jobs leave the queue
+        self.assertEqual(subtask.job_run_time, 0.0)
+
+        #Job 3 leaves the queue after finishing normally
+        log_file = open(os.path.join(self.directory, 'auto_copasi_0.3.cps.log'), 'w')
+        log_file.write(TERMINATE_EVENT.replace('20949.000', '100.003'))
+        log_file.close()
+        output_file = open(os.path.join(self.directory, 'output_0.3.txt'), 'w')
+        output_file.write('output')
+        output_file.close()
+        self.set_queue([(100, 0, 'R', 0.5, 1),
+                        (100, 1, 'H', 0.0, 1),
+                        (100, 2, 'R', 0.125, 1),
+                        ])
+        condor_tools.process_condor_q(subtask=self.subtask)
+        subtask = self.assert_counters_consistent()
+        self.assertEqual((subtask.idle_job_count, subtask.running_job_count, subtask.held_job_count, subtask.finished_job_count), (0, 2, 1, 1))
+        job = CondorJob.objects.get(subtask=self.subtask, process_id=3)
+        self.assertEqual(job.status, 'F')
+        #The run time is read from the log
+        self.assertAlmostEqual(job.run_time, 55 / 86400.0)
+        self.assertAlmostEqual(subtask.job_run_time, 55 / 86400.0)
+
+    def test_unsubmitted_counters(self):
+        condor_tools.start_subtask_jobs(self.subtask, None, 5)
+        subtask = self.assert_counters_consistent()
+        self.assertEqual((subtask.unsubmitted_job_count, subtask.idle_job_count), (5, 0))
+
+    def test_task_totals(self):
+        condor_tools.start_subtask_jobs(self.subtask, 100, 4)
+        Subtask.objects.create(task=self.task, index=1, type='process', status='finished', job_count=1, run_time=0.5)
+        Subtask.objects.filter(id=self.subtask.id).update(job_run_time=0.25)
+        self.assertEqual(self.task.get_job_count(), 5)
+        self.assertEqual(self.task.get_run_time(), 0.75)
+
+
+class SchedulerTest(SimpleTestCase):
+    """Each daemon phase backs off while idle, and runs straight away when woken"""
+
+    def setUp(self):
+        self.results = {'busy': True, 'idle': False}
+        self.runs = []
+        self.scheduler = Scheduler()
+        for name in ['busy', 'idle']:
+            self.scheduler.add_phase(name, self.get_function(name), 10, 35)
+
+    def get_function(self, name):
+        def function():
+            self.runs.append(name)
+            result = self.results[name]
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return function
+
+    def test_backoff(self):
+        idle = self.scheduler.get_phase('idle')
+        busy = self.scheduler.get_phase('busy')
+        intervals = []
+        for i in range(4):
+            idle.run()
+            busy.run()
+            intervals.append(idle.interval)
+        #The idle phase backs off up to its maximum interval
+        self.assertEqual(intervals, [20, 35, 35, 35])
+        self.assertEqual(busy.interval, 10)
+
+        #As soon as there is work to do, it goes back to its minimum interval
+        self.results['idle'] = True
+        idle.run()
+        self.assertEqual(idle.interval, 10)
 
-Replace this with more appropriate tests for your application.
+    def test_exception(self):
+        self.results['busy'] = Exception('failed')
+        busy = self.scheduler.get_phase('busy')
+        busy.run()
+        self.assertEqual(busy.interval, 20)
+
+    def test_run_due_phases(self):
+        self.assertEqual(self.scheduler.run_due_phases(), 2)
+        self.assertEqual(self.runs, ['busy', 'idle'])
+        #Nothing is due again until the minimum interval has passed
+        self.assertEqual(self.scheduler.run_due_phases(), 0)
+        self.assertTrue(0 < self.scheduler.time_until_next() <= 10)
+
+    def test_wake(self):
+        self.scheduler.run_due_phases()
+        self.scheduler.get_phase('idle').run()
+        self.runs = []
+
+        self.scheduler.wake(['idle'])
+        self.assertEqual(self.scheduler.get_phase('idle').interval, 10)
+        self.assertEqual(self.scheduler.time_until_next(), 0)
+        self.assertEqual(self.scheduler.run_due_phases(), 1)
+        self.assertEqual(self.runs, ['idle'])
+
+        self.scheduler.wake()
+        self.assertEqual(self.scheduler.run_due_phases(), 2)
+
+    def test_phase_intervals(self):
+        missing = object()
+        phase_intervals = getattr(settings, 'DAEMON_PHASE_INTERVALS', missing)
+        settings.DAEMON_PHASE_INTERVALS = {'ec2_refresh': (60, 600)}
+        try:
+            scheduler = background_script.get_scheduler()
+            ec2_refresh = scheduler.get_phase('ec2_refresh')
+            self.assertEqual((ec2_refresh.min_interval, ec2_refresh.max_interval), (60, 600))
+            condor_q = scheduler.get_phase('condor_q')
+            self.assertEqual(condor_q.min_interval, settings.DAEMON_POLL_TYME)
+            #Pending jobs are submitted as soon as there is room in the queue, so the phase doesn't back off
+            submit_pending_jobs = scheduler.get_phase('submit_pending_jobs')
+            self.assertEqual(submit_pending_jobs.max_interval, submit_pending_jobs.min_interval)
+        finally:
+            if phase_intervals is missing:
+                del settings.DAEMON_PHASE_INTERVALS
+            else:
+                settings.DAEMON_PHASE_INTERVALS = phase_intervals
+
+    def test_wakeup_phases(self):
+        scheduler = background_script.get_scheduler()
+        for name in background_script.WAKEUP_PHASES:
+            scheduler.get_phase(name)
+        self.assertTrue('submit_pending_jobs' in background_script.WAKEUP_PHASES)
+
+
+SPEC_FILE = """executable = CopasiSE
+arguments = --nologo --home . auto_copasi_1.$(Process).cps
+transfer_input_files = auto_copasi_1.$(Process).cps
+log = auto_copasi_1.$(Process).cps.log
+output = auto_copasi_1.$(Process).cps.out
+queue %s
 """
 
-from django.test import TestCase
 
+class ChunkSpecTest(SimpleTestCase):
+    """Spec files of subtasks with very many jobs are split into chunks submitted as separate clusters"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spec_file_path = os.path.join(self.directory, 'auto_condor_1.job')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_spec(self, spec_string):
+        spec_file = open(self.spec_file_path, 'w')
+        spec_file.write(spec_string)
+        spec_file.close()
+
+    def test_count_spec_jobs(self):
+        self.write_spec(SPEC_FILE % '250')
+        self.assertEqual(condor_tools.count_spec_jobs(self.spec_file_path), 250)
+        self.write_spec(SPEC_FILE % '')
+        self.assertEqual(condor_tools.count_spec_jobs(self.spec_file_path), 1)
+        self.write_spec((SPEC_FILE % '2') + 'arguments = other\nQueue 3\n')
+        self.assertEqual(condor_tools.count_spec_jobs(self.spec_file_path), 5)
+        self.assertFalse(condor_tools.is_chunkable(self.spec_file_path))
+
+    def test_write_chunk_spec(self):
+        self.write_spec(SPEC_FILE % '10000')
+        self.assertTrue(condor_tools.is_chunkable(self.spec_file_path))
+        chunk_file_path = condor_tools.write_chunk_spec(self.spec_file_path, 5000, 2500)
+        self.assertEqual(chunk_file_path, os.path.join(self.directory, 'auto_condor_1.5000.job'))
+
+        chunk_file = open(chunk_file_path, 'r')
+        chunk_spec = chunk_file.read()
+        chunk_file.close()
+        #A single queue statement, however many jobs are in the chunk
+        self.assertEqual(chunk_spec.count('queue'), 1)
+        self.assertTrue('queue JobIndex from seq 5000 7499 |' in chunk_spec)
+        #The filenames keep the job's index in the subtask
+        self.assertTrue('transfer_input_files = auto_copasi_1.$(JobIndex).cps' in chunk_spec)
+        self.assertFalse('$(Process)' in chunk_spec)
+
+
+class FairShareTest(TestCase):
+    """Jobs are submitted with a priority based on the recent usage of their user and task"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {}
+        for name in ['FAIR_SHARE_USAGE_UNIT', 'FAIR_SHARE_SMALL_TASK_JOBS', 'FAIR_SHARE_SMALL_TASK_PRIORITY']:
+            self.settings[name] = getattr(settings, name, None)
+        settings.FAIR_SHARE_USAGE_UNIT = 1.0
+        settings.FAIR_SHARE_SMALL_TASK_JOBS = 100
+        settings.FAIR_SHARE_SMALL_TASK_PRIORITY = 10
+
+        owner = User.objects.create_user('owner', 'owner@example.com', 'owner')
+        self.user = User.objects.create_user('test', 'test@example.com', 'test')
+        self.pool = CondorPool.objects.create(name='pool', user=owner)
+        #The user submits to a shared copy of the pool
+        self.copy = CondorPool.objects.create(name='copy', user=self.user, copy_of=self.pool)
+        self.task = self.create_task(self.copy)
+        self.subtask = Subtask.objects.create(task=self.task, index=1, type='main')
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            if value == None:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+        shutil.rmtree(self.directory)
+
+    def create_task(self, pool, user=None):
+        return Task.objects.create(name='test', user=user or self.user, condor_pool=pool, task_type='test', original_model='model.cps', directory=self.directory, status='running')
+
+    def add_usage(self, task, days, start_time=None):
+        Subtask.objects.create(task=task, index=0, type='main', status='finished', job_run_time=days, start_time=start_time or now())
+
+    def test_job_priority(self):
+        #No usage: small tasks get the bonus
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 50), 10)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 500), 0)
+
+        #15 hours used recently by another of the user's tasks, on the original pool
+        self.add_usage(self.create_task(self.pool), 0.625)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 500), -4)
+        #Usage outside the window, or by other users, doesn't count
+        self.add_usage(self.create_task(self.pool), 100, now() - datetime.timedelta(days=30))
+        other_user = User.objects.create_user('other', 'other@example.com', 'other')
+        self.add_usage(self.create_task(self.pool, other_user), 100)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 500), -4)
+
+        #The task's own usage counts towards both the user and the task
+        self.add_usage(self.task, 0.625)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 500), -8)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 50), 2)
+
+    def test_job_priority_bounds(self):
+        self.add_usage(self.task, 1e6)
+        self.assertEqual(fair_share.get_job_priority(self.subtask, 500), fair_share.MIN_PRIORITY)
+
+    def test_set_spec_priority(self):
+        spec_file_path = os.path.join(self.directory, 'auto_condor_1.job')
+        spec_file = open(spec_file_path, 'w')
+        spec_file.write('Priority = 5\n' + (SPEC_FILE % '10'))
+        spec_file.close()
+
+        fair_share.set_spec_priority(spec_file_path, -3)
+        fair_share.set_spec_priority(spec_file_path, 7)
+        spec_file = open(spec_file_path, 'r')
+        spec_string = spec_file.read()
+        spec_file.close()
+        #Any existing priority is replaced, and the new one is set just before the queue statement
+        self.assertEqual(spec_string.lower().count('priority'), 1)
+        self.assertTrue(spec_string.endswith('priority = 7\nqueue 10\n'))
+        self.assertTrue(spec_string.startswith('executable = CopasiSE\n'))
+
+
+class FederationTest(TestCase):
+    """The jobs of a federated subtask are split between its pools by their throughput"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user = User.objects.create_user('test', 'test@example.com', 'test')
+        self.pools = [CondorPool.objects.create(name='pool %d' % i, user=self.user) for i in range(3)]
+        task = self.create_task()
+        self.subtask = Subtask.objects.create(task=task, index=1, type='main', status='running')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_task(self):
+        return Task.objects.create(name='test', user=self.user, condor_pool=self.pools[0], task_type='test', original_model='model.cps', directory=self.directory, status='running')
+
+    def set_remaining(self, remaining):
+        self.subtask.unsubmitted_job_count = remaining
+        self.subtask.save()
+
+    def add_finished_subtask(self):
+        """A subtask that took an hour, with 6 jobs run on the task's own pool and 3 on the second pool"""
+        time_now = now()
+        subtask = Subtask.objects.create(task=self.create_task(), index=1, type='main', status='finished',
+                                         start_time=time_now - datetime.timedelta(hours=2), finish_time=time_now - datetime.timedelta(hours=1))
+        for i in range(6):
+            CondorJob.objects.create(subtask=subtask, status='F', process_id=i, run_time=0.5 / 24)
+        for i in range(3):
+            CondorJob.objects.create(subtask=subtask, status='F', process_id=6 + i, condor_pool=self.pools[1], run_time=0.25 / 24)
+        CondorJob.objects.create(subtask=subtask, status='E', process_id=9, condor_pool=self.pools[1])
+
+    def test_pool_throughput(self):
+        self.assertEqual(federation.get_pool_throughput(self.pools[0]), None)
+        self.add_finished_subtask()
+        #Jobs with no pool recorded ran on the task's own pool
+        self.assertAlmostEqual(federation.get_pool_throughput(self.pools[0]), 6.0)
+        #The second pool was only busy for the 0.75 hours its jobs took
+        self.assertAlmostEqual(federation.get_pool_throughput(self.pools[1]), 4.0)
+        self.assertEqual(federation.get_pool_throughput(self.pools[2]), None)
+
+    def test_equal_shares(self):
+        #With no throughput known for some of the pools, the jobs are split equally
+        self.add_finished_subtask()
+        self.set_remaining(10)
+        shares = federation.get_chunk_shares(self.subtask, self.pools)
+        self.assertEqual([share for pool, share in shares], [4, 3, 3])
+        self.assertEqual(shares[0][0], self.pools[0])
+
+    def test_throughput_shares(self):
+        self.add_finished_subtask()
+        for remaining in [1, 11, 1000]:
+            self.set_remaining(remaining)
+            shares = federation.get_chunk_shares(self.subtask, self.pools[:2])
+            #The shares add up to the remaining jobs, largest first
+            self.assertEqual(sum([share for pool, share in shares]), remaining)
+            self.assertEqual(shares[0][0], self.pools[0])
+        self.set_remaining(11)
+        self.assertEqual(federation.get_chunk_shares(self.subtask, self.pools[:2]), [(self.pools[0], 7), (self.pools[1], 4)])
+
+
+class ModelCacheTest(SimpleTestCase):
+    """Parsed models are cached until the file changes, dropping the least recently used ones when full"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_size = getattr(settings, 'MODEL_CACHE_FILE_SIZE', None)
+        settings.MODEL_CACHE_FILE_SIZE = 1 #MB
+        model_cache.clear()
+
+    def tearDown(self):
+        model_cache.clear()
+        if self.cache_size == None:
+            del settings.MODEL_CACHE_FILE_SIZE
+        else:
+            settings.MODEL_CACHE_FILE_SIZE = self.cache_size
+        shutil.rmtree(self.directory)
+
+    def write_model(self, name, size):
+        """Write a model file of exactly size bytes"""
+        path = os.path.join(self.directory, name)
+        model_string = '<COPASI><Model name="%s">%%s</Model></COPASI>' % name
+        model_file = open(path, 'w')
+        model_file.write(model_string % ('x' * (size - len(model_string) + 2)))
+        model_file.close()
+        self.assertEqual(os.path.getsize(path), size)
+        return path
+
+    def get_cached_paths(self):
+        return [key[0] for key, tree in model_cache._cache]
+
+    def test_cached(self):
+        path = self.write_model('a.cps', 1000)
+        tree = model_cache.get_tree(path)
+        self.assertTrue(model_cache.get_tree(path) is tree)
+        self.assertEqual(model_cache._cache_size, 1000)
+        #A private copy can be changed without affecting the cached tree
+        model_cache.copy_tree(tree).getroot()[0].set('name', 'changed')
+        self.assertEqual(model_cache.get_tree(path).getroot()[0].get('name'), 'a.cps')
+
+    def test_invalidation(self):
+        path = self.write_model('a.cps', 1000)
+        tree = model_cache.get_tree(path)
+        self.write_model('a.cps', 2000)
+        changed_tree = model_cache.get_tree(path)
+        self.assertFalse(changed_tree is tree)
+        self.assertEqual(len(changed_tree.getroot()[0].text), len(tree.getroot()[0].text) + 1000)
+        #The out of date copy is dropped
+        self.assertEqual(self.get_cached_paths(), [os.path.abspath(path)])
+        self.assertEqual(model_cache._cache_size, 2000)
+
+        #A change of modification time alone is also picked up
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime - 60))
+        self.assertFalse(model_cache.get_tree(path) is changed_tree)
+        self.assertEqual(len(model_cache._cache), 1)
+
+    def test_lru_eviction(self):
+        size = 400 * 1024
+        paths = [self.write_model(name, size) for name in ['a.cps', 'b.cps', 'c.cps']]
+        trees = [model_cache.get_tree(path) for path in paths[:2]]
+        #Use a.cps again, so that b.cps is the least recently used
+        self.assertTrue(model_cache.get_tree(paths[0]) is trees[0])
+        model_cache.get_tree(paths[2])
+        self.assertEqual(self.get_cached_paths(), [os.path.abspath(paths[0]), os.path.abspath(paths[2])])
+        self.assertEqual(model_cache._cache_size, 2 * size)
+        self.assertTrue(model_cache._cache_size <= model_cache.get_max_size())
+        self.assertTrue(model_cache.get_tree(paths[0]) is trees[0])
+        self.assertFalse(model_cache.get_tree(paths[1]) is trees[1])
+
+    def test_too_large(self):
+        path = self.write_model('a.cps', 1024 * 1024 + 1)
+        model_cache.get_tree(path)
+        self.assertEqual(len(model_cache._cache), 0)
+        self.assertEqual(model_cache._cache_size, 0)
+
+
+MODEL_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- generated with COPASI -->
+<COPASI xmlns="http://www.copasi.org/static/schema" versionMajor="4" versionMinor="12">
+  <Model key="Model_1" name="Mod\xc3\xa8le &amp; test">
+    <Comment>A model with &lt;escaped&gt; text</Comment>
+  </Model>
+  <ListOfTasks>
+    <Task key="Task_1" name="Scan" type="scan">
+      <Report reference="Report_1" target="" append="0"/>
+      <Problem>
+        <Parameter name="Number of steps" type="unsignedInteger" value="10"/>
+      </Problem>
+    </Task>
+  </ListOfTasks>
+</COPASI>
+"""
+
+class ModelVariantsTest(SimpleTestCase):
+    """Job models spliced into the serialised model are byte for byte the same as those written by write()"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {}
+        for name in ['COPASI_JOB_WRITER_PROCESSES', 'COPASI_JOB_WRITER_MIN_JOBS']:
+            self.settings[name] = getattr(settings, name, None)
+        model_file = open(os.path.join(self.directory, 'model.cps'), 'wb')
+        model_file.write(MODEL_FILE)
+        model_file.close()
+        model_cache.clear()
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            if value == None:
+                if hasattr(settings, name):
+                    delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+        model_cache.clear()
+        shutil.rmtree(self.directory)
+
+    def get_set_values(self, model):
+        task = model.model.getroot().find('{http://www.copasi.org/static/schema}ListOfTasks')[0]
+        report = task.find('{http://www.copasi.org/static/schema}Report')
+        parameter = task.find('{http://www.copasi.org/static/schema}Problem')[0]
+        def set_values(process, values):
+            parameter.attrib['value'] = values['steps']
+            report.set('target', 'output_1.%s.txt' % process)
+        return set_values
+
+    def read(self, filename):
+        model_file = open(filename, 'rb')
+        model_string = model_file.read()
+        model_file.close()
+        return model_string
+
+    def assert_variants_identical(self, job_count):
+        model = CopasiModel(os.path.join(self.directory, 'model.cps'))
+        job_values = [{'steps': str(i + 1)} for i in range(job_count)]
+        #Values that would need escaping are written with write()
+        job_values[1]['steps'] = '1 & <2>'
+        jobs = [(os.path.join(self.directory, 'auto_copasi_1.%d.cps' % i), str(i), values) for i, values in enumerate(job_values)]
+        model._write_model_variants(jobs, self.get_set_values(model))
+
+        expected_model = CopasiModel(os.path.join(self.directory, 'model.cps'))
+        set_values = self.get_set_values(expected_model)
+        for filename, process, values in jobs:
+            set_values(process, values)
+            expected_model.write(filename + '.expected')
+            self.assertEqual(self.read(filename), self.read(filename + '.expected'))
+            self.assertFalse(os.path.exists(filename + '.tmp'))
+        self.assertTrue('<!-- generated with COPASI -->' in self.read(jobs[0][0]))
+
+    def test_identical(self):
+        settings.COPASI_JOB_WRITER_PROCESSES = 1
+        self.assert_variants_identical(5)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+    def test_identical_worker_processes(self):
+        settings.COPASI_JOB_WRITER_PROCESSES = 3
+        settings.COPASI_JOB_WRITER_MIN_JOBS = 2
+        self.assert_variants_identical(10)